@@ -1,5 +1,9 @@
 from ._version import __name__, __date__, __version__, __authors__
 
+# The heavy dependencies (matplotlib, IPython, scikit-learn, scipy, tqdm) are
+# imported inside the functions that use them, so that importing the package
+# stays fast
+
 
 class info:
     """
@@ -0,0 +1,213 @@
+"""
+    This file contains functions to read the .ASC files written by the ALV
+    correlator of the photon correlation spectroscopy (PCS) setup at the ALS.
+
+    An .ASC file consists of a header ("key : value" lines, e.g., the
+    Temperature, Duration and Runs of the measurement) followed by quoted
+    section names (e.g., "Correlation", "Count Rate", "StandardDeviation"),
+    each followed by a block of tab-separated numbers.
+
+    Authors: Dayne Sasaki
+"""
+import os.path
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+# ALV files are written on Windows with a latin-1 code page (e.g., "°")
+ASC_ENCODING = 'latin-1'
+
+# Characters a line of a numeric block can start with
+_NUMERIC_START = frozenset('0123456789+-.')
+
+
+def _convert_value(value: str) -> int | float | str:
+    # Converts a header value into an int, float or (unquoted) string
+    value = value.strip()
+    if value.startswith('"'):
+        return value.strip('"')
+    for data_type in (int, float):
+        try:
+            return data_type(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _convert_block(lines: list[str], name: str, path_file: str) -> np.ndarray:
+    # Converts the lines of a numeric block into a 2D array in one go
+    values = np.array(' '.join(lines).split(), dtype=float)
+    if values.size % len(lines) != 0:
+        raise ValueError(f'The rows of the "{name}" section of {path_file} '
+                         f'have different numbers of columns')
+    return values.reshape(len(lines), -1)
+
+
+def read_asc(path_file: str) -> dict:
+    """
+    Reads an ALV .ASC file in a single pass over its lines
+
+    PARAMETERS
+    -----
+    path_file: str
+        The pathname of the .ASC file
+
+    RETURNS
+    -----
+    asc_data: dict
+        'header': dict
+            All "key : value" entries of the file, with the key as written
+            in the file (e.g., 'Temperature [K]', 'Duration [s]', 'Runs',
+            'MeanCR0 [kHz]'). Values are converted to int or float where
+            possible. Entries following the data sections (e.g.,
+            'Monitor Diode') are included as well.
+        'lag_time': np.ndarray
+            The lag times of the correlation function
+        'correlation': np.ndarray
+            The lag times x channels correlation function
+        'count_time': np.ndarray
+            The times of the count rate trace
+        'count_rate': np.ndarray
+            The times x channels count rate trace
+        'blocks': dict[str, np.ndarray]
+            All numeric sections (including "Correlation" and "Count Rate")
+            as 2D arrays, with the first column holding the lag times/times
+    """
+    header = {}
+    blocks = {}
+    block_name = None
+    block_lines = []
+
+    with open(path_file, mode='r', encoding=ASC_ENCODING) as asc_file:
+        for line in asc_file:
+            stripped = line.strip()
+
+            # Collect the lines of a numeric block
+            if block_name is not None and stripped and \
+                    stripped[0] in _NUMERIC_START:
+                block_lines.append(stripped)
+                continue
+
+            # Any other line ends the current block
+            if block_lines:
+                blocks[block_name] = _convert_block(block_lines, block_name,
+                                                    path_file)
+            block_name = None
+            block_lines = []
+
+            if not stripped:
+                continue
+            elif stripped.startswith('"'):
+                # A quoted line starts a new section
+                block_name = stripped.strip('"')
+            elif ':' in stripped and not blocks:
+                # Header entries before the data sections are "key : value"
+                key, _, value = stripped.partition(':')
+                header[key.strip()] = _convert_value(value)
+            elif '\t' in stripped:
+                # Entries after the data sections are "key <tab> value"
+                key, _, value = stripped.partition('\t')
+                header[key.strip()] = _convert_value(value)
+
+    # Close the last block of the file
+    if block_lines:
+        blocks[block_name] = _convert_block(block_lines, block_name,
+                                            path_file)
+
+    correlation = blocks.get('Correlation', np.empty((0, 2)))
+    count_rate = blocks.get('Count Rate', np.empty((0, 2)))
+
+    return {'header': header,
+            'lag_time': correlation[:, 0],
+            'correlation': correlation[:, 1:],
+            'count_time': count_rate[:, 0],
+            'count_rate': count_rate[:, 1:],
+            'blocks': blocks}
+
+
+def _stack_padded(arrays: list[np.ndarray]) -> np.ndarray:
+    # Stacks arrays of different lengths, padding the missing values with NaN
+    shape = np.max([array.shape for array in arrays], axis=0)
+    stacked = np.full((len(arrays),) + tuple(shape), np.nan)
+    for idx, array in enumerate(arrays):
+        stacked[(idx,) + tuple(slice(0, n) for n in array.shape)] = array
+    return stacked
+
+
+def load_asc_files(
+        path_files: str | list[str],
+        *,
+        workers: int = 1,
+        chunksize: int = None,
+        verbose: bool = False
+) -> tuple[dict, pd.DataFrame]:
+    """
+    Reads many ALV .ASC files (e.g., all files of a series of measurements)
+    into stacked arrays and a table of their header entries
+
+    PARAMETERS
+    -----
+    path_files: str or list[str]
+        The pathname of a directory (all .ASC files within it are read), a
+        glob pattern or a list of pathnames
+
+    workers: int
+        Number of processes reading the files. Reading a typical file takes
+        well below a millisecond, so several processes mostly pay off on
+        slow (e.g., network) file systems.
+
+    chunksize: int
+        Number of files handed to a process at once. By default the
+        files are split into about four chunks per process.
+
+    verbose: bool
+        Prints out the number of files read
+
+    RETURNS
+    -----
+    (asc_data, metadata_df): tuple
+        asc_data: dict
+            'lag_time': files x lags array
+            'correlation': files x lags x channels array
+            'count_time': files x times array
+            'count_rate': files x times x channels array
+            Files with fewer lags/times/channels than others are padded
+            with NaN.
+        metadata_df: pd.DataFrame
+            One row per file (i.e., per first index of the arrays) with
+            the file 'path' and all header entries of the file
+    """
+    # Bring all kinds of file inputs into a sorted list of path names
+    if isinstance(path_files, str):
+        if os.path.isdir(path_files):
+            path_files = [path for path in
+                          glob(os.path.join(path_files, '*'))
+                          if path.lower().endswith('.asc')]
+        else:
+            path_files = glob(path_files)
+        path_files = sorted(path_files)
+    if len(path_files) == 0:
+        raise ValueError('No .ASC files were found')
+
+    # Read the files either one at a time or spread over several processes
+    if workers > 1 and len(path_files) > 1:
+        chunksize = chunksize or max(1, len(path_files) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            all_data = list(executor.map(read_asc, path_files,
+                                         chunksize=chunksize))
+    else:
+        all_data = [read_asc(path_file) for path_file in path_files]
+
+    if verbose:
+        print(f'Read {len(all_data)} .ASC files')
+
+    asc_data = {key: _stack_padded([data[key] for data in all_data])
+                for key in ('lag_time', 'correlation', 'count_time',
+                            'count_rate')}
+    metadata_df = pd.DataFrame([{'path': path_file, **data['header']}
+                                for path_file, data
+                                in zip(path_files, all_data)])
+
+    return asc_data, metadata_df
@@ -0,0 +1,420 @@
+"""
+    This file contains the command-line entry points of the package, so that
+    repairs, file grouping and batch dichroism can be run (e.g., by a cluster
+    scheduler) without a Jupyter kernel:
+
+        bl7011-repair      repair broken bluesky .h5 files (h5repair)
+        bl7011-groups      group the .h5 files of a directory (get_file_groups)
+        bl7011-dichroism   batch dichroism of a directory
+
+    Progress is written to stdout as JSON lines, one object per line with an
+    "event" entry ("start", "progress", "group", "error" or "done"). All other
+    output of the processing functions is redirected to stderr.
+
+    Authors: Damian Günzing
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+
+class _Progress:
+    """
+    Writes JSON lines with the number of files done, the bytes read, the
+    throughput in MB/s and the estimated time until all files are done.
+    """
+
+    def __init__(self, command: str, n_total: int, stream=None):
+        self.command = command
+        self.n_total = n_total
+        self.n_done = 0
+        self.bytes_read = 0
+        self.time_start = time.perf_counter()
+        self.stream = stream or sys.stdout
+        self.emit("start", files_total=n_total)
+
+    def emit(self, event: str, **entries) -> None:
+        line = {"event": event, "command": self.command, **entries}
+        self.stream.write(json.dumps(line) + "\n")
+        self.stream.flush()
+
+    def update(self, n_files: int = 1, n_bytes: int = 0, **entries) -> None:
+        self.n_done += n_files
+        self.bytes_read += n_bytes
+        elapsed = time.perf_counter() - self.time_start
+        rate = self.n_done / elapsed if elapsed > 0 else 0.0
+        eta = (self.n_total - self.n_done) / rate if rate > 0 else None
+        self.emit(
+            "progress",
+            files_done=self.n_done,
+            files_total=self.n_total,
+            bytes_read=self.bytes_read,
+            elapsed_s=round(elapsed, 3),
+            mb_per_s=round(self.bytes_read / 2**20 / elapsed, 3) if elapsed > 0 else 0.0,
+            eta_s=None if eta is None else round(eta, 3),
+            **entries,
+        )
+
+    def done(self, **entries) -> None:
+        self.emit(
+            "done",
+            files_done=self.n_done,
+            bytes_read=self.bytes_read,
+            elapsed_s=round(time.perf_counter() - self.time_start, 3),
+            **entries,
+        )
+
+
+def _map(function, items: list, workers: int, chunksize: int):
+    """
+    Maps function over items, in worker processes if workers > 1. Results are
+    yielded in the order of items as soon as they are available.
+    """
+    if workers <= 1:
+        yield from map(function, items)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(function, items, chunksize=chunksize)
+
+
+def _add_common_arguments(parser: argparse.ArgumentParser) -> None:
+    # Options shared by all commands
+    parser.add_argument(
+        "-j", "--workers", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1,
+        help="number of files (or file groups) handed to a worker at once",
+    )
+
+
+def _add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    # Options of the manifest that skips up-to-date outputs (BL7011.manifest)
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="do not use the manifest, recompute and overwrite all outputs",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="recompute outputs that are up to date"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only list the outputs which would be recomputed",
+    )
+    parser.add_argument(
+        "--identity",
+        choices=["mtime", "hash"],
+        default="mtime",
+        help="identify input files by size and mtime or by content hash",
+    )
+
+
+def _key_arguments(parser: argparse.ArgumentParser) -> None:
+    # Options defining the file groups
+    parser.add_argument("path_dir", help="directory which contains the h5 files")
+    parser.add_argument(
+        "--key-common",
+        nargs="+",
+        required=True,
+        help="labview entries common to the files of a group",
+    )
+    parser.add_argument(
+        "--key-variable",
+        default="EPU_Polarization",
+        help="labview entry which differs within a group",
+    )
+    parser.add_argument("--search", default="", help="only use files containing this")
+
+
+# ---------------------------------------------------------------- repair
+
+
+def _repair_worker(task: dict) -> dict:
+    # Repairs a single file, printed output goes to stderr
+    from BL7011.repair import h5repair
+
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            h5repair(**task)
+        return {"file": task["h5filename"], "output": task["outputfilename"]}
+    except Exception as error:
+        return {
+            "file": task["h5filename"],
+            "error": repr(error),
+            "traceback": traceback.format_exc(),
+        }
+
+
+def repair_main(argv: list[str] = None) -> int:
+    """
+    Entry point of bl7011-repair.
+    """
+    from BL7011 import manifest as mf
+
+    parser = argparse.ArgumentParser(
+        prog="bl7011-repair",
+        description="Repair broken bluesky .h5 files into Nexus-style files.",
+    )
+    parser.add_argument("files", nargs="+", help="broken *_0.h5 files (or globs)")
+    parser.add_argument(
+        "--json",
+        default="",
+        help="labview .json file (only for a single file, "
+        "by default *_documents.json next to each file)",
+    )
+    parser.add_argument("-o", "--output-dir", default="", help="directory of the outputs")
+    parser.add_argument("--average", type=int, default=10, help="frames per average")
+    parser.add_argument(
+        "--roi",
+        type=int,
+        nargs=4,
+        default=[0, 2048, 0, 2048],
+        metavar=("START_ROW", "END_ROW", "START_COL", "END_COL"),
+    )
+    parser.add_argument("--eps", type=float, default=0.3, help="DBSCAN eps")
+    parser.add_argument("--dtype", default=None, help="dtype of the repaired data")
+    parser.add_argument("--pyramid", action="store_true", help="store preview pyramids")
+    parser.add_argument("--binning", type=int, default=1, help="sum binning x binning pixels")
+    _add_common_arguments(parser)
+    _add_cache_arguments(parser)
+    args = parser.parse_args(argv)
+
+    files = sorted({path for pattern in args.files for path in (glob(pattern) or [pattern])})
+    if args.json and len(files) > 1:
+        parser.error("--json can only be given for a single file")
+
+    tasks = []
+    for path in files:
+        output = path.replace(".h5", "_repaired.h5")
+        if args.output_dir:
+            output = os.path.join(args.output_dir, os.path.basename(output))
+        tasks.append(
+            {
+                "h5filename": path,
+                "jsonfilename": args.json or path.replace("_0.h5", "_documents.json"),
+                "outputfilename": output,
+                "average": args.average,
+                "roi": list(args.roi),
+                "eps": args.eps,
+                "pyramid": args.pyramid,
+                "dtype": args.dtype,
+                "binning": args.binning,
+            }
+        )
+
+    # Leave out the files whose repaired output is up to date
+    params = {key: args.__dict__[key] for key in ("average", "roi", "eps", "dtype")}
+    if args.binning != 1:
+        params["binning"] = args.binning
+    if args.pyramid:
+        params["pyramid"] = args.pyramid
+    manifests = {}
+    if not args.no_cache:
+        stale = []
+        for task in tasks:
+            out_dir = os.path.dirname(os.path.abspath(task["outputfilename"]))
+            manifest = manifests.setdefault(out_dir, mf.load_manifest(out_dir))
+            inputs = [task["h5filename"], task["jsonfilename"]]
+            if args.force or not mf.is_up_to_date(
+                manifest, task["outputfilename"], inputs, params, args.identity
+            ):
+                stale.append(task)
+        tasks = stale
+
+    progress = _Progress("repair", len(tasks))
+    if args.dry_run:
+        for task in tasks:
+            progress.emit("would_recompute", file=task["h5filename"], output=task["outputfilename"])
+        progress.done(dry_run=True)
+        return 0
+
+    n_errors = 0
+    for task, result in zip(tasks, _map(_repair_worker, tasks, args.workers, args.chunk_size)):
+        if "error" in result:
+            n_errors += 1
+            progress.emit("error", **result)
+            progress.update(1)
+            continue
+
+        if not args.no_cache:
+            out_dir = os.path.dirname(os.path.abspath(task["outputfilename"]))
+            mf.record(
+                manifests[out_dir],
+                task["outputfilename"],
+                [task["h5filename"], task["jsonfilename"]],
+                params,
+                args.identity,
+            )
+            mf.save_manifest(out_dir, manifests[out_dir])
+        progress.update(1, os.path.getsize(task["h5filename"]), **result)
+
+    progress.done(errors=n_errors)
+    return 1 if n_errors else 0
+
+
+# ---------------------------------------------------------------- groups
+
+
+def _read_groups(args, command: str):
+    # Reads the labview data of all files with progress and groups them
+    from BL7011 import file_processing as fp
+
+    paths = [
+        path
+        for path in sorted(glob(os.path.join(args.path_dir, "*.h5")))
+        if args.search in path and not os.path.basename(path).startswith("processed_")
+    ]
+    progress = _Progress(command, len(paths))
+    with contextlib.redirect_stdout(sys.stderr):
+        file_df, unique_positions, file_group = fp.get_file_groups(
+            os.path.join(args.path_dir, ""),
+            key_common=tuple(args.key_common),
+            key_variable=args.key_variable,
+            search=args.search,
+            workers=args.workers,
+            chunksize=args.chunk_size,
+            progress=lambda path: progress.update(1, os.path.getsize(path), file=path),
+        )
+    return progress, file_df, unique_positions, file_group
+
+
+def groups_main(argv: list[str] = None) -> int:
+    """
+    Entry point of bl7011-groups.
+    """
+    parser = argparse.ArgumentParser(
+        prog="bl7011-groups",
+        description="Group the .h5 files of a directory by their labview data.",
+    )
+    _key_arguments(parser)
+    parser.add_argument("-o", "--output", default="", help="also write file_df to this CSV")
+    _add_common_arguments(parser)
+    args = parser.parse_args(argv)
+
+    progress, file_df, unique_positions, file_group = _read_groups(args, "groups")
+
+    # One line per file group with its common values and members
+    for idx in range(len(unique_positions)):
+        group_df = file_df[file_group[idx]]
+        progress.emit(
+            "group",
+            values={key: float(unique_positions[key].iloc[idx]) for key in args.key_common},
+            files=list(group_df["path"]),
+            variable=[float(value) for value in group_df[args.key_variable]],
+        )
+
+    if args.output:
+        file_df.to_csv(args.output, index=False)
+    progress.done(groups=len(unique_positions))
+    return 0
+
+
+# ---------------------------------------------------------------- dichroism
+
+
+def _dichroism_worker(task: dict) -> dict:
+    # Processes the dichroism of a single file group, printed output goes to
+    # stderr. The manifest entries written by the worker are sent back.
+    from BL7011 import file_processing as fp
+
+    try:
+        manifest = task.pop("manifest")
+        with contextlib.redirect_stdout(sys.stderr):
+            save_paths = fp.process_dichroism_group(**task, manifest=manifest)
+        entries = {}
+        if manifest is not None:
+            for path in save_paths:
+                name = os.path.basename(path)
+                if name in manifest:
+                    entries[name] = manifest[name]
+        return {"outputs": save_paths, "manifest": entries}
+    except Exception as error:
+        return {"error": repr(error), "traceback": traceback.format_exc()}
+
+
+def dichroism_main(argv: list[str] = None) -> int:
+    """
+    Entry point of bl7011-dichroism.
+    """
+    from BL7011 import manifest as mf
+
+    # Figures are only saved, never shown (also in the worker processes)
+    os.environ["MPLBACKEND"] = "Agg"
+
+    parser = argparse.ArgumentParser(
+        prog="bl7011-dichroism",
+        description="Batch dichroism of all file groups of a directory.",
+    )
+    _key_arguments(parser)
+    parser.add_argument("--mode", choices=["difference", "asymmetry"], default="difference")
+    parser.add_argument("--correction", default="", help="'i0 blade', 'i0 rlrl' or 'cps'")
+    parser.add_argument("--variable-stack", action="store_true")
+    parser.add_argument("--dtype", default=None, help="dtype of the saved images")
+    parser.add_argument("--pyramid", action="store_true", help="store preview pyramids")
+    parser.add_argument("--save-figure", action="store_true", help="save a PNG per output")
+    parser.add_argument("--binning", type=int, default=1, help="sum binning x binning pixels")
+    _add_common_arguments(parser)
+    _add_cache_arguments(parser)
+    args = parser.parse_args(argv)
+
+    _, file_df, unique_positions, file_group = _read_groups(args, "dichroism")
+
+    manifest = None if args.no_cache else mf.load_manifest(args.path_dir)
+    tasks = []
+    for idx in range(len(unique_positions)):
+        tasks.append(
+            {
+                "file_group_df": file_df[file_group[idx]],
+                "path_dir": args.path_dir,
+                "key_variable": args.key_variable,
+                "mode": args.mode,
+                "correction": args.correction,
+                "variable_stack": args.variable_stack,
+                "save_figure": args.save_figure,
+                "plot": args.save_figure,
+                "reuse_figure": True,
+                "pyramid": args.pyramid,
+                "dtype": args.dtype,
+                "binning": args.binning,
+                "force": args.force,
+                "dry_run": args.dry_run,
+                "identity": args.identity,
+                "manifest": manifest,
+            }
+        )
+
+    progress = _Progress("dichroism", len(tasks))
+    n_errors, n_outputs = 0, 0
+    for task, result in zip(
+        tasks, _map(_dichroism_worker, tasks, args.workers, args.chunk_size)
+    ):
+        if "error" in result:
+            n_errors += 1
+            progress.emit("error", **result)
+            progress.update(1)
+            continue
+
+        if manifest is not None and result["manifest"]:
+            manifest.update(result["manifest"])
+            mf.save_manifest(args.path_dir, manifest)
+
+        # The input files of a group are only read if an output was computed
+        n_bytes = 0
+        if result["outputs"] and not args.dry_run:
+            n_bytes = sum(os.path.getsize(path) for path in task["file_group_df"]["path"])
+        n_outputs += len(result["outputs"])
+        key = "would_recompute" if args.dry_run else "outputs"
+        progress.update(1, n_bytes, **{key: result["outputs"]})
+
+    progress.done(outputs=n_outputs, errors=n_errors, dry_run=args.dry_run)
+    return 1 if n_errors else 0
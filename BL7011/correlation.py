@@ -0,0 +1,514 @@
+"""
+    This file contains functions to calculate intensity correlation functions
+    of CCD image stacks for X-ray photon correlation spectroscopy (XPCS).
+
+    The frames are streamed from the HDF5 files (or from an in-memory stack)
+    block by block, so that the length of a measurement is not limited by
+    the available memory.
+
+    Authors: Damian Günzing
+"""
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+from BL7011.tools import frames_per_block
+
+# Detector datasets of the Nexus and of the broken bluesky files
+NEXUS_DATASET = "entry1/instrument_1/detector_1/data"
+BLUESKY_DATASET = "entry/data/data"
+
+
+@contextmanager
+def _open_stack(source, dataset_path: str = None):
+    # Yields the image stack of an h5 file (opened for the duration of the
+    # with block) or an in-memory stack as is
+    if not isinstance(source, str):
+        yield source
+        return
+    with h5py.File(source, "r") as h5_file:
+        if dataset_path is None:
+            in_file = NEXUS_DATASET in h5_file
+            dataset_path = NEXUS_DATASET if in_file else BLUESKY_DATASET
+        yield h5_file[dataset_path]
+
+
+def iter_frame_blocks(
+    stack,
+    *,
+    roi: list = None,
+    start: int = 0,
+    stop: int = None,
+    block_frames: int = 64,
+):
+    """
+    Iterates over blocks of consecutive frames of an image stack. Only the
+    frames of a block (and only their ROI) are read at a time.
+
+    Parameters
+    ----------
+    stack : h5py.Dataset or np.ndarray
+        A (F, M, N) image stack or a Nexus (a, b, M, N) stack, whose images
+        and exposures are taken as a * b consecutive frames.
+    roi : list
+        Region of interest in the format [start_row, end_row, start_col,
+        end_col]. None uses the whole frames.
+    start, stop : int
+        First and last (exclusive) frame to read.
+    block_frames : int
+        Number of frames per block.
+
+    Yields
+    ------
+    block : np.ndarray
+        The (k, M', N') float32 frames of the block.
+    """
+    roi = [0, stack.shape[-2], 0, stack.shape[-1]] if roi is None else roi
+    n_exposures = stack.shape[1] if stack.ndim == 4 else 1
+    n_frames = stack.shape[0] * n_exposures
+    stop = n_frames if stop is None else min(stop, n_frames)
+    for block_start in range(start, stop, block_frames):
+        block_stop = min(block_start + block_frames, stop)
+        # Read whole images of a Nexus stack and cut the exposures after
+        first, last = block_start // n_exposures, -(-block_stop // n_exposures)
+        block = stack[first:last, ..., roi[0] : roi[1], roi[2] : roi[3]]
+        block = np.asarray(block, dtype=np.float32).reshape(
+            (-1,) + block.shape[-2:]
+        )
+        offset = block_start - first * n_exposures
+        yield block[offset : offset + block_stop - block_start]
+
+
+def _sort_labels(labels: np.ndarray, frame_shape: tuple) -> tuple:
+    # Returns the (flat) labelled pixels sorted by their label, so that the
+    # pixels of a bin are contiguous, and the labels, first positions and
+    # numbers of pixels of the bins
+    labels = np.asarray(labels).ravel()
+    if labels.size != np.prod(frame_shape):
+        raise ValueError("labels has to have the shape of the frames")
+    pixels = np.flatnonzero(labels > 0)
+    pixels = pixels[np.argsort(labels[pixels], kind="stable")]
+    bins, starts, sizes = np.unique(labels[pixels], return_index=True, return_counts=True)
+    return pixels, bins, starts, sizes
+
+
+def multi_tau_lags(num_levels: int, num_bufs: int = 8) -> np.ndarray:
+    """
+    Returns the lag times (in frames) of a multi-tau correlator. The first
+    level has the lags 0 ... num_bufs - 1, every further level l the lags
+    num_bufs / 2 ... num_bufs - 1 in units of 2**l frames.
+
+    Parameters
+    ----------
+    num_levels : int
+        Number of levels of the correlator.
+    num_bufs : int
+        Number of buffered frames per level (even).
+
+    Returns
+    -------
+    lags : np.ndarray
+        The lag times in frames.
+    """
+    if num_bufs % 2 != 0 or num_bufs < 2:
+        raise ValueError("num_bufs has to be an even number")
+    lags = [np.arange(num_bufs)]
+    for level in range(1, num_levels):
+        lags.append(np.arange(num_bufs // 2, num_bufs) * 2**level)
+    return np.concatenate(lags)
+
+
+class MultiTauCorrelator:
+    """
+    Multi-tau intensity autocorrelation g2(q, tau) of a stream of frames.
+
+    Every two frames of a level are averaged into one frame of the next
+    level. The frames of a level are correlated with the last num_bufs - 1
+    frames of that level only, so the memory is about num_levels * num_bufs
+    frames (plus the block being added), independent of the number of
+    frames.
+
+    The products are reduced to q-bins right away, so the accumulators have
+    only one entry per lag and q-bin. With labels=None, every pixel is its
+    own q-bin (per-pixel g2).
+
+    g2 uses the symmetric normalization
+    g2(q, tau) = <I(t) I(t + tau)> / (<I(t)> <I(t + tau)>),
+    where <> averages over all frame pairs of the lag and over the pixels of
+    the q-bin.
+
+    Parameters
+    ----------
+    frame_shape : tuple
+        Shape (M, N) of the frames.
+    labels : np.ndarray
+        (M, N) array of q-bin (or ROI) numbers 1 ... Q for every pixel,
+        pixels labelled 0 are ignored. None computes the g2 of every pixel.
+    num_levels : int
+        Number of levels, the longest lag is about num_bufs * 2**(num_levels
+        - 1) frames.
+    num_bufs : int
+        Number of buffered frames per level (even).
+    """
+
+    def __init__(
+        self,
+        frame_shape: tuple,
+        *,
+        labels: np.ndarray = None,
+        num_levels: int = 10,
+        num_bufs: int = 8,
+    ):
+        self.lags = multi_tau_lags(num_levels, num_bufs)
+        self.frame_shape = tuple(frame_shape)
+        self.num_levels = num_levels
+        self.num_bufs = num_bufs
+        self.max_block = 256
+
+        if labels is None:
+            # Every pixel is its own bin
+            self._pixels = None
+            self._bin_starts = None
+            self._bin_sizes = np.ones(int(np.prod(frame_shape)))
+            self.n_bins = len(self._bin_sizes)
+        else:
+            self._pixels, self.bins, self._bin_starts, self._bin_sizes = _sort_labels(
+                labels, frame_shape
+            )
+            self.n_bins = len(self.bins)
+        n_pixels = self.n_bins if self._pixels is None else len(self._pixels)
+
+        # The last num_bufs - 1 frames of each level (and their bin sums),
+        # which are correlated with the frames of the next block
+        empty = np.zeros((0, n_pixels), dtype=np.float32)
+        self._history = [empty] * num_levels
+        self._history_sums = [np.zeros((0, self.n_bins))] * num_levels
+        # Frames of each level waiting for their partner to be averaged
+        self._pending = [empty] * num_levels
+
+        # Sums of I(t) I(t + tau), I(t) and I(t + tau) per lag and bin
+        n_lags = len(self.lags)
+        self._g = np.zeros((n_lags, self.n_bins))
+        self._past = np.zeros((n_lags, self.n_bins))
+        self._future = np.zeros((n_lags, self.n_bins))
+        self._counts = np.zeros(n_lags, dtype=np.int64)
+        self.n_frames = 0
+
+    def _reduce(self, values: np.ndarray) -> np.ndarray:
+        # Sums the last axis of (..., pixels) values over the pixels of each bin
+        if self._bin_starts is None:
+            return values
+        return np.add.reduceat(values, self._bin_starts, axis=-1)
+
+    def _update_level(self, level: int, frames: np.ndarray) -> None:
+        # Correlates a block of new frames of a level with each other and
+        # with the history of the level, then bins them for the next level
+        m = self.num_bufs
+        frames_ext = np.concatenate([self._history[level], frames])
+        sums_ext = np.concatenate([self._history_sums[level], self._reduce(frames)])
+        n_old, n_ext = len(self._history[level]), len(frames_ext)
+        # Bin sums of all new frames, the past frames of a lag differ from
+        # them only by a few frames at both ends
+        new_sum = sums_ext[n_old:].sum(axis=0)
+
+        # Lags of this level (in units of its frames) and their position in
+        # the lag array
+        first = 0 if level == 0 else m // 2
+        start = 0 if level == 0 else m + (level - 1) * (m // 2) - first
+        for lag in range(first, m):
+            # All pairs of a new frame and the frame lag frames before it
+            t0 = max(n_old, lag)
+            if t0 >= n_ext:
+                break
+            future = frames_ext[t0:]
+            past = frames_ext[t0 - lag : n_ext - lag]
+            # Sum over the frames first, the bin sum is linear
+            self._g[start + lag] += self._reduce(np.einsum("tp,tp->p", future, past))
+            if t0 == n_old:
+                self._past[start + lag] += (
+                    new_sum
+                    + sums_ext[n_old - lag : n_old].sum(axis=0)
+                    - sums_ext[n_ext - lag :].sum(axis=0)
+                )
+                self._future[start + lag] += new_sum
+            else:
+                self._past[start + lag] += sums_ext[: n_ext - lag].sum(axis=0)
+                self._future[start + lag] += sums_ext[t0:].sum(axis=0)
+            self._counts[start + lag] += n_ext - t0
+
+        self._history[level] = frames_ext[max(0, n_ext - (m - 1)) :]
+        self._history_sums[level] = sums_ext[max(0, n_ext - (m - 1)) :]
+
+        # Every two frames of this level make one frame of the next level
+        if level + 1 < self.num_levels:
+            frames = np.concatenate([self._pending[level], frames])
+            n_pairs = len(frames) // 2
+            self._pending[level] = frames[2 * n_pairs :]
+            if n_pairs > 0:
+                binned = (frames[0 : 2 * n_pairs : 2] + frames[1 : 2 * n_pairs : 2]) / 2
+                self._update_level(level + 1, binned)
+
+    def update(self, frames: np.ndarray) -> None:
+        """
+        Adds a single (M, N) frame or a (k, M, N) block of frames. All
+        frames of a block are correlated in one vectorized step per lag.
+        """
+        frames = np.asarray(frames, dtype=np.float32).reshape(
+            (-1,) + self.frame_shape
+        )
+        frames = frames.reshape(len(frames), -1)
+        # Sub-blocks keep the float32 sums over the frames accurate
+        for start in range(0, len(frames), self.max_block):
+            block = frames[start : start + self.max_block]
+            if self._pixels is not None:
+                # np.take is much faster than fancy indexing along axis 1
+                block = np.take(block, self._pixels, axis=1)
+            self._update_level(0, block)
+        self.n_frames += len(frames)
+
+    def g2(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the correlation function of the frames added so far.
+
+        Returns
+        -------
+        (lags, g2) : tuple
+            lags : np.ndarray
+                Lag times in frames of the lags with at least one frame pair.
+            g2 : np.ndarray
+                (lags, Q) g2 of each q-bin, or (lags, M, N) g2 of each pixel
+                if no labels were given.
+        """
+        valid = self._counts > 0
+        counts = self._counts[valid, None]
+        sizes = self._bin_sizes[None, :]
+        g = self._g[valid] / counts / sizes
+        past = self._past[valid] / counts / sizes
+        future = self._future[valid] / counts / sizes
+        with np.errstate(divide="ignore", invalid="ignore"):
+            g2 = g / (past * future)
+        if self._pixels is None:
+            g2 = g2.reshape((-1,) + self.frame_shape)
+        return self.lags[valid], g2
+
+
+def multi_tau_g2(
+    source,
+    *,
+    dataset_path: str = None,
+    labels: np.ndarray = None,
+    roi: list = None,
+    num_levels: int = None,
+    num_bufs: int = 8,
+    max_memory_mb: float = 512.0,
+    verbose: bool = False,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates the multi-tau intensity autocorrelation g2(q, tau) of an image
+    stack, reading the frames from the HDF5 file block by block.
+
+    Parameters
+    ----------
+    source : str or np.ndarray
+        Whole path of an .h5 file (Nexus or broken bluesky file) or an
+        in-memory (F, M, N) image stack (e.g., from import_broken_h5).
+    dataset_path : str
+        Path of the image stack within the file. By default the Nexus
+        detector data, or "entry/data/data" if there is none.
+    labels : np.ndarray
+        Array of q-bin (or ROI) numbers 1 ... Q for every pixel of the ROI,
+        pixels labelled 0 are ignored. None computes the g2 of every pixel.
+    roi : list
+        Region of interest in the format [start_row, end_row, start_col,
+        end_col]. None uses the whole frames.
+    num_levels : int
+        Number of levels of the correlator. By default the longest lag is
+        about the length of the measurement.
+    num_bufs : int
+        Number of buffered frames per level (even).
+    max_memory_mb : float
+        Memory budget in MB for the block of frames read at once.
+    verbose : bool
+        Prints the number of frames and levels.
+
+    Returns
+    -------
+    (lags, g2) : tuple
+        lags : np.ndarray
+            Lag times in frames.
+        g2 : np.ndarray
+            (lags, Q) g2 of each q-bin, or (lags, M, N) g2 of each pixel if
+            no labels are given.
+    """
+    with _open_stack(source, dataset_path) as stack:
+        n_frames = int(np.prod(stack.shape[:-2]))
+        if roi is None:
+            roi = [0, stack.shape[-2], 0, stack.shape[-1]]
+        frame_shape = (roi[1] - roi[0], roi[3] - roi[2])
+        if num_levels is None:
+            num_levels = max(1, int(np.ceil(np.log2(max(n_frames / num_bufs, 1)))) + 1)
+        if verbose:
+            print(f"{n_frames} frames, {num_levels} levels of {num_bufs} buffers")
+
+        correlator = MultiTauCorrelator(
+            frame_shape, labels=labels, num_levels=num_levels, num_bufs=num_bufs
+        )
+        block_frames = frames_per_block(frame_shape, max_memory_mb=max_memory_mb)
+        for block in iter_frame_blocks(stack, roi=roi, block_frames=block_frames):
+            correlator.update(block)
+
+    return correlator.g2()
+
+
+def _panel_layout(
+    n_frames: int, frame_pixels: int, n_pixels: int, tile_frames: int, max_memory_mb: float
+) -> tuple:
+    # Numbers of frames of the panel and of the tiles of two_time_correlation
+    # within the memory budget. A frame of the panel or a tile takes 4 bytes
+    # per labelled pixel and, while it is read, 4 bytes per pixel of the ROI,
+    # a (panel x tile) product 4 bytes (float32) plus 8 bytes for the means.
+    # If the budget does not hold a panel as large as a tile, the tiles are
+    # shrunk until it does.
+    budget = max_memory_mb * 2**20
+    frame_bytes = 4 * (frame_pixels + n_pixels)
+    tile_frames = min(tile_frames, n_frames)
+    panel_frames = int((budget - frame_bytes * tile_frames) // (frame_bytes + 12 * tile_frames))
+    if panel_frames < tile_frames:
+        # Largest tile with 12 T^2 + 2 frame_bytes T <= budget
+        tile_frames = int((np.sqrt(frame_bytes**2 + 12 * budget) - frame_bytes) // 12)
+        if tile_frames < 1:
+            raise ValueError(
+                f"max_memory_mb={max_memory_mb} is too small for frames of {n_pixels} pixels"
+            )
+        panel_frames = int((budget - frame_bytes * tile_frames) // (frame_bytes + 12 * tile_frames))
+    return min(n_frames, panel_frames), tile_frames
+
+
+def two_time_correlation(
+    source,
+    outputfilename: str = "",
+    *,
+    dataset_path: str = None,
+    labels: np.ndarray = None,
+    roi: list = None,
+    tile_frames: int = 256,
+    max_memory_mb: float = 512.0,
+    verbose: bool = False,
+) -> str:
+    """
+    Calculates the two-time correlation
+    C(q, t1, t2) = <I(t1) I(t2)> / (<I(t1)> <I(t2)>),
+    where <> averages over the pixels of the q-bin (or ROI), without holding
+    the image stack or the F x F matrices in memory.
+
+    The frames are read in tiles. A panel of as many frames as the memory
+    budget allows is held in memory, and the tiles up to the end of the
+    panel are streamed past it. Each panel-tile product of the flattened
+    pixels of a bin is a single matrix multiplication (BLAS). The symmetric
+    result is written to a chunked dataset "two_time" of shape (Q, F, F).
+
+    Parameters
+    ----------
+    source : str or np.ndarray
+        Whole path of an .h5 file (Nexus or broken bluesky file) or an
+        (F, M, N) image stack.
+    outputfilename : str
+        Whole path of the .h5 file the result is written to. By default
+        "_two_time.h5" replaces the ".h5" ending of the source file.
+    dataset_path : str
+        Path of the image stack within the file. By default the Nexus
+        detector data, or "entry/data/data" if there is none.
+    labels : np.ndarray
+        Array of q-bin (or ROI) numbers 1 ... Q for every pixel of the ROI,
+        pixels labelled 0 are ignored. None uses all pixels as one bin.
+    roi : list
+        Region of interest in the format [start_row, end_row, start_col,
+        end_col]. None uses the whole frames.
+    tile_frames : int
+        Number of frames of the tiles streamed past a panel, which is also
+        the chunk size of the output dataset. Smaller tiles are used if the
+        memory budget cannot hold a panel of tile_frames frames.
+    max_memory_mb : float
+        Memory budget in MB for the panel, the tile and the products,
+        including the frames while they are read.
+    verbose : bool
+        Prints the panel size and the number of frames read.
+
+    Returns
+    -------
+    outputfilename : str
+        Whole path of the written file.
+    """
+    if outputfilename == "":
+        if not isinstance(source, str):
+            raise ValueError("outputfilename is needed for an in-memory stack")
+        outputfilename = source.replace(".h5", "_two_time.h5")
+
+    with _open_stack(source, dataset_path) as stack:
+        n_frames = int(np.prod(stack.shape[:-2]))
+        if roi is None:
+            roi = [0, stack.shape[-2], 0, stack.shape[-1]]
+        frame_shape = (roi[1] - roi[0], roi[3] - roi[2])
+        if labels is None:
+            labels = np.ones(frame_shape, dtype=int)
+        pixels, bins, starts, sizes = _sort_labels(labels, frame_shape)
+        stops = starts + sizes
+        n_pixels = len(pixels)
+
+        panel_frames, tile_frames = _panel_layout(
+            n_frames, int(np.prod(frame_shape)), n_pixels, tile_frames, max_memory_mb
+        )
+        if verbose:
+            print(f"{n_frames} frames, panels of {panel_frames} and tiles of {tile_frames} frames")
+
+        def read(start, stop):
+            # Reads the labelled pixels of frames start ... stop - 1, sorted
+            # by bin
+            blocks = iter_frame_blocks(
+                stack, roi=roi, start=start, stop=stop, block_frames=stop - start
+            )
+            block = next(blocks).reshape(stop - start, -1)
+            return np.take(block, pixels, axis=1)
+
+        # Mean intensity of each bin in each frame
+        means = np.zeros((len(bins), n_frames))
+        n_read = 0
+
+        with h5py.File(outputfilename, "w") as f:
+            two_time = f.create_dataset(
+                "two_time",
+                shape=(len(bins), n_frames, n_frames),
+                dtype=np.float32,
+                chunks=(1, tile_frames, tile_frames),
+            )
+            two_time.attrs["bins"] = bins
+            two_time.attrs["roi"] = roi
+
+            for p0 in range(0, n_frames, panel_frames):
+                p1 = min(p0 + panel_frames, n_frames)
+                panel = read(p0, p1)
+                n_read += p1 - p0
+                for k in range(len(bins)):
+                    means[k, p0:p1] = panel[:, starts[k] : stops[k]].mean(axis=1)
+
+                # Tiles up to the end of the panel (the rest follows from
+                # the symmetry)
+                for t0 in range(0, p1, tile_frames):
+                    t1 = min(t0 + tile_frames, p1)
+                    if t0 >= p0:
+                        tile = panel[t0 - p0 : t1 - p0]
+                    else:
+                        tile = read(t0, t1)
+                        n_read += t1 - t0
+                    for k in range(len(bins)):
+                        bin_pixels = slice(starts[k], stops[k])
+                        products = panel[:, bin_pixels] @ tile[:, bin_pixels].T
+                        products /= sizes[k]
+                        products /= np.outer(means[k, p0:p1], means[k, t0:t1])
+                        two_time[k, p0:p1, t0:t1] = products
+                        two_time[k, t0:t1, p0:p1] = products.T
+
+        if verbose:
+            print(f"{n_read} frames read for {n_frames} frames")
+
+    return outputfilename
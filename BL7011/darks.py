@@ -0,0 +1,373 @@
+"""
+    This file contains functions to build master dark (background) frames
+    from designated dark files and a library to look them up by the exposure
+    time (count_time), the detector temperature and the date of a measurement.
+
+    A library is a single HDF5 file with one dataset per master dark in the
+    group "darks". The count_time (in ms, as in the Nexus files), temperature
+    (in K, NaN if unknown), date ("YYYY-MM-DD"), number of averaged frames and
+    source files of a master are stored as attributes of its dataset.
+
+    The masters read from a library are held in an in-memory LRU cache, so
+    that all files (and frames) measured with the same settings reuse a single
+    array instead of reading it again.
+
+    Authors: Damian Günzing
+"""
+import datetime
+import os
+from functools import lru_cache
+
+import h5py
+import numpy as np
+import pandas as pd
+from BL7011 import instrumentation as ins
+from BL7011.tools import frames_per_block
+
+NEXUS_DATASET = "entry1/instrument_1/detector_1/data"
+BLUESKY_DATASET = "entry/data/data"
+
+# Offset of the EPICS epoch (1990-01-01) to the unix epoch in seconds
+EPICS_EPOCH = 631152000
+
+# Number of master darks held in memory
+CACHE_SIZE = 8
+
+
+def read_dark_metadata(path_file: str) -> dict:
+    """
+    Reads the exposure time, detector temperature and date of a Nexus or a
+    broken bluesky .h5 file, as used to look up its master dark.
+
+    Parameters
+    ----------
+    path_file : str
+        Whole path of the .h5 file.
+
+    Returns
+    -------
+    metadata : dict
+        "count_time" in ms, "temperature" in K and "date" as "YYYY-MM-DD".
+        Entries not recorded in the file are NaN (count_time, temperature)
+        or "" (date). Broken bluesky files hold no exposure time, it is
+        recorded in the .json file instead.
+    """
+    metadata = {"count_time": np.nan, "temperature": np.nan, "date": ""}
+    with h5py.File(path_file, "r") as f:
+        if NEXUS_DATASET in f:
+            detector = f["entry1/instrument_1/detector_1"]
+            metadata["count_time"] = float(detector["count_time"][()])
+            if "temperature" in detector:
+                metadata["temperature"] = float(np.mean(detector["temperature"][()]))
+            if "entry1/start_time" in f:
+                metadata["date"] = f["entry1/start_time"].asstr()[()][:10]
+        elif "entry/instrument/NDAttributes/NDArrayEpicsTSSec" in f:
+            seconds = f["entry/instrument/NDAttributes/NDArrayEpicsTSSec"][0]
+            metadata["date"] = datetime.datetime.fromtimestamp(
+                int(seconds) + EPICS_EPOCH, tz=datetime.timezone.utc
+            ).strftime("%Y-%m-%d")
+    return metadata
+
+
+def build_master_dark(path_files: str | list, max_memory_mb: float = 512.0) -> tuple:
+    """
+    Averages all frames of one or more dark files into a master dark. The
+    frames are read in blocks, so that the files do not have to fit into
+    memory.
+
+    Parameters
+    ----------
+    path_files : str or list
+        Whole path(s) of the Nexus or broken bluesky .h5 dark files.
+    max_memory_mb : float
+        Memory budget in MB for a block of frames.
+
+    Returns
+    -------
+    master : np.ndarray
+        The (M, N) mean of all frames.
+    n_frames : int
+        Number of averaged frames.
+    """
+    if isinstance(path_files, str):
+        path_files = [path_files]
+
+    total, n_frames = None, 0
+    for path_file in path_files:
+        with ins.stage("darks.open"):
+            f = h5py.File(path_file, "r")
+        with f:
+            data = f[NEXUS_DATASET] if NEXUS_DATASET in f else f[BLUESKY_DATASET]
+            # Nexus stacks (images, exposures, M, N) are averaged over both
+            frames = data.shape[0] * int(np.prod(data.shape[1:-2]))
+            if total is None:
+                total = np.zeros(data.shape[-2:])
+            elif total.shape != data.shape[-2:]:
+                raise ValueError(
+                    f"The frames of {path_file} have the shape {data.shape[-2:]}, "
+                    f"the dark frames before have the shape {total.shape}"
+                )
+            block = frames_per_block(
+                data.shape[-2:], itemsize=8, n_arrays=2, max_memory_mb=max_memory_mb
+            )
+            # Nexus files are read by whole images (all exposures at once)
+            block = max(1, block * data.shape[0] // frames)
+            for start in range(0, data.shape[0], block):
+                with ins.stage("darks.read"):
+                    frames_block = data[start : start + block]
+                    ins.add_bytes("darks.read", read=frames_block.nbytes)
+                with ins.stage("darks.average"):
+                    frames_block = frames_block.reshape((-1,) + total.shape)
+                    total += frames_block.sum(axis=0, dtype=float)
+            n_frames += frames
+
+    if n_frames == 0:
+        raise ValueError("No dark frames were found")
+    return total / n_frames, n_frames
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _read_master(path_library: str, name: str, mtime_ns: int) -> np.ndarray:
+    # Reads a master dark of a library. The modification time is part of the
+    # key, so that masters of a rewritten library are not taken from the cache
+    with ins.stage("darks.read_master"), h5py.File(path_library, "r") as f:
+        master = f["darks"][name][()]
+        ins.add_bytes("darks.read_master", read=master.nbytes)
+    # The cached array is shared by all callers
+    master.flags.writeable = False
+    return master
+
+
+def clear_cache() -> None:
+    """
+    Empties the in-memory cache of master darks.
+    """
+    _read_master.cache_clear()
+
+
+class DarkLibrary:
+    """
+    Library of master darks stored in an .h5 file, indexed by count_time,
+    temperature and date.
+
+    Parameters
+    ----------
+    path_library : str
+        Whole path of the library .h5 file. It is created by the first add().
+    """
+
+    def __init__(self, path_library: str):
+        self.path_library = os.path.abspath(path_library)
+
+    def __repr__(self):
+        return f"DarkLibrary({self.path_library!r})"
+
+    def add(
+        self,
+        path_files: str | list,
+        *,
+        name: str = None,
+        count_time: float = None,
+        temperature: float = None,
+        date: str = None,
+        max_memory_mb: float = 512.0,
+    ) -> str:
+        """
+        Builds a master dark from dark files and stores it in the library.
+
+        Parameters
+        ----------
+        path_files : str or list
+            Whole path(s) of the Nexus or broken bluesky .h5 dark files, all
+            taken with the same settings.
+        name : str
+            Name of the master within the library, "dark_<n>" by default. An
+            existing master of the same name is replaced.
+        count_time, temperature, date :
+            Exposure time in ms, detector temperature in K and date as
+            "YYYY-MM-DD" of the darks. By default they are read from the
+            first file (see read_dark_metadata). The count_time has to be
+            given for broken bluesky files.
+        max_memory_mb : float
+            Memory budget in MB for a block of frames.
+
+        Returns
+        -------
+        name : str
+            Name of the stored master.
+        """
+        if isinstance(path_files, str):
+            path_files = [path_files]
+        metadata = read_dark_metadata(path_files[0])
+        for key, value in (
+            ("count_time", count_time),
+            ("temperature", temperature),
+            ("date", date),
+        ):
+            if value is not None:
+                metadata[key] = value
+        if np.isnan(metadata["count_time"]):
+            raise ValueError(
+                f"{path_files[0]} holds no count_time, it has to be given for the darks"
+            )
+
+        master, n_frames = build_master_dark(path_files, max_memory_mb=max_memory_mb)
+
+        with ins.stage("darks.write", written=master.nbytes), h5py.File(
+            self.path_library, "a"
+        ) as f:
+            darks = f.require_group("darks")
+            if name is None:
+                name = f"dark_{len(darks)}"
+            if name in darks:
+                del darks[name]
+            dataset = darks.create_dataset(name, data=master)
+            dataset.attrs["count_time"] = float(metadata["count_time"])
+            dataset.attrs["temperature"] = float(metadata["temperature"])
+            dataset.attrs["date"] = metadata["date"]
+            dataset.attrs["n_frames"] = n_frames
+            dataset.attrs["sources"] = [os.path.basename(path) for path in path_files]
+        return name
+
+    def index(self) -> pd.DataFrame:
+        """
+        Lists the master darks of the library.
+
+        Returns
+        -------
+        index : pd.DataFrame
+            One row per master with its "name", "count_time", "temperature",
+            "date" and "n_frames".
+        """
+        columns = ["name", "count_time", "temperature", "date", "n_frames"]
+        if not os.path.exists(self.path_library):
+            return pd.DataFrame(columns=columns)
+        with h5py.File(self.path_library, "r") as f:
+            darks = f.get("darks", {})
+            rows = [
+                [name]
+                + [darks[name].attrs[key] for key in columns[1:]]
+                for name in darks
+            ]
+        return pd.DataFrame(rows, columns=columns)
+
+    def lookup(
+        self,
+        count_time: float,
+        temperature: float = np.nan,
+        date: str = "",
+        temperature_tolerance: float = 2.0,
+    ) -> str:
+        """
+        Finds the master dark that fits a measurement best: the count_time
+        has to match, among those the master with the closest temperature
+        (within the tolerance) and then the closest date is taken.
+
+        Parameters
+        ----------
+        count_time : float
+            Exposure time in ms.
+        temperature : float
+            Detector temperature in K. NaN ignores the temperature.
+        date : str
+            Date as "YYYY-MM-DD". "" ignores the date.
+        temperature_tolerance : float
+            Largest temperature difference in K of a usable master. Masters
+            of unknown temperature are always usable.
+
+        Returns
+        -------
+        name : str
+            Name of the master.
+        """
+        index = self.index()
+        index = index[np.isclose(index["count_time"].astype(float), count_time)]
+        if not np.isnan(temperature):
+            difference = np.abs(index["temperature"].astype(float) - temperature)
+            index = index.assign(temperature_difference=difference.fillna(0))
+            index = index[index["temperature_difference"] <= temperature_tolerance]
+        else:
+            index = index.assign(temperature_difference=0.0)
+        if len(index) == 0:
+            raise KeyError(
+                f"No master dark for count_time={count_time} and "
+                f"temperature={temperature} in {self.path_library}"
+            )
+        if date:
+            days = [
+                abs((pd.Timestamp(date) - pd.Timestamp(d)).days) if d else np.inf
+                for d in index["date"]
+            ]
+            index = index.assign(days=days)
+        else:
+            index = index.assign(days=0)
+        best = index.sort_values(["temperature_difference", "days"], kind="stable")
+        return best["name"].iloc[0]
+
+    def master(self, name: str) -> np.ndarray:
+        """
+        Returns a master dark (read only), read from the in-memory cache if
+        it has been used before.
+
+        Parameters
+        ----------
+        name : str
+            Name of the master.
+
+        Returns
+        -------
+        master : np.ndarray
+            The (M, N) master dark.
+        """
+        mtime_ns = os.stat(self.path_library).st_mtime_ns
+        return _read_master(self.path_library, name, mtime_ns)
+
+    def master_for(self, path_file: str, **metadata) -> np.ndarray:
+        """
+        Returns the master dark that fits a measurement file.
+
+        Parameters
+        ----------
+        path_file : str
+            Whole path of the Nexus or broken bluesky .h5 file.
+        **metadata :
+            count_time, temperature or date replacing the ones read from the
+            file (see read_dark_metadata), and temperature_tolerance.
+
+        Returns
+        -------
+        master : np.ndarray
+            The (M, N) master dark.
+        """
+        tolerance = metadata.pop("temperature_tolerance", 2.0)
+        file_metadata = read_dark_metadata(path_file)
+        file_metadata.update(metadata)
+        if np.isnan(file_metadata["count_time"]):
+            raise ValueError(
+                f"{path_file} holds no count_time, it has to be given to find its dark"
+            )
+        return self.master(self.lookup(**file_metadata, temperature_tolerance=tolerance))
+
+
+def resolve_dark(dark, path_file: str, **metadata) -> np.ndarray:
+    """
+    Returns the dark frame to subtract from the frames of a file.
+
+    Parameters
+    ----------
+    dark : None, np.ndarray or DarkLibrary
+        No dark, a (M, N) dark frame or a library the master dark is looked
+        up in.
+    path_file : str
+        Whole path of the measurement file.
+    **metadata :
+        Passed to DarkLibrary.master_for.
+
+    Returns
+    -------
+    dark : None or np.ndarray
+        The (M, N) dark frame.
+    """
+    if isinstance(dark, DarkLibrary):
+        return dark.master_for(path_file, **metadata)
+    return dark
@@ -4,14 +4,36 @@
 
     Stuff to add at some point:
     - Q conversion
-    - Peak finding function
-    - Peak broadening function
     - Consider making some kind of class out of calculate_dichroism
 
     Authors: Dayne Sasaki
 """
+import time
 import numpy as np
 from BL7011 import file_processing as fp
+from BL7011 import instrumentation as ins
+from BL7011.tools import bin_frames, frames_per_block
+
+# Data type of the peak table returned by find_peaks
+PEAK_DTYPE = np.dtype([('frame', np.int32),
+                       ('row', np.int32),
+                       ('col', np.int32),
+                       ('intensity', np.float32)])
+
+# Parameters of the peak profiles fitted by fit_peaks (in this order)
+PROFILE_PARAMETERS = ('amplitude', 'center_row', 'center_col', 'fwhm_row',
+                      'fwhm_col', 'background', 'eta')
+
+# Data type of the table returned by fit_peaks
+FIT_DTYPE = np.dtype([('frame', np.int32), ('row', np.int32), ('col', np.int32)]
+                     + [(name, np.float64) for name in PROFILE_PARAMETERS]
+                     + [('err_' + name, np.float64)
+                        for name in PROFILE_PARAMETERS]
+                     + [('chi2', np.float64), ('converged', np.bool_),
+                        ('iterations', np.int32)])
+
+# Methods of reduce_stack to average an image stack
+REDUCERS = ('mean', 'median', 'sigma_clip')
 
 
 def calculate_dichroism(
@@ -42,9 +64,9 @@ def calculate_dichroism(
     np.ndarray of the calculated dichroism image
     """
     image_dichroism = image_pol_a - image_pol_b
-    if mode is 'difference':
+    if mode == 'difference':
         return image_dichroism
-    elif mode is 'asymmetry':
+    elif mode == 'asymmetry':
         return image_dichroism / (image_pol_a + image_pol_b)
     else:
         raise ValueError(
@@ -52,12 +74,187 @@ def calculate_dichroism(
             'specified')
 
 
+def summed_area_table(image_stack: np.ndarray) -> np.ndarray:
+    """
+    Calculates the summed-area tables (integral images) of an image stack.
+
+    PARAMETERS
+    -----
+    image_stack: np.ndarray
+        A F x M x N image stack
+
+    RETURNS
+    -----
+    np.ndarray
+        F x (M + 1) x (N + 1) array, where entry [f, i, j] is the sum of
+        image_stack[f, :i, :j]. The first row and column are zero.
+    """
+    table = np.zeros((image_stack.shape[0], image_stack.shape[1] + 1,
+                      image_stack.shape[2] + 1))
+    np.cumsum(image_stack, axis=1, out=table[:, 1:, 1:])
+    np.cumsum(table[:, 1:, 1:], axis=2, out=table[:, 1:, 1:])
+    return table
+
+
+def roi_sums(table: np.ndarray, rois: np.ndarray) -> np.ndarray:
+    """
+    Calculates the integrated intensity within several rectangular regions
+    of interest from the summed-area tables of an image stack
+
+    PARAMETERS
+    -----
+    table: np.ndarray
+        F x (M + 1) x (N + 1) summed-area tables from summed_area_table
+    rois: np.ndarray
+        R x 4 array of regions of interest, each in the format
+        [start_row, end_row, start_col, end_col]
+
+    RETURNS
+    -----
+    np.ndarray
+        F x R array of the summed intensity within each ROI
+    """
+    rois = np.atleast_2d(rois)
+    r0, r1, c0, c1 = rois[:, 0], rois[:, 1], rois[:, 2], rois[:, 3]
+    return table[:, r1, c1] - table[:, r0, c1] - table[:, r1, c0] \
+        + table[:, r0, c0]
+
+
+def _read_block(stack, index: int | None, frames: slice,
+                rows: slice = slice(None), binning: int = 1) -> np.ndarray:
+    # Reads a block of frames (and rows) of a F x M x N stack, or of the
+    # image "index" of a v x F x M x N Nexus stack, binned as float
+    key = (frames, rows) if index is None else (index, frames, rows)
+    with ins.stage('data_processing.read'):
+        block = stack[key]
+        ins.add_bytes('data_processing.read', read=block.nbytes)
+    return bin_frames(block, binning)
+
+
+def reduce_stack(
+        stack,
+        method: str = 'mean',
+        *,
+        index: int = None,
+        sigma: float = 3.0,
+        max_memory_mb: float = 512.0,
+        binning: int = 1
+) -> np.ndarray:
+    """
+    Reduces an image stack to a single image with a plain or a robust
+    (cosmic-ray and hot pixel rejecting) average. The stack is read in
+    blocks, so that it can stay in the HDF5 file.
+
+    PARAMETERS
+    -----
+    stack: np.ndarray or h5py.Dataset
+        A F x M x N image stack, or a v x F x M x N Nexus stack together
+        with "index"
+
+    method: str
+        - 'mean': Plain mean of all frames
+        - 'median': Median of all frames, calculated on tiles of rows that
+                    hold all frames of their pixels
+        - 'sigma_clip': Mean of the frames within sigma standard deviations
+                        of the mean of each pixel. The mean and standard
+                        deviation are running moments of a first pass over
+                        blocks of frames, the clipped mean is accumulated in
+                        a second pass.
+
+    index: int
+        Index of the image within a v x F x M x N Nexus stack whose F
+        exposures are reduced
+
+    sigma: float
+        Clipping threshold of 'sigma_clip' in standard deviations
+
+    max_memory_mb: float
+        Memory budget in MB for the blocks (tiles) read at once
+
+    binning: int
+        Sums blocks of binning x binning pixels of every block right after
+        it is read (see BL7011.tools.bin_frames)
+
+    RETURNS
+    -----
+    np.ndarray
+        The M x N (M/binning x N/binning) reduced image
+    """
+    if method not in REDUCERS:
+        raise ValueError(f'Unknown reducer {method}, use one of {REDUCERS}')
+
+    n_frames = stack.shape[-3]
+    frame_shape = (stack.shape[-2] // binning, stack.shape[-1] // binning)
+
+    if method == 'median':
+        # Tiles of (binned) rows holding all frames, and the copy np.median
+        # sorts
+        bytes_per_row = n_frames * frame_shape[1] * 8 * 2
+        rows = max(1, int(max_memory_mb * 2**20) // bytes_per_row)
+        image = np.empty(frame_shape)
+        for r0 in range(0, frame_shape[0], rows):
+            r1 = min(r0 + rows, frame_shape[0])
+            tile = _read_block(stack, index, slice(None),
+                               slice(r0 * binning, r1 * binning), binning)
+            with ins.stage('data_processing.median'):
+                image[r0:r1] = np.median(tile, axis=0)
+        return image
+
+    # Blocks of frames next to the working arrays of the same size. Binned
+    # blocks are dominated by the full resolution frames read.
+    block = frames_per_block(stack.shape[-2:], itemsize=8,
+                             n_arrays=3 if binning == 1 else 2,
+                             max_memory_mb=max_memory_mb)
+
+    # First pass: running mean and sum of squared deviations (M2), merging
+    # the moments of the blocks (Chan et al.)
+    count, mean, m2 = 0, np.zeros(frame_shape), np.zeros(frame_shape)
+    for f0 in range(0, n_frames, block):
+        frames = _read_block(stack, index, slice(f0, f0 + block),
+                             binning=binning)
+        with ins.stage('data_processing.moments'):
+            n_block = len(frames)
+            mean_block = frames.mean(axis=0)
+            m2_block = ((frames - mean_block) ** 2).sum(axis=0)
+            delta = mean_block - mean
+            total = count + n_block
+            mean += delta * n_block / total
+            m2 += m2_block + delta ** 2 * count * n_block / total
+            count = total
+
+    if method == 'mean':
+        return mean
+
+    # Second pass: mean of the frames within the clipping range
+    std = np.sqrt(m2 / count)
+    lower, upper = mean - sigma * std, mean + sigma * std
+    clipped_sum = np.zeros(frame_shape)
+    clipped_count = np.zeros(frame_shape)
+    for f0 in range(0, n_frames, block):
+        frames = _read_block(stack, index, slice(f0, f0 + block),
+                             binning=binning)
+        with ins.stage('data_processing.sigma_clip'):
+            keep = (frames >= lower) & (frames <= upper)
+            clipped_sum += np.where(keep, frames, 0).sum(axis=0)
+            clipped_count += keep.sum(axis=0)
+
+    # Pixels without any frame within the range keep the plain mean
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(clipped_count > 0, clipped_sum / clipped_count, mean)
+
+
 def calculate_dichroism_from_file(file_pol_a: str,
                                   file_pol_b: str,
                                   *,
                                   mode: str = 'difference',
                                   correction: str = '',
-                                  variable_stack: bool = False
+                                  variable_stack: bool = False,
+                                  dark=None,
+                                  reducer: str = 'mean',
+                                  sigma: float = 3.0,
+                                  max_memory_mb: float = 512.0,
+                                  register: bool = False,
+                                  binning: int = 1
 ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Calculates a dichroism image using two opposite polarization images loaded
@@ -84,6 +281,28 @@ def calculate_dichroism_from_file(file_pol_a: str,
         Setting this to False will make the function calculate an average
         of an image stack (i.e., each frame in the stack represents multiple
         "redundant" camera exposure and do not have any parameters varying)
+    dark: np.ndarray or BL7011.darks.DarkLibrary
+        Dark frame subtracted from the images of both files, or a library
+        of master darks in which the dark of each file is looked up
+        (see fp.load_h5_image)
+    reducer: str
+        How the image stack is averaged if variable_stack is False
+        - 'mean': Plain mean of the loaded stack
+        - 'median', 'sigma_clip': Cosmic-ray and hot pixel rejecting
+                averages, calculated in blocks (see reduce_stack)
+    sigma: float
+        Clipping threshold of 'sigma_clip' in standard deviations
+    max_memory_mb: float
+        Memory budget in MB for the blocks of 'median', 'sigma_clip' and
+        register
+    register: bool
+        Corrects the drift between the exposures before averaging them
+        (only with the 'mean' reducer and variable_stack False). The
+        exposures of both files are aligned with the first exposure of
+        file_pol_a (see fp.load_h5_registered_image).
+    binning: int
+        Sums blocks of binning x binning pixels while the images are read,
+        e.g., 2 or 4 for fast survey runs (see fp.load_h5_image)
 
 
     Returns a tuple containing...
@@ -94,18 +313,485 @@ def calculate_dichroism_from_file(file_pol_a: str,
         The first polarization image
     im_pol_b: np.ndarray
         The second polarization image
+    shifts: np.ndarray
+        Only if register is True: 2 x exposures x 2 shift trajectories
+        (rows, columns) of the exposures of both files in pixels
     """
+    # Averages of the exposures aligned with the first exposure of pol_a
+    if register:
+        if variable_stack or reducer != 'mean':
+            raise ValueError('register needs variable_stack=False and the '
+                             'mean reducer')
+        (im_pol_a, shifts_a), (im_pol_b, shifts_b) = (
+            fp.load_h5_registered_image(path_file, correction, dark,
+                                        reference_file=file_pol_a,
+                                        max_memory_mb=max_memory_mb,
+                                        binning=binning)
+            for path_file in (file_pol_a, file_pol_b))
+        with ins.stage('data_processing.dichroism'):
+            im_dichro = calculate_dichroism(im_pol_a, im_pol_b, mode=mode)
+        return im_dichro, im_pol_a, im_pol_b, np.stack([shifts_a, shifts_b])
+
+    # Robust averages are calculated in blocks from the files
+    if not variable_stack and reducer != 'mean':
+        im_pol_a, im_pol_b = (
+            fp.load_h5_reduced_image(path_file, correction, dark,
+                                     reducer=reducer, sigma=sigma,
+                                     max_memory_mb=max_memory_mb,
+                                     binning=binning)
+            for path_file in (file_pol_a, file_pol_b))
+        with ins.stage('data_processing.dichroism'):
+            im_dichro = calculate_dichroism(im_pol_a, im_pol_b, mode=mode)
+        return im_dichro, im_pol_a, im_pol_b
+
     # Load the two polarization images
-    im_pol_a = fp.load_h5_image(file_pol_a, correction)
-    im_pol_b = fp.load_h5_image(file_pol_b, correction)
+    im_pol_a = fp.load_h5_image(file_pol_a, correction, dark=dark,
+                                binning=binning)
+    im_pol_b = fp.load_h5_image(file_pol_b, correction, dark=dark,
+                                binning=binning)
 
     # If the user sets variable_stack = False, then average the
     # entire image stack to a single image
     if not variable_stack:
-        im_pol_a = np.average(im_pol_a, axis=0)
-        im_pol_b = np.average(im_pol_b, axis=0)
+        with ins.stage('data_processing.average'):
+            im_pol_a = np.average(im_pol_a, axis=0)
+            im_pol_b = np.average(im_pol_b, axis=0)
 
     # Calculate dichroism
-    im_dichro = calculate_dichroism(im_pol_a, im_pol_b, mode=mode)
+    with ins.stage('data_processing.dichroism'):
+        im_dichro = calculate_dichroism(im_pol_a, im_pol_b, mode=mode)
+
+    return im_dichro, im_pol_a, im_pol_b
+
+
+@ins.timed('data_processing.find_peaks')
+def find_peaks(
+        image_stack,
+        *,
+        sigma: float = 1.0,
+        size: int = 5,
+        threshold: float = None,
+        threshold_rel: float = 0.5,
+        max_memory_mb: float = 512.0
+) -> np.ndarray:
+    """
+    Finds the local intensity maxima (peaks) in every frame of an image stack.
+
+    The stack is processed in blocks of frames. Each block is smoothed with a
+    Gaussian filter and compared against a maximum filter of the same block,
+    so that all frames of a block are handled by a single scipy.ndimage call
+    instead of a Python loop over frames. The number of frames per block is
+    chosen such that the working arrays stay within max_memory_mb.
+
+    PARAMETERS
+    -----
+    image_stack: np.ndarray or h5py.Dataset
+        A F x M x N image stack. An h5py dataset (e.g.,
+        h5_file['entry']['data']['data']) can be passed directly, in which
+        case only one block of frames is read from the file at a time.
+    sigma: float
+        Standard deviation (in pixels) of the Gaussian smoothing applied to
+        each frame before searching for maxima. No smoothing is done for 0.
+    size: int
+        Edge length (in pixels) of the square neighbourhood a pixel has to be
+        the maximum of to count as a peak
+    threshold: float
+        Absolute intensity (of the smoothed frame) a peak has to exceed. If
+        given, threshold_rel is ignored.
+    threshold_rel: float
+        Intensity a peak has to exceed relative to the maximum of the smoothed
+        frame it sits in
+    max_memory_mb: float
+        Memory budget in MB for the working arrays of one block
+
+    RETURNS
+    -----
+    peaks: np.ndarray
+        Structured array (dtype PEAK_DTYPE) with the fields 'frame', 'row',
+        'col' and 'intensity' of every peak found. The intensity is the raw
+        pixel value at the peak position. Peaks are sorted by frame.
+    """
+    from scipy import ndimage
+
+    if image_stack.ndim != 3:
+        raise ValueError('image_stack has to be a F x M x N image stack')
+
+    n_frames = image_stack.shape[0]
+
+    # The input block, the smoothed block and the maximum filtered block are
+    # held in memory at the same time (all float32)
+    n_block = frames_per_block(image_stack.shape[1:], itemsize=4, n_arrays=3,
+                               max_memory_mb=max_memory_mb)
+
+    peak_list = []
+    for start in range(0, n_frames, n_block):
+        stop = min(start + n_block, n_frames)
+        block = np.asarray(image_stack[start:stop], dtype=np.float32)
+
+        # Smooth all frames of the block at once (no smoothing along frames)
+        if sigma > 0:
+            smoothed = ndimage.gaussian_filter(block, sigma=(0, sigma, sigma))
+        else:
+            smoothed = block
+
+        # A pixel is a local maximum if it equals the maximum of its
+        # neighbourhood within the same frame
+        local_max = ndimage.maximum_filter(smoothed, size=(1, size, size),
+                                           mode='nearest')
+        is_peak = smoothed == local_max
+        del local_max
+
+        # Only keep the maxima which are above the threshold
+        if threshold is not None:
+            is_peak &= smoothed > threshold
+        else:
+            frame_max = smoothed.max(axis=(1, 2), keepdims=True)
+            is_peak &= smoothed > threshold_rel * frame_max
+
+        frame, row, col = np.nonzero(is_peak)
+        block_peaks = np.empty(len(frame), dtype=PEAK_DTYPE)
+        block_peaks['frame'] = frame + start
+        block_peaks['row'] = row
+        block_peaks['col'] = col
+        block_peaks['intensity'] = block[frame, row, col]
+        peak_list.append(block_peaks)
+
+    if not peak_list:
+        return np.empty(0, dtype=PEAK_DTYPE)
+    return np.concatenate(peak_list)
+
+
+def _profile_and_jacobian(
+        params: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        profile: str
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Evaluates K two-dimensional pseudo-Voigt profiles and their analytic
+    Jacobians on the flattened window coordinates (rows, cols).
+
+    The profile is A * (eta * L + (1 - eta) * G) + B with
+        G = exp(-4 ln2 q),  L = 1 / (1 + 4 q),
+        q = ((r - r0) / w_r)^2 + ((c - c0) / w_c)^2
+    so that w_r and w_c are the full widths at half maximum. For the
+    'gaussian' and 'lorentzian' profile eta is fixed to 0 and 1 and its
+    column is left out of the Jacobian.
+
+    Returns the K x P model and the K x P x n_params Jacobian
+    """
+    amp, r0, c0, w_r, w_c, bg, eta = (params[:, [i]] for i in range(7))
+    u = (rows - r0) / w_r
+    v = (cols - c0) / w_c
+    q = u ** 2 + v ** 2
+
+    gauss = np.exp(-4 * np.log(2) * q)
+    lorentz = 1 / (1 + 4 * q)
+    shape = eta * lorentz + (1 - eta) * gauss
+    model = amp * shape + bg
+
+    # Derivative of the profile shape with respect to q
+    dshape_dq = -4 * eta * lorentz ** 2 - 4 * np.log(2) * (1 - eta) * gauss
+
+    columns = [shape,
+               amp * dshape_dq * (-2 * u / w_r),
+               amp * dshape_dq * (-2 * v / w_c),
+               amp * dshape_dq * (-2 * u ** 2 / w_r),
+               amp * dshape_dq * (-2 * v ** 2 / w_c),
+               np.ones_like(shape)]
+    if profile == 'pseudo-voigt':
+        columns.append(amp * (lorentz - gauss))
+
+    return model, np.stack(columns, axis=-1)
+
+
+def _initial_guess(windows: np.ndarray, eta: float) -> np.ndarray:
+    """
+    Estimates the profile parameters of K x W x W windows from the moments of
+    the background subtracted intensity
+    """
+    n_fits, size = windows.shape[0], windows.shape[1]
+    rows, cols = np.mgrid[:size, :size]
+
+    background = windows.min(axis=(1, 2))
+    signal = np.clip(windows - background[:, None, None], 0, None)
+    total = signal.sum(axis=(1, 2))
+    total[total == 0] = 1
+
+    center_row = (signal * rows).sum(axis=(1, 2)) / total
+    center_col = (signal * cols).sum(axis=(1, 2)) / total
+    var_row = (signal * (rows - center_row[:, None, None]) ** 2).sum(
+        axis=(1, 2)) / total
+    var_col = (signal * (cols - center_col[:, None, None]) ** 2).sum(
+        axis=(1, 2)) / total
+
+    params = np.empty((n_fits, 7))
+    params[:, 0] = windows.max(axis=(1, 2)) - background
+    params[:, 1] = center_row
+    params[:, 2] = center_col
+    # FWHM = 2 sqrt(2 ln2) sigma
+    params[:, 3] = np.clip(2.3548 * np.sqrt(var_row), 1, size)
+    params[:, 4] = np.clip(2.3548 * np.sqrt(var_col), 1, size)
+    params[:, 5] = background
+    params[:, 6] = eta
+    return params
+
+
+def _levenberg_marquardt(
+        windows: np.ndarray,
+        params: np.ndarray,
+        profile: str,
+        max_iter: int,
+        tol: float
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fits K windows at once with a Levenberg-Marquardt scheme. Residuals,
+    Jacobians and normal equations of all fits are computed in single
+    vectorized steps, every fit keeps its own damping factor and fits that
+    have converged are dropped from the active set.
+
+    Returns the fitted parameters, their standard errors, the reduced chi2,
+    whether the fit has converged and its number of iterations. Fits whose
+    damping grows beyond 1e10 without lowering the cost have stalled, they
+    are dropped from the active set but are not converged
+    """
+    n_fits, size = windows.shape[0], windows.shape[1]
+    n_params = 7 if profile == 'pseudo-voigt' else 6
+    rows, cols = np.mgrid[:size, :size]
+    rows, cols = rows.ravel()[None, :], cols.ravel()[None, :]
+    data = windows.reshape(n_fits, -1)
+
+    def cost_of(p, idx):
+        model, jac = _profile_and_jacobian(p, rows, cols, profile)
+        residual = model - data[idx]
+        return residual, jac, (residual ** 2).sum(axis=1)
+
+    params = params.copy()
+    damping = np.full(n_fits, 1e-3)
+    converged = np.zeros(n_fits, dtype=bool)
+    stalled = np.zeros(n_fits, dtype=bool)
+    iterations = np.zeros(n_fits, dtype=np.int32)
+    rounding = size ** 2 * np.finfo(float).eps ** 2 * (data ** 2).sum(axis=1)
+    residual, jac, cost = cost_of(params, np.arange(n_fits))
+
+    for _ in range(max_iter):
+        active = np.flatnonzero(~converged & ~stalled)
+        if len(active) == 0:
+            break
+        iterations[active] += 1
+
+        # Normal equations of all active fits
+        j_act, r_act = jac[active], residual[active]
+        jtj = np.einsum('kpi,kpj->kij', j_act, j_act)
+        grad = np.einsum('kpi,kp->ki', j_act, r_act)
+        diag = np.einsum('kii->ki', jtj)
+        lhs = jtj + (damping[active, None] * diag + 1e-12)[:, :, None] \
+            * np.eye(n_params)
+        step = np.linalg.solve(lhs, -grad[:, :, None])[:, :, 0]
+
+        # Keep the centres inside the window, the widths positive and eta
+        # within [0, 1]
+        trial = params[active].copy()
+        trial[:, :n_params] += step
+        trial[:, 1:3] = np.clip(trial[:, 1:3], -0.5, size - 0.5)
+        trial[:, 3:5] = np.clip(trial[:, 3:5], 0.1, 10 * size)
+        trial[:, 6] = np.clip(trial[:, 6], 0, 1)
+
+        trial_residual, trial_jac, trial_cost = cost_of(trial, active)
+
+        # Accept the steps which lowered the cost and adjust the damping
+        better = trial_cost < cost[active]
+        accepted = active[better]
+        rel_change = (cost[accepted] - trial_cost[better]) \
+            / np.maximum(cost[accepted], np.finfo(float).tiny)
+        params[accepted] = trial[better]
+        residual[accepted] = trial_residual[better]
+        jac[accepted] = trial_jac[better]
+        cost[accepted] = trial_cost[better]
+        damping[accepted] /= 3
+        damping[active[~better]] *= 3
+
+        # Converged if the step hardly lowered the cost or the cost reached
+        # the rounding level (the steps of exact data stay large until then)
+        done = (rel_change < tol) | (trial_cost[better] < rounding[accepted])
+        converged[accepted[done]] = True
+        stalled[~converged & (damping > 1e10)] = True
+
+    # Standard errors from the covariance matrix at the solution
+    dof = max(size * size - n_params, 1)
+    chi2 = cost / dof
+    jtj = np.einsum('kpi,kpj->kij', jac, jac)
+    covariance = np.linalg.pinv(jtj) * chi2[:, None, None]
+    errors = np.zeros_like(params)
+    errors[:, :n_params] = np.sqrt(np.abs(
+        np.einsum('kii->ki', covariance)))
+
+    return params, errors, chi2, converged, iterations
+
+
+@ins.timed('data_processing.fit_peaks')
+def fit_peaks(
+        image_stack,
+        peaks: np.ndarray,
+        *,
+        window: int = 9,
+        profile: str = 'gaussian',
+        block_frames: int = 32,
+        warm_start: bool = True,
+        max_iter: int = 100,
+        tol: float = 1e-8,
+        max_memory_mb: float = 512.0,
+        verbose: bool = False
+) -> np.ndarray:
+    """
+    Fits a 2D peak profile to small windows around peak positions across all
+    frames of an image stack (e.g., satellite peaks in a temperature or
+    energy series), giving the peak widths, centres and their uncertainties.
+
+    Instead of calling scipy.optimize.curve_fit once per peak, the windows
+    of all peaks of a frame are fitted together by a batched
+    Levenberg-Marquardt scheme with vectorized residuals and analytic
+    Jacobians. The frames are read in blocks and worked through in order.
+    Amplitude, centre and background are started from the moments of each
+    window. If warm_start is True, the widths (and eta) start from the
+    result of the closest peak (within half a window) in the previous frame
+    with peaks, as they usually change slowly across a series.
+
+    PARAMETERS
+    -----
+    image_stack: np.ndarray or h5py.Dataset
+        A F x M x N image stack
+    peaks: np.ndarray
+        Structured array with (at least) the fields 'frame', 'row' and 'col'
+        giving the peaks to fit, e.g., the output of find_peaks
+    window: int
+        Edge length (in pixels) of the square window cut out around each peak.
+        Windows at the edge of the frame are shifted inwards.
+    profile: str
+        The peak profile to fit
+        - 'gaussian': Gaussian profile
+        - 'lorentzian': Lorentzian profile
+        - 'pseudo-voigt': Linear combination of a Gaussian and a Lorentzian
+                          with the same width and the mixing parameter eta
+    block_frames: int
+        Maximum number of frames read at once
+    warm_start: bool
+        Start the widths (and eta) of the fits of a frame from the results
+        of the previous frame
+    max_iter: int
+        Maximum number of Levenberg-Marquardt iterations
+    tol: float
+        Fits are converged if an accepted step changes the sum of squared
+        residuals relatively by less than tol
+    max_memory_mb: float
+        Memory budget in MB for the frames read per block
+    verbose: bool
+        Prints out the number of fits and the throughput in fits per second
+
+    RETURNS
+    -----
+    fit_table: np.ndarray
+        Structured array (dtype FIT_DTYPE) with one row per peak containing
+        the frame, row and col of the input peak, the fitted parameters
+        (amplitude, center_row, center_col, fwhm_row, fwhm_col, background,
+        eta), their standard errors ('err_' + parameter name), the reduced
+        chi2, whether the fit converged and the number of iterations it
+        took. The centres are given in pixel coordinates of the full frame.
+    """
+    eta_fixed = {'gaussian': 0.0, 'lorentzian': 1.0, 'pseudo-voigt': 0.5}
+    if profile not in eta_fixed:
+        raise ValueError('A profile other than gaussian, lorentzian or '
+                         'pseudo-voigt was specified')
+
+    n_rows, n_cols = image_stack.shape[1:]
+    if window > min(n_rows, n_cols):
+        raise ValueError('window is larger than the frames')
+
+    # Sort the peaks by frame so that the blocks can be worked through in
+    # order, fit_table is returned in the order of the input
+    order = np.argsort(peaks['frame'], kind='stable')
+    frames = np.asarray(peaks['frame'])[order]
+    peak_rows = np.asarray(peaks['row'])[order]
+    peak_cols = np.asarray(peaks['col'])[order]
+
+    fit_table = np.zeros(len(peaks), dtype=FIT_DTYPE)
+    block_frames = min(block_frames, frames_per_block(
+        (n_rows, n_cols), itemsize=8, max_memory_mb=max_memory_mb))
+
+    # Results of the previous frame for warm starting
+    previous_centers, previous_params = None, None
+    time_start = time.perf_counter()
+    half = window // 2
+    offset = np.arange(window)
+
+    block_starts = np.unique(frames // block_frames) * block_frames
+    for start in block_starts:
+        in_block = np.flatnonzero((frames >= start)
+                                  & (frames < start + block_frames))
+        first, last = frames[in_block].min(), frames[in_block].max()
+        block = np.asarray(image_stack[first:last + 1], dtype=np.float64)
+
+        # Top left corner of each window, shifted inwards at the edges
+        r_start = np.clip(peak_rows[in_block] - half, 0, n_rows - window)
+        c_start = np.clip(peak_cols[in_block] - half, 0, n_cols - window)
+
+        # Cut out all windows of the block at once
+        windows = block[(frames[in_block] - first)[:, None, None],
+                        (r_start[:, None] + offset)[:, :, None],
+                        (c_start[:, None] + offset)[:, None, :]]
+        params = _initial_guess(windows, eta_fixed[profile])
+
+        # Fit the peaks of one frame at a time (they are sorted by frame),
+        # so that every frame can start from the results of the previous one
+        _, frame_starts = np.unique(frames[in_block], return_index=True)
+        frame_stops = np.append(frame_starts[1:], len(in_block))
+        for f0, f1 in zip(frame_starts, frame_stops):
+            peaks_frame = slice(f0, f1)
+            guess = params[peaks_frame]
+
+            if warm_start and previous_centers is not None:
+                # Use the closest peak of the previous frame if it lies
+                # within half a window of the peak
+                centers = np.stack([peak_rows[in_block][peaks_frame],
+                                    peak_cols[in_block][peaks_frame]], 1)
+                distance = np.linalg.norm(
+                    centers[:, None, :] - previous_centers[None, :, :], axis=2)
+                closest = distance.argmin(axis=1)
+                use = distance[np.arange(len(centers)), closest] <= half
+                # Only the peak shape is carried over, amplitude, centre and
+                # background of the window itself are the better estimates
+                guess[np.ix_(use, [3, 4, 6])] = \
+                    previous_params[np.ix_(closest[use], [3, 4, 6])]
+
+            fitted, errors, chi2, converged, iterations = _levenberg_marquardt(
+                windows[peaks_frame], guess, profile, max_iter, tol)
+
+            # Convert the centres to frame coordinates
+            fitted[:, 1] += r_start[peaks_frame]
+            fitted[:, 2] += c_start[peaks_frame]
+
+            # Fill in the results
+            out = order[in_block[peaks_frame]]
+            fit_table['frame'][out] = frames[in_block[peaks_frame]]
+            fit_table['row'][out] = peak_rows[in_block[peaks_frame]]
+            fit_table['col'][out] = peak_cols[in_block[peaks_frame]]
+            for idx, name in enumerate(PROFILE_PARAMETERS):
+                fit_table[name][out] = fitted[:, idx]
+                fit_table['err_' + name][out] = errors[:, idx]
+            fit_table['chi2'][out] = chi2
+            fit_table['converged'][out] = converged
+            fit_table['iterations'][out] = iterations
+
+            # Remember the converged results of this frame
+            if converged.any():
+                previous_centers = fitted[converged, 1:3]
+                previous_params = fitted[converged]
+            else:
+                previous_centers, previous_params = None, None
+
+    elapsed = time.perf_counter() - time_start
+    if verbose:
+        print(f'{len(peaks)} fits in {elapsed:.3f} s '
+              f'({len(peaks) / max(elapsed, 1e-12):.0f} fits per second)')
 
-    return im_dichro, im_pol_a, im_pol_b
\ No newline at end of file
+    return fit_table
@@ -5,16 +5,41 @@
 
     Authors: Dayne Sasaki, Damian Günzing
 """
+import hashlib
 import os.path
+import time
+from collections import deque
 
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from glob import glob
 from os.path import basename
 import pandas as pd
 import h5py
-from IPython.display import display
+from BL7011 import darks as dk
 from BL7011 import data_processing as dp
-from BL7011 import plotting as pt
+from BL7011 import instrumentation as ins
+from BL7011 import manifest as mf
+from BL7011 import pyramid as pr
+from BL7011.stack import DetectorStack
+from BL7011.tools import bin_frames, frames_per_block
+
+
+def display(obj) -> None:
+    # Displays obj with IPython (e.g., a pandas data frame in a notebook)
+    from IPython.display import display as ipython_display
+    ipython_display(obj)
+
+
+# Define static variables to identify polarization states
+POL_CIR = (-1, 1)
+POL_LIN = (0, 2)
+
+# Pairs of opposite polarizations used for dichroism calculations as
+# (label, name of pol_a, pol_a, name of pol_b, pol_b)
+DICHROISM_PAIRS = (('XCD', 'RCP', POL_CIR[1], 'LCP', POL_CIR[0]),
+                   ('XLD', 'HLP', POL_LIN[0], 'VLP', POL_LIN[1]))
 
 
 def get_all_file_names(
@@ -109,11 +134,14 @@ def read_image_from_h5(
         dataset: h5py._hl.dataset.Dataset,
         index: int,
         correction: str = '',
-        verbose: bool = False
+        verbose: bool = False,
+        dark: np.ndarray = None,
+        binning: int = 1,
+        out: np.ndarray = None
 ) -> np.ndarray:
     """
     Reads CCD image(s) contained in a HDF5 dataset of interest with optional
-    normalization of the image
+    binning, dark subtraction and normalization of the image
     
     PARAMETERS
     -----
@@ -135,10 +163,27 @@ def read_image_from_h5(
         Prints out diagnostic parameters, namely the normalization factor and
         the shape of 'XS111RLRL_diode' if 'i0 rlrl' is the correction method
 
+    dark: np.ndarray
+        M x N dark frame subtracted from each image before the
+        normalization (e.g., a master dark from BL7011.darks)
+
+    binning: int
+        Sums blocks of binning x binning pixels while the exposures are
+        read, block by block, so that no full resolution float copy of
+        the image is made (see BL7011.tools.bin_frames). The dark is
+        binned alike.
+
+    out: np.ndarray
+        v x M x N float buffer the image is read into (e.g., reused for the
+        images of a loop), with HDF5 converting the detector data to float
+        while reading. By default a new buffer is allocated. Not used if
+        binned
+
     RETURNS
     -----
     ccd_image: np.ndarray
-        A v x M x N image
+        A v x M x N image (v x M/binning x N/binning if binned), which is
+        'out' if given
 
     TODO: Change the normalization factor for the diode, they're negative!
           Plus, the number of labview datapoints is not the same as the ccd
@@ -148,18 +193,99 @@ def read_image_from_h5(
     h5_ccd_db = dataset['detector_1']['data']
     h5_labview_db = dataset['labview_data']
 
-    # Get the image
-    ccd_image = (h5_ccd_db[index]).astype(float)
+    # Get the image (reading includes the HDF5 decompression and the
+    # conversion to float, without an intermediate copy of the raw data)
+    if binning == 1:
+        ccd_image = out
+        if ccd_image is None:
+            ccd_image = np.empty(h5_ccd_db.shape[1:])
+        with ins.stage('file_processing.read'):
+            h5_ccd_db.read_direct(ccd_image, np.s_[index])
+            ins.add_bytes('file_processing.read',
+                          read=ccd_image.size * h5_ccd_db.dtype.itemsize)
+    else:
+        ccd_image = _read_binned(h5_ccd_db, index, binning)
+        if dark is not None:
+            dark = bin_frames(dark, binning)
+
+    if dark is not None:
+        with ins.stage('file_processing.dark'):
+            ccd_image -= dark
 
     # Select what kind of normalization to perform on the image
+    with ins.stage('file_processing.normalize'):
+        norm_factor = get_norm_factor(h5_labview_db, index, correction,
+                                      verbose)
+
+        # Normalize the image by either i0 or acquisition time
+        ccd_image /= norm_factor
+        return ccd_image
+
+
+def _read_binned(
+        h5_ccd_db: h5py._hl.dataset.Dataset,
+        index: int,
+        binning: int
+) -> np.ndarray:
+    # Reads the exposures of an image in blocks of the default memory budget
+    # and bins each block right after reading it
+    n_exposures = h5_ccd_db.shape[1]
+    block = frames_per_block(h5_ccd_db.shape[-2:],
+                             itemsize=h5_ccd_db.dtype.itemsize)
+    binned = []
+    for start in range(0, n_exposures, block):
+        with ins.stage('file_processing.read'):
+            exposures = h5_ccd_db[index, start:start + block]
+            ins.add_bytes('file_processing.read', read=exposures.nbytes)
+        with ins.stage('file_processing.bin'):
+            binned.append(bin_frames(exposures, binning))
+    return np.concatenate(binned)
+
+
+def get_norm_factor(
+        labview_db: h5py._hl.group.Group,
+        index: int | slice,
+        correction: str = '',
+        verbose: bool = False
+) -> float | np.ndarray:
+    """
+    Gets the factor a CCD image has to be divided by for the intensity
+    correction of interest
+
+    PARAMETERS
+    -----
+    labview_db: h5py._hl.group.Group
+        The labview data of an HDF5 file
+        i.e., h5_file['entry1']['instrument_1']['labview_data']
+
+    index: int or slice
+        Index (or slice of indices) of the image(s) within an image stack in
+        the HDF5 file. For a slice, one factor per image is returned.
+
+    correction: str
+        Type of intensity correction to perform on the CCD image 'ccd_image'
+            - Nothing : Return the raw ccd image
+            - 'i0 blade' : Normalize ccd image by the right blade current
+            - 'i0 rlrl' : Normalized by the XS111 RLRL diode (what is this?)
+            - 'cps' : Normalize ccd image by acquisition time (counts per sec)
+
+    verbose: bool
+        Prints out the normalization factor and the shape of
+        'XS111RLRL_diode' if 'i0 rlrl' is the correction method
+
+    RETURNS
+    -----
+    norm_factor: float or np.ndarray
+        The normalization factor(s)
+    """
     if 'i0 blade' in correction:  # Blade current i0 normalization
-        norm_factor = h5_labview_db['XS111LeftBladecurrent_diode'][index]
+        norm_factor = labview_db['XS111LeftBladecurrent_diode'][index]
     elif 'i0 rlrl' in correction:  # XS111 RLRL diode normalization
-        norm_factor = np.abs(h5_labview_db['XS111RLRL_diode'][index])
+        norm_factor = np.abs(labview_db['XS111RLRL_diode'][index])
         if verbose:
-            print(h5_labview_db['XS111RLRL_diode'].shape)
+            print(labview_db['XS111RLRL_diode'].shape)
     elif 'cps' in correction:  # Convert intensity to counts-per-second
-        norm_factor = h5_labview_db['count_time'][index] / 1000
+        norm_factor = labview_db['count_time'][index] / 1000
     elif '' in correction:
         norm_factor = 1
     else:
@@ -168,14 +294,17 @@ def read_image_from_h5(
     if verbose:
         print(norm_factor)
 
-    # Normalize the image by either i0 or acquisition time
-    return ccd_image / norm_factor
+    return norm_factor
 
 
 def load_h5_image(
         path_file: str,
-        correction: str = ''
-) -> np.ndarray:
+        correction: str = '',
+        dark: np.ndarray | dk.DarkLibrary = None,
+        binning: int = 1,
+        lazy: bool = False,
+        out: np.ndarray = None
+) -> np.ndarray | DetectorStack:
     """
     Reads the CCD image contained in a h5 file of interest
 
@@ -194,28 +323,479 @@ def load_h5_image(
             - 'i0 RLRL' : Normalized by the XS111 RLRL diode (what is this?)
             - 'cps' : Normalize ccd image by acquisition time (counts per sec)
 
+    dark: np.ndarray or BL7011.darks.DarkLibrary
+        M x N dark frame subtracted from the images before the
+        normalization, or a library of master darks in which the dark
+        matching the count_time, detector temperature and date of the file
+        is looked up
+
+    binning: int
+        Sums blocks of binning x binning pixels while reading, e.g., 2 or 4
+        for fast survey runs (see read_image_from_h5)
+
+    lazy: bool
+        Returns a BL7011.stack.DetectorStack of the exposures instead,
+        which is only read (dark subtracted and normalized) when it is
+        sliced down to frames, reduced or converted with np.asarray.
+        Binning is not supported for lazy stacks
+
+    out: np.ndarray
+        v x M x N float buffer the image is read into, e.g., to reuse the
+        memory when loading the files of a series (see read_image_from_h5)
+
     RETURNS
     -----
-    ccd_image: np.ndarray
+    ccd_image: np.ndarray or BL7011.stack.DetectorStack
         The CCD image, contained within an v x M x N array
+        (v x M/binning x N/binning if binned)
     """
+    dark = dk.resolve_dark(dark, path_file)
+
+    if lazy:
+        if binning != 1:
+            raise ValueError('binning is not supported for lazy stacks')
+        return DetectorStack(path_file, index=0).normalize(correction, dark)
+
     # Open the h5 file of interest
-    with h5py.File(path_file, 'r') as h5_file:
+    with ins.stage('file_processing.open'):
+        h5_file = h5py.File(path_file, 'r')
+    with h5_file:
         # Define the h5 database with the ccd image stack and the labview data
         h5_inst_db = h5_file['entry1']['instrument_1']
 
         # Get the ccd_image stack
-        ccd_image = read_image_from_h5(h5_inst_db, 0, correction)
+        ccd_image = read_image_from_h5(h5_inst_db, 0, correction,
+                                       dark=dark, binning=binning, out=out)
     return ccd_image
 
 
+def load_h5_reduced_image(
+        path_file: str,
+        correction: str = '',
+        dark: np.ndarray | dk.DarkLibrary = None,
+        *,
+        reducer: str = 'median',
+        sigma: float = 3.0,
+        max_memory_mb: float = 512.0,
+        binning: int = 1
+) -> np.ndarray:
+    """
+    Reads the image stack contained in a h5 file of interest and reduces it
+    to a single image with a robust average (see dp.reduce_stack), without
+    loading the whole stack at once
+
+    The stack is reduced before the dark subtraction and the normalization,
+    which gives the same image as reducing the corrected stack, as all
+    frames share the same dark and normalization factor.
+
+    PARAMETERS
+    -----
+    path_file: str
+        The pathname of the h5 file
+
+    correction, dark:
+        See load_h5_image
+
+    reducer: str
+        'mean', 'median' or 'sigma_clip' (see dp.reduce_stack)
+
+    sigma: float
+        Clipping threshold of 'sigma_clip' in standard deviations
+
+    max_memory_mb: float
+        Memory budget in MB for the blocks of frames read at once
+
+    binning: int
+        Sums blocks of binning x binning pixels while reading
+
+    RETURNS
+    -----
+    ccd_image: np.ndarray
+        The reduced M x N (M/binning x N/binning) CCD image
+    """
+    dark = dk.resolve_dark(dark, path_file)
+
+    with ins.stage('file_processing.open'):
+        h5_file = h5py.File(path_file, 'r')
+    with h5_file:
+        h5_inst_db = h5_file['entry1']['instrument_1']
+        ccd_image = dp.reduce_stack(h5_inst_db['detector_1']['data'],
+                                    reducer, index=0, sigma=sigma,
+                                    max_memory_mb=max_memory_mb,
+                                    binning=binning)
+        if dark is not None:
+            with ins.stage('file_processing.dark'):
+                ccd_image -= bin_frames(dark, binning)
+        with ins.stage('file_processing.normalize'):
+            norm_factor = get_norm_factor(h5_inst_db['labview_data'], 0,
+                                          correction)
+            return ccd_image / norm_factor
+
+
+def load_h5_registered_image(
+        path_file: str,
+        correction: str = '',
+        dark: np.ndarray | dk.DarkLibrary = None,
+        *,
+        reference_file: str = None,
+        max_memory_mb: float = 512.0,
+        binning: int = 1,
+        verbose: bool = False
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reads the image stack contained in a h5 file of interest and averages it
+    after correcting the drift between the exposures (see
+    BL7011.registration.register_stack), without loading the whole stack at
+    once
+
+    PARAMETERS
+    -----
+    path_file: str
+        The pathname of the h5 file
+
+    correction, dark:
+        See load_h5_image
+
+    reference_file: str
+        The pathname of a h5 file whose first exposure is the reference the
+        exposures are aligned with (e.g., the file of the opposite
+        polarization). By default the first exposure of path_file is used.
+
+    max_memory_mb: float
+        Memory budget in MB for the FFTs of a block of exposures
+
+    binning: int
+        Sums blocks of binning x binning pixels while reading, the shifts
+        are estimated on the binned exposures
+
+    verbose: bool
+        Prints out the largest shift
+
+    RETURNS
+    -----
+    (ccd_image, shifts): tuple
+        ccd_image: np.ndarray
+            The M x N (M/binning x N/binning) average of the aligned
+            exposures
+        shifts: np.ndarray
+            Exposures x 2 shift trajectory (rows, columns) in (binned)
+            pixels
+    """
+    from BL7011 import registration as rg
+
+    dark = dk.resolve_dark(dark, path_file)
+
+    # Raw first exposure of the reference file
+    reference = 0
+    if reference_file is not None:
+        with h5py.File(reference_file, 'r') as h5_file:
+            reference = h5_file['entry1']['instrument_1']['detector_1'][
+                'data'][0, 0]
+
+    with ins.stage('file_processing.open'):
+        h5_file = h5py.File(path_file, 'r')
+    with h5_file:
+        h5_inst_db = h5_file['entry1']['instrument_1']
+        ccd_image, shifts = rg.register_stack(h5_inst_db['detector_1']['data'],
+                                              reference=reference, index=0,
+                                              dark=dark,
+                                              max_memory_mb=max_memory_mb,
+                                              binning=binning,
+                                              verbose=verbose)
+        with ins.stage('file_processing.normalize'):
+            norm_factor = get_norm_factor(h5_inst_db['labview_data'], 0,
+                                          correction)
+            return ccd_image / norm_factor, shifts
+
+
+def extract_roi_series(
+        path_files: str | list[str] | pd.DataFrame,
+        rois: list[list[int]],
+        *,
+        correction: str = '',
+        max_memory_mb: float = 512.0,
+        verbose: bool = False
+) -> tuple[np.ndarray, pd.DataFrame]:
+    """
+    Extracts the integrated intensity within several rectangular regions of
+    interest (ROIs) for every frame of one or more HDF5 files.
+
+    Each frame is read only once. A summed-area table is built for each
+    chunk of frames, from which the sum of every ROI follows from four
+    table entries, independent of the ROI size and the number of ROIs.
+
+    PARAMETERS
+    -----
+    path_files: str, list[str] or pd.DataFrame
+        The pathname of an h5 file, a list of pathnames, or a file group
+        data frame with a 'path' column (e.g., file_df[file_group[0]] from
+        get_file_groups)
+
+    rois: list[list[int]]
+        Regions of interest, each in the format
+        [start_row, end_row, start_col, end_col]
+
+    correction: str
+        Type of intensity correction to perform on the CCD image 'ccd_image'
+            - Nothing : Return the raw ccd image
+            - 'i0 blade' : Normalize ccd image by the right blade current
+            - 'i0 rlrl' : Normalized by the XS111 RLRL diode (what is this?)
+            - 'cps' : Normalize ccd image by acquisition time (counts per sec)
+
+    max_memory_mb: float
+        Memory budget in MB for the frames and summed-area tables of a chunk
+
+    verbose: bool
+        Prints out each file while it is processed
+
+    RETURNS
+    -----
+    (roi_sums, metadata_df): tuple
+        roi_sums: np.ndarray
+            Frames x ROIs array of the integrated intensities
+        metadata_df: pd.DataFrame
+            One row per frame (i.e., per row of roi_sums) with the file
+            path, the 'index' of the image in the image stack, the
+            'exposure' within that image and all labview entries of the
+            image
+    """
+    # Bring all kinds of file inputs into a list of path names
+    if isinstance(path_files, str):
+        path_files = [path_files]
+    elif isinstance(path_files, pd.DataFrame):
+        path_files = list(path_files['path'].values)
+
+    rois = np.atleast_2d(np.asarray(rois, dtype=int))
+    if rois.shape[1] != 4 or np.any(rois[:, 1] <= rois[:, 0]) or \
+            np.any(rois[:, 3] <= rois[:, 2]) or np.any(rois < 0):
+        raise ValueError('ROIs have to be given as '
+                         '[start_row, end_row, start_col, end_col]')
+
+    sums_list = []
+    metadata_list = []
+    for path_file in path_files:
+        if verbose:
+            print('Extracting ROIs from ' + path_file)
+
+        with h5py.File(path_file, 'r') as h5_file:
+            h5_inst_db = h5_file['entry1']['instrument_1']
+            h5_ccd_db = h5_inst_db['detector_1']['data']
+            h5_labview_db = h5_inst_db['labview_data']
+
+            # The image stack is stored as images x exposures x M x N
+            n_images, n_exposures = h5_ccd_db.shape[:2]
+            frame_shape = h5_ccd_db.shape[2:]
+
+            if np.any(rois[:, 1] > frame_shape[0]) or \
+                    np.any(rois[:, 3] > frame_shape[1]):
+                raise ValueError(f'ROIs exceed the frame size {frame_shape} '
+                                 f'of {path_file}')
+
+            # Read as many images at once as fit in the memory budget for
+            # the frame and its summed-area table
+            n_chunk = max(1, frames_per_block(
+                frame_shape, itemsize=8, n_arrays=2,
+                max_memory_mb=max_memory_mb) // n_exposures)
+
+            for start in range(0, n_images, n_chunk):
+                stop = min(start + n_chunk, n_images)
+                with ins.stage('file_processing.read'):
+                    frames = h5_ccd_db[start:stop].reshape((-1,) + frame_shape)
+                    ins.add_bytes('file_processing.read', read=frames.nbytes)
+                with ins.stage('file_processing.roi_sums'):
+                    table = dp.summed_area_table(frames)
+                    chunk_sums = dp.roi_sums(table, rois)
+
+                # The intensity correction can be applied to the sums
+                norm_factor = get_norm_factor(h5_labview_db,
+                                              slice(start, stop), correction)
+                norm_factor = np.repeat(np.broadcast_to(
+                    norm_factor, (stop - start,)), n_exposures)
+                sums_list.append(chunk_sums / norm_factor[:, None])
+
+            # Tag each frame with its labview data
+            file_metadata = {
+                'path': path_file,
+                'index': np.repeat(np.arange(n_images), n_exposures),
+                'exposure': np.tile(np.arange(n_exposures), n_images)}
+            for entry in h5_labview_db.keys():
+                values = h5_labview_db[entry][()]
+                if np.ndim(values) == 1 and len(values) == n_images:
+                    file_metadata[entry] = np.repeat(values, n_exposures)
+            metadata_list.append(pd.DataFrame(file_metadata))
+
+    roi_sums = np.concatenate(sums_list, axis=0)
+    metadata_df = pd.concat(metadata_list, ignore_index=True)
+
+    return roi_sums, metadata_df
+
+
+def _read_roi_intensity(
+        path_file: str,
+        roi: list[int],
+        keys: tuple[str],
+        correction: str
+) -> tuple[float, float, dict[str, float]]:
+    # Reads the ROI pixels of the exposures of the first image of a h5 file
+    # and returns their summed intensity (averaged over the exposures), the
+    # normalization factor and the rounded labview values of the keys
+    with h5py.File(path_file, 'r') as h5_file:
+        h5_inst_db = h5_file['entry1']['instrument_1']
+        h5_ccd_db = h5_inst_db['detector_1']['data']
+        h5_labview_db = h5_inst_db['labview_data']
+        with ins.stage('file_processing.read'):
+            pixels = h5_ccd_db[0, :, roi[0]:roi[1], roi[2]:roi[3]]
+            ins.add_bytes('file_processing.read', read=pixels.nbytes)
+        intensity = pixels.sum(dtype=float) / len(pixels)
+        norm_factor = float(get_norm_factor(h5_labview_db, 0, correction))
+        metadata = {entry: round(h5_labview_db[entry][0], 2)
+                    for entry in keys}
+    return intensity, norm_factor, metadata
+
+
+def extract_spectra(
+        path_files: list[str] | pd.DataFrame,
+        roi: list[int] = None,
+        *,
+        correction: str = '',
+        mode: str = 'difference',
+        key_energy: str = 'beamline_energy',
+        key_polarization: str = 'EPU_Polarization',
+        workers: int = 1,
+        chunksize: int = None
+) -> pd.DataFrame:
+    """
+    Builds the (XAS-like) spectra, i.e., the intensity within a region of
+    interest (ROI) vs. the energy, of the files of an energy scan for each
+    polarization, together with their dichroism (XCD and/or XLD) spectra
+
+    Only the ROI pixels of each file are read, optionally spread over several
+    processes, and the intensity correction is applied to all files at once.
+    Like load_h5_image, the exposures of the first image of a file are used.
+    Files at the same energy and polarization are averaged.
+
+    PARAMETERS
+    -----
+    path_files: list[str] or pd.DataFrame
+        A list of pathnames, or a data frame with a 'path' column (e.g.,
+        file_df from get_file_groups with key_variable='beamline_energy', or
+        a file group file_df[file_group[0]])
+
+    roi: list[int]
+        Region of interest in the format [start_row, end_row, start_col,
+        end_col]. By default the intensity of the whole frame is integrated.
+
+    correction: str
+        Type of intensity correction to perform on the intensities
+            - Nothing : Return the raw intensity
+            - 'i0 blade' : Normalize by the right blade current
+            - 'i0 rlrl' : Normalized by the XS111 RLRL diode
+            - 'cps' : Normalize by acquisition time (counts per sec)
+
+    mode: str
+        The type of dichroism calculation to perform (see
+        dp.calculate_dichroism)
+        - 'difference': (spectrum_pol_A - spectrum_pol_B)
+        - 'asymmetry': (spectrum_pol_A - spectrum_pol_B) /
+                       (spectrum_pol_A + spectrum_pol_B)
+
+    key_energy, key_polarization: str
+        Labview entries holding the energy and the polarization state
+
+    workers: int
+        Number of processes reading the files
+
+    chunksize: int
+        Number of files handed to a process at once. By default the files
+        are split into about four chunks per process.
+
+    RETURNS
+    -----
+    spectra: pd.DataFrame
+        One row per energy (the index, in ascending order) with the spectrum
+        of every polarization found (columns 'RCP', 'LCP', 'HLP', 'VLP') and
+        the dichroism spectrum ('XCD', 'XLD') of every pair of opposite
+        polarizations found. Energies at which a polarization was not
+        measured are NaN.
+    """
+    # Bring all kinds of file inputs into a list of path names
+    if isinstance(path_files, pd.DataFrame):
+        path_files = list(path_files['path'].values)
+    if roi is None:
+        roi = [0, None, 0, None]
+    keys = (key_energy, key_polarization)
+
+    # Read the ROI intensities, one h5 file at a time or spread over several
+    # processes
+    if workers > 1 and len(path_files) > 1:
+        chunksize = chunksize or max(1, len(path_files) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_read_roi_intensity, path_files,
+                                        repeat(roi), repeat(keys),
+                                        repeat(correction),
+                                        chunksize=chunksize))
+    else:
+        results = list(map(_read_roi_intensity, path_files, repeat(roi),
+                           repeat(keys), repeat(correction)))
+    if not results:
+        raise ValueError('No files to extract the spectra from')
+
+    # Apply the intensity correction to all files at once
+    intensity, norm_factor, metadata = zip(*results)
+    points_df = pd.DataFrame(list(metadata))
+    points_df['intensity'] = np.array(intensity) / np.array(norm_factor)
+
+    # Average the files per energy and polarization
+    spectra = points_df.pivot_table(index=key_energy,
+                                    columns=key_polarization,
+                                    values='intensity', aggfunc='mean')
+    columns = {}
+    for label, name_a, pol_a, name_b, pol_b in DICHROISM_PAIRS:
+        for name, pol in ((name_a, pol_a), (name_b, pol_b)):
+            if pol in spectra.columns:
+                columns[name] = spectra[pol].to_numpy()
+        if name_a in columns and name_b in columns:
+            columns[label] = dp.calculate_dichroism(columns[name_a],
+                                                    columns[name_b], mode)
+    return pd.DataFrame(columns, index=spectra.index)
+
+
+def read_file_metadata(
+        path_file: str,
+        keys: tuple[str]
+) -> dict[str, float]:
+    """
+    Reads the labview data of the first image of a h5 file for the HDF5 keys
+    of interest. The values are rounded to the second decimal place.
+
+    PARAMETERS
+    -----
+    path_file: str
+        The pathname of the h5 file
+    keys: tuple[str]
+        HDF5 keys/Labview entries to read
+
+    RETURNS
+    -----
+    metadata: dict[str, float]
+        The rounded labview values of each key
+    """
+    with ins.stage('file_processing.metadata'), \
+            h5py.File(path_file, 'r') as h5_file:
+        h5_labview_db = h5_file['entry1']['instrument_1']['labview_data']
+        return {entry: round(h5_labview_db[entry][0], 2) for entry in keys}
+
+
 def get_file_groups(
         path_dir: str,
         *,
         key_common: str | tuple[str],
         key_variable: str,
         search: str = '',
-        verbose: bool = False
+        verbose: bool = False,
+        workers: int = 1,
+        chunksize: int = None,
+        progress=None
 ) -> tuple[pd.DataFrame, pd.DataFrame, list[bool]]:
     """
         Looks at all HDF5 CCD files within a directory and identifies
@@ -257,6 +837,17 @@ def get_file_groups(
             Will enable/disable the outputs of get_all_file_names and
             dict_to_df in the function
 
+        workers: int
+            Number of processes reading the labview data of the files
+
+        chunksize: int
+            Number of files handed to a process at once. By default the
+            files are split into about four chunks per process.
+
+        progress: callable
+            Function called with the path name of each file once its
+            labview data has been read (e.g., to report progress)
+
         RETURNS
         -----
         (file_list, unique_positions, file_group): tuple
@@ -278,8 +869,11 @@ def get_file_groups(
     # This is used to visualize all the entries within a pandas dataframe
     pd.set_option('display.max_colwidth', 0)
 
-    # Grab all the file names in the directory and put them in a dict
+    # Grab all the file names in the directory and put them in a dict,
+    # leaving out the data files written by batch_processing_dichroism
     file_paths = get_all_file_names(path_dir, search=search, verbose=verbose)
+    file_paths = {idx: path for idx, path in file_paths.items()
+                  if not basename(path).startswith('processed_')}
 
     # Convert file_paths into a Pandas DataFrame
     file_df = dict_to_df(file_paths, value_title='path', verbose=verbose)
@@ -298,17 +892,30 @@ def get_file_groups(
         file_df[entry] = pd.Series(dtype='float')
 
     # Populate file_df with the desired labview data (keys_common
-    # and keys_different)
-    for idx in file_df.index:
-        # Open one h5 file at a time
-        with h5py.File(file_paths[idx], 'r') as h5_file:
-            # Iterate over all the keys_common and keys_different entries
-            for entry in key_common + key_variable:
-                file_df.at[idx, entry] = round(h5_file['entry1']
-                                               ['instrument_1']
-                                               ['labview_data']
-                                               [entry]
-                                               [0], 2)
+    # and keys_different), either one h5 file at a time or spread over
+    # several processes
+    paths = [file_paths[idx] for idx in file_df.index]
+    if workers > 1 and len(paths) > 1:
+        chunksize = chunksize or max(1, len(paths) // (4 * workers))
+        executor = ProcessPoolExecutor(max_workers=workers)
+        all_metadata = executor.map(read_file_metadata, paths,
+                                    repeat(key_common + key_variable),
+                                    chunksize=chunksize)
+    else:
+        executor = None
+        all_metadata = map(read_file_metadata, paths,
+                           repeat(key_common + key_variable))
+
+    try:
+        for idx, path, file_metadata in zip(file_df.index, paths,
+                                            all_metadata):
+            for entry, value in file_metadata.items():
+                file_df.at[idx, entry] = value
+            if progress is not None:
+                progress(path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     # Get a smaller dataframe with lists the unique combination of key_common
     # position values (not the name of the key, but the value associated with
@@ -358,8 +965,20 @@ def batch_processing_dichroism(
         verbose: bool = False,
         diagnostic: bool = False,
         save_data: bool = True,
-        save_figure: bool = False
-) -> None:
+        save_figure: bool = False,
+        reuse_figure: bool = False,
+        pyramid: bool = False,
+        dtype: str = None,
+        incremental: bool = True,
+        force: bool = False,
+        dry_run: bool = False,
+        identity: str = 'mtime',
+        dark: np.ndarray | dk.DarkLibrary = None,
+        reducer: str = 'mean',
+        binning: int = 1,
+        prefetch: int = 0,
+        max_memory_mb: float = 1024.0
+) -> list[str]:
     """
     Performs batch processing of all COSMIC Scattering data files within a
     specified directory.
@@ -442,60 +1061,75 @@ def batch_processing_dichroism(
         will automatically have a name generated based on the "keys_common" and
         "key_variable" name and values they possess
 
+    reuse_figure: bool
+        Updates a single matplotlib figure for all file groups instead of
+        creating a new figure per group, which is much faster for large
+        batches (e.g., when only saving the figures)
+
+    pyramid: bool
+        Stores mean-binned preview pyramids (1/2, 1/4, ...) of the saved
+        images in the processed data files (see BL7011.pyramid)
+
+    dtype: str
+        Data type the images are saved with (e.g., 'float32'). By default
+        they are saved as calculated (float64).
+
+    incremental: bool
+        Only recompute the processed data files which are out of date. A
+        manifest in path_dir (see BL7011.manifest) records the identities of
+        the input files and the mode, correction and variable_stack of every
+        saved file. A file is out of date if it is missing or any of these
+        have changed, or if save_figure is True and its figure is missing.
+        Only has an effect if save_data is True.
+
+    force: bool
+        Recompute all processed data files, even if they are up to date
+
+    dry_run: bool
+        Only print out the processed data files which would be recomputed,
+        without calculating, saving or plotting anything
+
+    identity: str
+        How the identity of the input files is determined
+            - 'mtime' : path, size and modification time
+            - 'hash' : path, size and sha256 hash of the content
+
+    dark: np.ndarray or BL7011.darks.DarkLibrary
+        Dark frame subtracted from all images, or a library of master darks
+        in which the dark of each file is looked up by its count_time,
+        detector temperature and date (see load_h5_image)
+
+    reducer: str
+        How an image stack is averaged if variable_stack is False: 'mean',
+        or the cosmic-ray rejecting 'median' or 'sigma_clip'
+        (see dp.reduce_stack)
+
+    binning: int
+        Sums blocks of binning x binning pixels while the images are read
+        (e.g., 2 or 4 for fast survey runs). The binning is saved in the
+        processed data files and the figures show the detector pixels.
+
+    prefetch: int
+        Number of file groups whose images are loaded ahead in a background
+        thread while the current group is saved and plotted, so that the
+        reading (HDF5 releases the GIL) overlaps with the processing. 0
+        loads every group when it is processed (default). If verbose, the
+        time the loading overlapped with the processing is printed at the
+        end.
+
+    max_memory_mb: float
+        Memory budget in MB for the image stacks of the prefetched file
+        groups, which can lower the number of groups loaded ahead (at least
+        one group is always prefetched)
+
     RETURNS
     -----
-    Nothing
+    recomputed: list[str]
+        Path names of the processed data files which were (or, for dry_run,
+        would be) recomputed
 
     """
 
-    # Define static variables to identify polarization states
-    POL_CIR = (-1, 1)
-    POL_LIN = (0, 2)
-
-    # Define a private function to handle saving data
-    def data_saver(path_name,
-                   im_dichro,
-                   im_pol_a,
-                   im_pol_b,
-                   metadata_pol_a,
-                   metadata_pol_b
-                   ) -> None:
-        # Writes the processed data to an HDF5 file
-        with h5py.File(path_name, 'w') as hf:
-            # Create different groups for the dichroism image and the
-            # corresponding polarization images
-            g_process = hf.create_group('process')
-            g_pol_a = hf.create_group('pol_a')
-            g_pol_b = hf.create_group('pol_b')
-
-            # Save the images
-            g_process.create_dataset('image_dichro', data=im_dichro)
-            g_pol_a.create_dataset('image', data=im_pol_a)
-            g_pol_b.create_dataset('image', data=im_pol_b)
-
-            # Save the metadata.
-            for entry_name in metadata_pol_a.columns[:]:
-                g_pol_a.create_dataset(entry_name,
-                                       data=metadata_pol_a[entry_name].iloc[0])
-
-            for entry_name in metadata_pol_b.columns[:]:
-                g_pol_b.create_dataset(entry_name,
-                                       data=metadata_pol_b[entry_name].iloc[0])
-
-            # Save image processing parameters
-            g_process.create_dataset('correction', data=correction)
-            g_process.create_dataset('dichroism_calculation', data=mode)
-
-    # Define a private function to handle file name generation from metadata.
-    # The file name will exclude the key_variable from the name
-    def file_name_generator(prefix, f_df) -> str:
-        # Generate name for dichroism data file
-        col_names = f_df.columns[1:-1]
-        temp_file_name = prefix + ''.join(
-            f'_{idx_name}_{f_df[idx_name].iloc[0]}' for
-            idx_name in col_names).replace('.', 'p') + '.h5'
-        return os.path.join(path_dir, temp_file_name)
-
     # Use group_files_in_dir to determine what groups of files to perform
     # batch processing on
     file_df, unique_positions, file_group = \
@@ -513,101 +1147,420 @@ def batch_processing_dichroism(
         display(unique_positions)
         print('\n-------------------------------------\n')
 
+    # Load the manifest of the previously processed data files
+    manifest = None
+    if incremental and save_data:
+        manifest = mf.load_manifest(path_dir)
+
+    # Pull out the dataframes containing all members of the file groups
+    file_groups = [file_df[file_group[idx]]
+                   for idx in range(len(unique_positions))]
+
+    # Load the images of the next file groups in a background thread
+    prefetched, executor = deque(), None
+    load_time, wait_time = 0.0, 0.0
+    if prefetch and not dry_run and file_groups:
+        executor = ThreadPoolExecutor(max_workers=1)
+        depth = _prefetch_depth(file_groups, prefetch, max_memory_mb, binning)
+        params = _processing_params(mode, correction, variable_stack, dtype,
+                                    dark, reducer, binning, pyramid)
+        options = {'mode': mode, 'correction': correction,
+                   'variable_stack': variable_stack, 'dark': dark,
+                   'reducer': reducer, 'binning': binning}
+
+    def submit(idx):
+        # Starts loading the pairs of a file group which are out of date
+        save_paths = [
+            save_path for *_, file_a, file_b, save_path in
+            _dichroism_pairs(file_groups[idx], path_dir, key_variable)
+            if manifest is None or force or not _is_up_to_date(
+                manifest, save_path,
+                [file_a['path'].values[0], file_b['path'].values[0]],
+                params, identity, save_figure)]
+        prefetched.append(executor.submit(
+            _calculate_group_images, file_groups[idx], path_dir,
+            key_variable, save_paths, options))
+
     # Look at each file group one at a time and perform dichroism calculations
-    for idx, position_values in enumerate(unique_positions):
-        # Pull out the dataframe containing all members of the file group
-        file_group_df = file_df[file_group[idx]]
+    recomputed = []
+    try:
+        for idx, file_group_df in enumerate(file_groups):
+            images = None
+            if executor is not None:
+                # Keep the next groups loading while this one is processed
+                if idx == 0:
+                    submit(0)
+                future = prefetched.popleft()
+                while len(prefetched) < depth and \
+                        idx + len(prefetched) + 1 < len(file_groups):
+                    submit(idx + len(prefetched) + 1)
+                start = time.perf_counter()
+                with ins.stage('file_processing.prefetch_wait'):
+                    images, seconds = future.result()
+                wait_time += time.perf_counter() - start
+                load_time += seconds
+
+            recomputed += process_dichroism_group(file_group_df,
+                                                  path_dir=path_dir,
+                                                  key_variable=key_variable,
+                                                  mode=mode,
+                                                  correction=correction,
+                                                  variable_stack=variable_stack,
+                                                  verbose=verbose,
+                                                  save_data=save_data,
+                                                  save_figure=save_figure,
+                                                  reuse_figure=reuse_figure,
+                                                  pyramid=pyramid,
+                                                  dtype=dtype,
+                                                  manifest=manifest,
+                                                  force=force,
+                                                  dry_run=dry_run,
+                                                  identity=identity,
+                                                  dark=dark,
+                                                  reducer=reducer,
+                                                  binning=binning,
+                                                  images=images)
+
+            # Update the manifest after every group, so that an interrupted
+            # batch does not lose track of the finished groups
+            if manifest is not None and not dry_run:
+                mf.save_manifest(path_dir, manifest)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if executor is not None and verbose:
+        print(f'Prefetch: loading took {load_time:.2f} s, '
+              f'{max(load_time - wait_time, 0):.2f} s of it overlapped with '
+              f'the processing')
+
+    if dry_run:
+        print(f'{len(recomputed)} processed data files would be recomputed')
+    elif manifest is not None:
+        print(f'{len(recomputed)} processed data files recomputed')
 
-        # Determine if this file group is suitable to calculate dichroism
-        file_LCP = file_group_df[file_group_df[key_variable] == POL_CIR[0]]
-        file_RCP = file_group_df[file_group_df[key_variable] == POL_CIR[1]]
-        file_HLP = file_group_df[file_group_df[key_variable] == POL_LIN[0]]
-        file_VLP = file_group_df[file_group_df[key_variable] == POL_LIN[1]]
+    # Let user know the function is done
+    print('Function is done. D-U-N')
 
-        # Dichroism calculation can only be performed if each opposite
-        # polarization has only 1 image
-        if len(file_LCP) * len(file_RCP) == 1:
-            # Calculate dichroism image
-            im_XCD, im_RCP, im_LCP = \
-                dp.calculate_dichroism_from_file(file_RCP['path'].values[0],
-                                                 file_LCP['path'].values[0],
-                                                 mode=mode,
-                                                 correction=correction,
-                                                 variable_stack=variable_stack)
+    return recomputed
 
-            # Generate name for dichroism data file
-            save_path = file_name_generator('processed_XCD', file_RCP)
 
-            # If verbose, display file_LCP and file_RCP
-            if verbose:
-                display(file_group_df[np.abs(
-                    file_group_df[key_variable]) == 1])
+def process_dichroism_group(
+        file_group_df: pd.DataFrame,
+        *,
+        path_dir: str,
+        key_variable: str,
+        mode: str = 'difference',
+        correction: str = '',
+        variable_stack: bool = False,
+        verbose: bool = False,
+        save_data: bool = True,
+        save_figure: bool = False,
+        plot: bool = True,
+        reuse_figure: bool = False,
+        pyramid: bool = False,
+        dtype: str = None,
+        manifest: dict = None,
+        force: bool = False,
+        dry_run: bool = False,
+        identity: str = 'mtime',
+        dark: np.ndarray | dk.DarkLibrary = None,
+        reducer: str = 'mean',
+        binning: int = 1,
+        images: dict = None
+) -> list[str]:
+    """
+    Calculates the circular (XCD) and/or linear (XLD) dichroism of a single
+    file group, i.e., one row of unique_positions from get_file_groups.
 
-            if save_data:
-                print('Saving data to: ' + save_path)
-                # Save the dichroism data
-                data_saver(save_path, im_XCD, im_RCP, im_LCP, file_RCP,
-                           file_LCP)
+    The dichroism can only be calculated if each of the opposite
+    polarizations is represented by exactly one file in the group.
 
-            # Initialize the a string to store the image save path as None
-            save_path_im = None
+    PARAMETERS
+    -----
+    file_group_df: pd.DataFrame
+        Data frame containing all members of the file group, with the
+        columns 'path', the key_common entries and key_variable, in that
+        order (e.g., file_df[file_group[0]] from get_file_groups)
 
-            # Redefine save_path_im as a file path if save_figure is True
-            if save_figure:
-                save_path_im = save_path[0:-2] + 'png'
-                print('Saving image to: ' + save_path_im)
+    path_dir: str
+        Pathname of the directory the processed files are saved to
 
-            # Plot the dichroism data
-            pt.plot_three_images_dichroism(im_RCP, im_LCP, im_XCD,
-                                            title_main=save_path,
-                                            title_1='RCP',
-                                            title_2='LCP',
-                                            title_3='XCD',
-                                            save_path=save_path_im)
-
-            print('\n-------------------------------------\n')
-
-        if len(file_HLP) * len(file_VLP) == 1:
-            # Calculate dichroism image
-            im_XLD, im_HLP, im_VLP = \
-                dp.calculate_dichroism_from_file(file_HLP['path'].values[0],
-                                                 file_VLP['path'].values[0],
+    key_variable: str
+        HDF5 key/Labview entry holding the polarization state
+
+    mode, correction, variable_stack, verbose, save_data, save_figure,
+    reuse_figure, pyramid, dtype:
+        See batch_processing_dichroism
+
+    plot: bool
+        Plots the polarization and dichroism images. Needs to be True for
+        save_figure to have an effect.
+
+    manifest: dict
+        Manifest of the processed data files (see BL7011.manifest). If
+        given, up-to-date files are skipped (unless save_figure is True and
+        their figure is missing) and the saved files are recorded in the
+        manifest.
+
+    force, dry_run, identity, dark, reducer, binning:
+        See batch_processing_dichroism
+
+    images: dict
+        Dichroism and polarization images (im_dichro, im_pol_a, im_pol_b)
+        which were already calculated, e.g., prefetched in the background,
+        by the path name of their processed data file. The images of the
+        other pairs are calculated here.
+
+    RETURNS
+    -----
+    save_paths: list[str]
+        Path names of the processed data files of the dichroism images
+        that were (or, for dry_run, would be) calculated, whether or not
+        they were saved
+    """
+    save_paths = []
+    params = _processing_params(mode, correction, variable_stack, dtype,
+                                dark, reducer, binning, pyramid)
+
+    for label, name_a, name_b, file_a, file_b, save_path in \
+            _dichroism_pairs(file_group_df, path_dir, key_variable):
+        inputs = [file_a['path'].values[0], file_b['path'].values[0]]
+
+        # Skip the pair if its processed data file is up to date
+        if manifest is not None and not force and \
+                _is_up_to_date(manifest, save_path, inputs, params,
+                               identity, save_figure):
+            if verbose:
+                print('Up to date: ' + save_path)
+            continue
+
+        if dry_run:
+            print('Would recompute: ' + save_path)
+            save_paths.append(save_path)
+            continue
+
+        # Calculate dichroism image, unless it was already calculated
+        if images is not None and save_path in images:
+            im_dichro, im_pol_a, im_pol_b = images[save_path]
+        else:
+            im_dichro, im_pol_a, im_pol_b = \
+                dp.calculate_dichroism_from_file(*inputs,
                                                  mode=mode,
                                                  correction=correction,
-                                                 variable_stack=variable_stack)
+                                                 variable_stack=variable_stack,
+                                                 dark=dark,
+                                                 reducer=reducer,
+                                                 binning=binning)
+        save_paths.append(save_path)
 
-            # Generate name for dichroism data file
-            save_path = file_name_generator('processed_XLD', file_HLP)
+        # If verbose, display both polarization files
+        if verbose:
+            display(pd.concat([file_a, file_b]))
 
-            # If verbose, display file_HLP and file_VLP
-            if verbose:
-                display(file_group_df[
-                            (file_group_df[key_variable] == POL_LIN[0]) |
-                            (file_group_df[key_variable] == POL_LIN[1])])
+        if save_data:
+            print('Saving data to: ' + save_path)
+            # Save the dichroism data
+            _save_dichroism_data(save_path, im_dichro, im_pol_a, im_pol_b,
+                                 file_a, file_b, correction=correction,
+                                 mode=mode, pyramid=pyramid, dtype=dtype,
+                                 binning=binning)
+            if manifest is not None:
+                mf.record(manifest, save_path, inputs, params, identity)
 
-            if save_data:
-                print('Saving data to: ' + save_path)
-                # Save the dichroism data
-                data_saver(save_path, im_XLD, im_HLP, im_VLP, file_HLP,
-                           file_VLP)
+        if plot:
+            from BL7011 import plotting as pt
 
             # Initialize the a string to store the image save path as None
             save_path_im = None
 
             # Redefine save_path_im as a file path if save_figure is True
             if save_figure:
-                save_path_im = save_path[0:-2] + 'png'
+                save_path_im = _figure_file_name(save_path)
                 print('Saving image to: ' + save_path_im)
 
             # Plot the dichroism data
-            pt.plot_three_images_dichroism(im_HLP, im_VLP, im_XLD,
-                                            title_main=save_path,
-                                            title_1='HLP',
-                                            title_2='VLP',
-                                            title_3='XLD',
-                                            save_path=save_path_im)
+            with ins.stage('file_processing.plot'):
+                pt.plot_three_images_dichroism(im_pol_a, im_pol_b, im_dichro,
+                                                title_main=save_path,
+                                                title_1=name_a,
+                                                title_2=name_b,
+                                                title_3=label,
+                                                save_path=save_path_im,
+                                                reuse_figure=reuse_figure,
+                                                binning=binning)
 
-            print('\n-------------------------------------\n')
+        print('\n-------------------------------------\n')
 
-    # Let user know the function is done
-    print('Function is done. D-U-N')
+    return save_paths
+
+
+def _processing_params(
+        mode: str,
+        correction: str,
+        variable_stack: bool,
+        dtype: str,
+        dark: np.ndarray | dk.DarkLibrary,
+        reducer: str,
+        binning: int,
+        pyramid: bool
+) -> dict:
+    # Processing parameters of the processed data files in the manifest
+    params = {'mode': mode, 'correction': correction,
+              'variable_stack': variable_stack, 'dtype': dtype}
+    # Files processed without a dark, with the plain mean, unbinned and
+    # without pyramids keep the parameters they were recorded with before
+    # these options existed
+    if dark is not None:
+        params['dark'] = _dark_identity(dark)
+    if reducer != 'mean':
+        params['reducer'] = reducer
+    if binning != 1:
+        params['binning'] = binning
+    if pyramid:
+        params['pyramid'] = pyramid
+    return params
+
+
+def _figure_file_name(save_path: str) -> str:
+    # Path name of the figure saved next to a processed data file
+    return save_path[0:-2] + 'png'
+
+
+def _is_up_to_date(
+        manifest: dict,
+        save_path: str,
+        inputs: list[str],
+        params: dict,
+        identity: str,
+        save_figure: bool
+) -> bool:
+    # A processed data file is only up to date if the figure, if requested,
+    # was saved as well (the figures are not part of the parameters)
+    if save_figure and not os.path.isfile(_figure_file_name(save_path)):
+        return False
+    return mf.is_up_to_date(manifest, save_path, inputs, params, identity)
+
+
+def _dichroism_pairs(file_group_df: pd.DataFrame, path_dir: str,
+                     key_variable: str):
+    # Yields (label, name_a, name_b, file_a, file_b, save_path) for every
+    # pair of opposite polarizations of a file group which can be processed
+    for label, name_a, pol_a, name_b, pol_b in DICHROISM_PAIRS:
+        # Determine if this file group is suitable to calculate dichroism
+        file_a = file_group_df[file_group_df[key_variable] == pol_a]
+        file_b = file_group_df[file_group_df[key_variable] == pol_b]
+
+        # Dichroism calculation can only be performed if each opposite
+        # polarization has only 1 image
+        if len(file_a) * len(file_b) != 1:
+            continue
+
+        # Generate name for dichroism data file
+        save_path = _dichroism_file_name(path_dir, 'processed_' + label,
+                                         file_a)
+        yield label, name_a, name_b, file_a, file_b, save_path
+
+
+def _calculate_group_images(
+        file_group_df: pd.DataFrame,
+        path_dir: str,
+        key_variable: str,
+        save_paths: list[str],
+        options: dict
+) -> tuple[dict, float]:
+    # Calculates the images of the pairs of a file group whose processed
+    # data files are in save_paths (run in the prefetch thread). Returns
+    # them by save path together with the time it took
+    start = time.perf_counter()
+    images = {}
+    for *_, file_a, file_b, save_path in \
+            _dichroism_pairs(file_group_df, path_dir, key_variable):
+        if save_path in save_paths:
+            images[save_path] = dp.calculate_dichroism_from_file(
+                file_a['path'].values[0], file_b['path'].values[0], **options)
+    return images, time.perf_counter() - start
+
+
+def _prefetch_depth(file_groups: list, prefetch: int, max_memory_mb: float,
+                    binning: int) -> int:
+    # Number of file groups loaded ahead, limited by the memory budget for
+    # the image stacks (as float) of the largest file group
+    largest = max(file_groups, key=len)
+    with h5py.File(largest['path'].values[0], 'r') as h5_file:
+        shape = h5_file['entry1/instrument_1/detector_1/data'].shape
+    group_bytes = len(largest) * np.prod(shape[1:]) * 8 / binning**2
+    return int(max(1, min(prefetch, max_memory_mb * 2**20 // group_bytes)))
+
+
+def _dark_identity(dark: np.ndarray | dk.DarkLibrary) -> str:
+    # Identifies the dark of the processing parameters in the manifest, by
+    # the library path or by the hash of the dark frame
+    if isinstance(dark, dk.DarkLibrary):
+        return repr(dark)
+    return hashlib.sha256(np.ascontiguousarray(dark).tobytes()).hexdigest()
+
+
+def _save_dichroism_data(
+        path_name: str,
+        im_dichro: np.ndarray,
+        im_pol_a: np.ndarray,
+        im_pol_b: np.ndarray,
+        metadata_pol_a: pd.DataFrame,
+        metadata_pol_b: pd.DataFrame,
+        *,
+        correction: str,
+        mode: str,
+        pyramid: bool = False,
+        dtype: str = None,
+        binning: int = 1
+) -> None:
+    # Writes the processed data to an HDF5 file
+    if dtype is not None:
+        im_dichro = im_dichro.astype(dtype)
+        im_pol_a = im_pol_a.astype(dtype)
+        im_pol_b = im_pol_b.astype(dtype)
+    n_bytes = im_dichro.nbytes + im_pol_a.nbytes + im_pol_b.nbytes
+    with ins.stage('file_processing.write', written=n_bytes), \
+            h5py.File(path_name, 'w') as hf:
+        # Create different groups for the dichroism image and the
+        # corresponding polarization images
+        g_process = hf.create_group('process')
+        g_pol_a = hf.create_group('pol_a')
+        g_pol_b = hf.create_group('pol_b')
+
+        # Save the images
+        g_process.create_dataset('image_dichro', data=im_dichro)
+        g_pol_a.create_dataset('image', data=im_pol_a)
+        g_pol_b.create_dataset('image', data=im_pol_b)
+
+        # Save the preview pyramids of the images
+        if pyramid:
+            pr.write_pyramid(g_process, 'image_dichro', im_dichro)
+            pr.write_pyramid(g_pol_a, 'image', im_pol_a)
+            pr.write_pyramid(g_pol_b, 'image', im_pol_b)
+
+        # Save the metadata.
+        for entry_name in metadata_pol_a.columns[:]:
+            g_pol_a.create_dataset(entry_name,
+                                   data=metadata_pol_a[entry_name].iloc[0])
+
+        for entry_name in metadata_pol_b.columns[:]:
+            g_pol_b.create_dataset(entry_name,
+                                   data=metadata_pol_b[entry_name].iloc[0])
+
+        # Save image processing parameters
+        g_process.create_dataset('correction', data=correction)
+        g_process.create_dataset('dichroism_calculation', data=mode)
+        if binning != 1:
+            g_process.create_dataset('binning', data=binning)
+
+
+def _dichroism_file_name(path_dir: str, prefix: str, f_df: pd.DataFrame) -> str:
+    # Generates the file name of a processed data file from the metadata.
+    # The file name will exclude the key_variable from the name
+    col_names = f_df.columns[1:-1]
+    temp_file_name = prefix + ''.join(
+        f'_{idx_name}_{f_df[idx_name].iloc[0]}' for
+        idx_name in col_names).replace('.', 'p') + '.h5'
+    return os.path.join(path_dir, temp_file_name)
@@ -1,11 +1,16 @@
 import numpy as np
 import h5py
-from BL7011.tools import where_is_my_frame_missing
-import tqdm
-import matplotlib.pyplot as plt
+from BL7011 import darks as dk
+from BL7011 import instrumentation as ins
+from BL7011.data_processing import REDUCERS, reduce_stack
+from BL7011.tools import bin_frames, where_is_my_frame_missing
+from BL7011.pyramid import read_preview, write_pyramid
+from BL7011.registration import register_stack
+from BL7011.stack import DetectorStack
 import warnings as w
 
 
+@ins.timed("import_functions.import_broken_h5")
 def import_broken_h5(
     h5filename: str,
     average: int = 10,
@@ -15,6 +20,14 @@ def import_broken_h5(
     eps: float = 0.3,
     for_roi: bool = False,
     save_to_h5: bool = False,
+    pyramid: bool = False,
+    dark=None,
+    dark_count_time: float = None,
+    reducer: str = "mean",
+    sigma: float = 3.0,
+    register: bool = False,
+    binning: int = 1,
+    lazy: bool = False,
 ) -> np.array:
     """
     When in the bluesky exporter None is selected it exports the collected
@@ -38,29 +51,75 @@ def import_broken_h5(
     eps: float
         Value for the eps to pass the where_is_my_frame_missing() function.
     for_roi : bool
-        Will only important a single frame to plot. Takes frame number as an argument as well.
+        Will only important a single frame to plot. Takes frame number as an argument as well. Only a preview that
+        fits the display is read (see BL7011.pyramid.read_preview), the axes show the full resolution pixels.
     save_to_h5 : bool
         Will save to h5 file, if string is passed it will use it as filename.
-
+    pyramid : bool
+        Will also save mean-binned preview pyramids (1/2, 1/4, ...) of the averages into the h5 file.
+    dark : np.ndarray or BL7011.darks.DarkLibrary
+        Dark frame subtracted from every frame, either of the full frame size or of the roi size, or a library of
+        master darks in which the dark is looked up by the count_time, detector temperature and date of the file.
+    dark_count_time : float
+        Exposure time in ms used to look up the master dark in a library. Broken bluesky files do not hold it (it
+        is recorded as the acquire_time of the camera in the .json file).
+    reducer : str
+        How the frames are averaged: "mean", or the cosmic-ray and hot pixel rejecting "median" or "sigma_clip"
+        (see BL7011.data_processing.reduce_stack).
+    sigma : float
+        Clipping threshold of "sigma_clip" in standard deviations.
+    register : bool
+        Corrects the drift between the frames of a position before averaging them, by aligning them with the first
+        frame of the position (see BL7011.registration.register_stack). Only with the "mean" reducer and average > 1.
+    binning : int
+        Sums blocks of binning x binning pixels of the roi right after the frames are read (e.g., 2 or 4 for fast
+        survey runs), so that no full resolution float copies are made. The dark is binned alike.
+    lazy : bool
+        Returns the recorded frames within the roi as a BL7011.stack.DetectorStack instead, with the dark subtracted
+        while they are read. Nothing is averaged and the missing frames are not searched for, e.g., to inspect or
+        reduce the raw frames block-wise (stack.mean(axis=0), stack[10:20].std(axis=0), ...). Binning is not
+        supported for lazy stacks.
 
     Returns
     -------
-    data : np.array
-        Data as np.array.
+    data : np.array or BL7011.stack.DetectorStack
+        Data as np.array, or the lazy stack of the recorded frames.
+    shifts : np.array
+        Only if register is True: (positions, average, 2) shift trajectory (rows, columns) of the frames in pixels,
+        NaN for the missing frames.
     """
     # Plot function to determine the roi while importing and averging.
     if for_roi:
+        import matplotlib.pyplot as plt
+
         if isinstance(for_roi, bool):
             for_roi = 0
-        f = h5py.File(h5filename, "r")
-        data = np.array(f["entry"]["data"]["data"][for_roi, :, :])
-        f.close()
+        data, factor = read_preview(h5filename, "entry/data/data", max_pixels=512, index=for_roi)
         plt.figure()
-        plt.imshow(data)
+        # Show the preview in the pixel coordinates of the full frame
+        plt.imshow(
+            data,
+            extent=(-0.5, data.shape[1] * factor - 0.5, data.shape[0] * factor - 0.5, -0.5),
+        )
         return plt.show()
 
     if average == 0:
         raise ValueError("average can not be zero")
+    if reducer not in REDUCERS:
+        raise ValueError(f"Unknown reducer {reducer}, use one of {REDUCERS}")
+    if register and (average == 1 or reducer != "mean"):
+        raise ValueError("register needs average > 1 and the mean reducer")
+
+    if lazy:
+        if binning != 1:
+            raise ValueError("binning is not supported for lazy stacks")
+        if isinstance(dark, dk.DarkLibrary):
+            metadata = {} if dark_count_time is None else {"count_time": dark_count_time}
+            dark = dark.master_for(h5filename, **metadata)
+        stack = DetectorStack(h5filename, "entry/data/data")
+        return stack[:, roi[0] : roi[1], roi[2] : roi[3]].normalize(dark=dark)
+
+    import tqdm
 
     if len(missing_frames) == 0:
         # Find missing frames in the data
@@ -75,23 +134,29 @@ def import_broken_h5(
         print(f"{n_missing_frames} frames missing @  {missing_frames}")
         print("start reading and averaging ", h5filename)
 
-    # function to load in the frames
+    # The frames are read with read_direct into a single buffer of the raw dtype, which is reused for every
+    # position, and accumulated into the preallocated averages, so that a frame is converted only once on its way
+    # from the file to the averages
     def load_frames(frame_min, frame_max):
-        # Load frames from the h5 file within the specified range and ROI
-        f = h5py.File(h5filename, "r")
-        data = np.array(
-            f["entry"]["data"]["data"][
-                frame_min:frame_max, roi[0] : roi[1], roi[2] : roi[3]
-            ]
-        )
-        f.close()
+        # Load frames from the h5 file within the specified range and ROI into the buffer
+        n_frames = frame_max - frame_min
+        with ins.stage("import_functions.read"):
+            dataset.read_direct(
+                buffer,
+                np.s_[frame_min:frame_max, roi[0] : roi[1], roi[2] : roi[3]],
+                np.s_[:n_frames],
+            )
+            ins.add_bytes("import_functions.read", read=buffer[:n_frames].nbytes)
+        data = buffer[:n_frames]
+        if binning != 1:
+            with ins.stage("import_functions.bin"):
+                data = bin_frames(data, binning)
         return data
 
     # Open the h5 file to determine the number of recorded frames
-    f = h5py.File(h5filename, "r")
-    for_recorded_frames = np.array(f["entry"]["data"]["data"][:, :1, :1])
-    actual_frame_size = np.array(f["entry"]["data"]["data"][0, :, :]).shape
-    f.close()
+    with h5py.File(h5filename, "r") as f:
+        n_recorded_frames = f["entry"]["data"]["data"].shape[0]
+        actual_frame_size = f["entry"]["data"]["data"].shape[1:]
 
     # Adjust the roi if actual frame size is smaller than the provided roi and warn the user
     if actual_frame_size[0] < roi[1] - roi[0]:
@@ -107,8 +172,23 @@ def import_broken_h5(
             f"roi[2] and roi[3] adjusted to the actual frame size {actual_frame_size[1]} from the h5 file."
         )
 
+    # Bring the dark frame to the roi
+    if isinstance(dark, dk.DarkLibrary):
+        metadata = {} if dark_count_time is None else {"count_time": dark_count_time}
+        dark = dark.master_for(h5filename, **metadata)
+    if dark is not None and dark.shape == actual_frame_size:
+        dark = dark[roi[0] : roi[1], roi[2] : roi[3]]
+    elif dark is not None and dark.shape != (roi[1] - roi[0], roi[3] - roi[2]):
+        raise ValueError(
+            f"dark has the shape {dark.shape}, which is neither the frame size {actual_frame_size} nor the roi size"
+        )
+    if dark is not None and binning != 1:
+        dark = bin_frames(dark, binning)
+
+    # Shape of the (binned) averages
+    frame_shape = ((roi[1] - roi[0]) // binning, (roi[3] - roi[2]) // binning)
+
     # estimating the number of frames
-    n_recorded_frames = len(for_recorded_frames)
     intended_n_frames = n_recorded_frames + n_missing_frames
 
     if verbose:
@@ -126,7 +206,6 @@ def import_broken_h5(
             )
 
     # Initialize variables for averaging process
-    averages_list = []
     already_replaced, correction_in_round = 0, 0
 
     # Determine how many frames to correct in each round
@@ -134,60 +213,83 @@ def import_broken_h5(
     unique, counts = np.unique(to_correct, return_counts=True)
     to_correct = dict(zip(unique, counts))
 
-    if average == 1:
-        # Loop over the frames and perform averaging
-        for n in tqdm.tqdm(range(0, n_recorded_frames)):
-            if n in to_correct.keys():
-                averages_list.append(np.zeros((roi[1] - roi[0], roi[3] - roi[2])))
-                already_replaced += 1
-                if verbose:
-                    print(
-                        f"correction zero shape: {np.zeros((roi[1] - roi[0], roi[3] - roi[2])).shape}"
-                    )
-                temp_data = load_frames(
-                    frame_min=n * average,
-                    frame_max=((n + 1) * average),
-                )
-                if np.isnan(temp_data).any():
+    with h5py.File(h5filename, "r") as f:
+        dataset = f["entry"]["data"]["data"]
+
+        # Preallocate the averages and the read buffer. Single frames without binning are read directly into the
+        # averages, with HDF5 converting them to float while reading.
+        if average == 1:
+            n_averages = n_recorded_frames + sum(n < n_recorded_frames for n in to_correct.keys())
+        else:
+            n_averages = intended_n_frames // average
+        direct = average == 1 and binning == 1
+        averages = np.empty((n_averages,) + frame_shape)
+        buffer = np.empty((average, roi[1] - roi[0], roi[3] - roi[2]), dtype=dataset.dtype)
+        if register:
+            all_shifts = np.full((n_averages, average, 2), np.nan)
+
+        if average == 1:
+            # Loop over the frames and perform averaging
+            n_average = 0
+            for n in tqdm.tqdm(range(0, n_recorded_frames)):
+                if n in to_correct.keys():
+                    averages[n_average] = 0
+                    n_average += 1
+                    already_replaced += 1
+                    if verbose:
+                        print(f"correction zero shape: {averages[n_average - 1].shape}")
+                if direct:
+                    with ins.stage("import_functions.read"):
+                        dataset.read_direct(
+                            averages, np.s_[n : n + 1, roi[0] : roi[1], roi[2] : roi[3]], np.s_[n_average]
+                        )
+                        n_bytes = averages[n_average].size * dataset.dtype.itemsize
+                        ins.add_bytes("import_functions.read", read=n_bytes)
+                else:
+                    averages[n_average] = load_frames(frame_min=n, frame_max=n + 1)[0]
+                if dark is not None:
+                    with ins.stage("import_functions.dark"):
+                        averages[n_average] -= dark
+                if np.isnan(averages[n_average]).any():
                     w.warn(f"NaN values in the data at frame {n}")
-                averages_list.append(np.array(temp_data).squeeze())
-            else:
+                n_average += 1
+            if verbose:
+                print(f"shape of the data: {averages[-1].shape}")
+        else:
+            # Loop over the frames and perform averaging
+            for n in tqdm.tqdm(range(0, intended_n_frames // average)):
+                if n in to_correct.keys():
+                    correction_in_round = to_correct[n]
+                    if verbose:
+                        print(f"corrections in round {correction_in_round}")
+
                 temp_data = load_frames(
-                    frame_min=n * average,
-                    frame_max=((n + 1) * average),
+                    frame_min=n * average - already_replaced,
+                    frame_max=((n + 1) * average - already_replaced - correction_in_round),
                 )
-                if np.isnan(temp_data).any():
-                    w.warn(f"NaN values in the data at frame {n}")
-                averages_list.append(np.array(temp_data).squeeze())
-        if verbose:
-            print(f"shape of the data: {np.array(averages_list[-1]).shape}")
-    else:
-        # Loop over the frames and perform averaging
-        for n in tqdm.tqdm(range(0, intended_n_frames // average)):
-            if n in to_correct.keys():
-                correction_in_round = to_correct[n]
-                if verbose:
-                    print(f"corrections in round {correction_in_round}")
-
-            temp_data = load_frames(
-                frame_min=n * average - already_replaced,
-                frame_max=((n + 1) * average - already_replaced - correction_in_round),
-            )
 
-            if np.isnan(temp_data).any():
-                w.warn(f"NaN values in the data at frame {n}")
+                # Averaging the data frames, the dark is subtracted from the average (all reducers commute with it)
+                # except for the registration, which estimates the shifts of the dark subtracted frames
+                with ins.stage("import_functions.average"):
+                    if register:
+                        averages[n], shifts = register_stack(temp_data, reference=0, dark=dark)
+                        all_shifts[n, : len(shifts)] = shifts
+                    elif reducer == "mean":
+                        np.sum(temp_data, axis=0, dtype=float, out=averages[n])
+                        averages[n] /= len(temp_data)
+                    else:
+                        averages[n] = reduce_stack(temp_data, reducer, sigma=sigma)
+                if dark is not None and not register:
+                    with ins.stage("import_functions.dark"):
+                        averages[n] -= dark
 
-            # Averaging the data frames
-            temp_data = np.mean(temp_data, axis=0)
-            averages_list.append(temp_data)
-
-            if correction_in_round != 0:
-                already_replaced += correction_in_round
-            # Reset the correction counter in the round
-            correction_in_round = 0
+                if np.isnan(averages[n]).any():
+                    w.warn(f"NaN values in the data at frame {n}")
 
-    # Convert list to np.array.
-    averages = np.array(averages_list)
+                if correction_in_round != 0:
+                    already_replaced += correction_in_round
+                # Reset the correction counter in the round
+                correction_in_round = 0
 
     # Save to h5 if wanted
     if save_to_h5:
@@ -198,9 +300,16 @@ def import_broken_h5(
             cleaned_h5filename = h5filename.replace(".h5", "")
             save_to_filename = cleaned_h5filename + "_averages.h5"
 
-        output_h5file = h5py.File(save_to_filename, "w")
-        output_h5file.create_dataset("data", data=averages)
-        output_h5file.close()
+        with ins.stage("import_functions.write", written=averages.nbytes):
+            output_h5file = h5py.File(save_to_filename, "w")
+            output_h5file.create_dataset("data", data=averages)
+            if pyramid:
+                write_pyramid(output_h5file, "data", averages)
+            if register:
+                output_h5file.create_dataset("shifts", data=all_shifts)
+            if binning != 1:
+                output_h5file.create_dataset("binning", data=binning)
+            output_h5file.close()
 
     # Check if the number of replaced frames matches the missing frames
     if already_replaced != n_missing_frames:
@@ -210,4 +319,6 @@ def import_broken_h5(
         print("converted and averaged")
 
     # Return the averaged data
+    if register:
+        return averages, all_shifts
     return averages
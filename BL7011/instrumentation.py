@@ -0,0 +1,237 @@
+"""
+    This file contains a lightweight instrumentation layer for the processing
+    pipeline. The hot paths of the package are wrapped in named stages (e.g.,
+    "file_processing.read", "import_functions.average", "repair.write") which
+    record their wall time, call count and the bytes read and written.
+
+    The instrumentation is off by default. While it is off, entering a stage
+    only costs a function call, so the stages can stay in the production code.
+
+    Example
+    -------
+    from BL7011 import instrumentation as ins
+
+    with ins.profile("run_report.json") as report:
+        fp.batch_processing_dichroism(...)
+    print(report.summary())
+
+    Authors: Damian Günzing
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+_enabled = False
+_lock = threading.Lock()
+# Recorded statistics as stage name: [calls, wall time, bytes read, bytes written]
+_stats = {}
+# Returned by stage() while the instrumentation is off
+_NULL_STAGE = nullcontext()
+
+
+def enable() -> None:
+    """
+    Switches the instrumentation on.
+    """
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """
+    Switches the instrumentation off. Recorded statistics are kept.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    """
+    Returns True if the instrumentation is on.
+    """
+    return _enabled
+
+
+def reset() -> None:
+    """
+    Deletes all recorded statistics.
+    """
+    with _lock:
+        _stats.clear()
+
+
+def _record(name: str, wall: float = 0.0, read: int = 0, written: int = 0, calls: int = 0):
+    with _lock:
+        entry = _stats.setdefault(name, [0, 0.0, 0, 0])
+        entry[0] += calls
+        entry[1] += wall
+        entry[2] += read
+        entry[3] += written
+
+
+def add_bytes(name: str, read: int = 0, written: int = 0) -> None:
+    """
+    Adds bytes read and/or written to a stage, e.g., once the size of the data
+    is known inside the stage. Does nothing while the instrumentation is off.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    read : int
+        Number of bytes read.
+    written : int
+        Number of bytes written.
+    """
+    if _enabled:
+        _record(name, read=read, written=written)
+
+
+@contextmanager
+def _timed_stage(name: str, read: int, written: int):
+    time_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - time_start, read, written, calls=1)
+
+
+def stage(name: str, read: int = 0, written: int = 0):
+    """
+    Context manager that records the wall time of a stage of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, by convention "<module>.<stage>".
+    read : int
+        Number of bytes read within the stage, if known beforehand.
+    written : int
+        Number of bytes written within the stage, if known beforehand.
+
+    Returns
+    -------
+    context manager
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _timed_stage(name, read, written)
+
+
+def timed(name: str):
+    """
+    Decorator that records every call of a function as a stage.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, by convention "<module>.<function>".
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _timed_stage(name, 0, 0):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Report:
+    """
+    Snapshot of the recorded statistics of all stages.
+    """
+
+    def __init__(self, stats: dict, wall_total: float = None):
+        self.stats = stats
+        self.wall_total = wall_total
+
+    def to_dict(self) -> dict:
+        """
+        Returns the statistics as a dictionary of stage name: {calls, wall_s,
+        bytes_read, bytes_written, mb_per_s}, where mb_per_s is the sum of
+        bytes read and written per wall time of the stage.
+        """
+        stages = {}
+        for name, (calls, wall, read, written) in sorted(self.stats.items()):
+            stages[name] = {
+                "calls": calls,
+                "wall_s": wall,
+                "bytes_read": read,
+                "bytes_written": written,
+                "mb_per_s": (read + written) / 2**20 / wall if wall > 0 else 0.0,
+            }
+        return {"wall_total_s": self.wall_total, "stages": stages}
+
+    def to_json(self, path_file: str) -> None:
+        """
+        Writes the report to a JSON file.
+        """
+        with open(path_file, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def summary(self) -> str:
+        """
+        Returns the report as a table, sorted by wall time.
+        """
+        stages = self.to_dict()["stages"]
+        lines = [
+            f"{'stage':<40} {'calls':>8} {'wall [s]':>10} {'read [MB]':>10} "
+            f"{'written [MB]':>12} {'MB/s':>8}"
+        ]
+        for name, entry in sorted(stages.items(), key=lambda item: -item[1]["wall_s"]):
+            lines.append(
+                f"{name:<40} {entry['calls']:>8} {entry['wall_s']:>10.3f} "
+                f"{entry['bytes_read'] / 2**20:>10.1f} "
+                f"{entry['bytes_written'] / 2**20:>12.1f} {entry['mb_per_s']:>8.1f}"
+            )
+        if self.wall_total is not None:
+            lines.append(f"total wall time: {self.wall_total:.3f} s")
+        return "\n".join(lines)
+
+
+def report() -> Report:
+    """
+    Returns a snapshot of the statistics recorded so far.
+    """
+    with _lock:
+        return Report({name: list(entry) for name, entry in _stats.items()})
+
+
+@contextmanager
+def profile(path_json: str = None, verbose: bool = False):
+    """
+    Context manager that switches the instrumentation on for its body and
+    yields a Report which is filled in when the body is left. The previous
+    state of the instrumentation is restored afterwards.
+
+    Parameters
+    ----------
+    path_json : str
+        If given, the report is also written to this JSON file.
+    verbose : bool
+        Prints the summary table when the body is left.
+    """
+    was_enabled = _enabled
+    reset()
+    enable()
+    result = Report({})
+    time_start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        if not was_enabled:
+            disable()
+        snapshot = report()
+        result.stats = snapshot.stats
+        result.wall_total = time.perf_counter() - time_start
+        if path_json is not None:
+            result.to_json(path_json)
+        if verbose:
+            print(result.summary())
@@ -0,0 +1,150 @@
+"""
+    This file contains functions to keep a manifest of processed data files,
+    similar to a build system. For every output the manifest records the
+    identities of the input files and the processing parameters, so that
+    reruns of a batch only recompute the outputs which are out of date.
+
+    Authors: Damian Günzing
+"""
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = ".bl7011_manifest.json"
+
+
+def file_identity(path_file: str, method: str = "mtime") -> dict:
+    """
+    Returns the identity of a file used to decide if an output built from it
+    is out of date.
+
+    Parameters
+    ----------
+    path_file : str
+        Whole path of the file.
+    method : str
+        - 'mtime': path, size and modification time (fast)
+        - 'hash': path, size and the sha256 hash of the content (robust
+          against copies that change the modification time)
+
+    Returns
+    -------
+    identity : dict
+        The identity of the file.
+    """
+    stat = os.stat(path_file)
+    identity = {"path": os.path.abspath(path_file), "size": stat.st_size}
+    if method == "mtime":
+        identity["mtime"] = stat.st_mtime_ns
+    elif method == "hash":
+        sha = hashlib.sha256()
+        with open(path_file, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                sha.update(block)
+        identity["sha256"] = sha.hexdigest()
+    else:
+        raise ValueError("method has to be 'mtime' or 'hash'")
+    return identity
+
+
+def load_manifest(path_dir: str) -> dict:
+    """
+    Loads the manifest of a directory. An empty manifest is returned if the
+    directory has none yet.
+
+    Parameters
+    ----------
+    path_dir : str
+        Pathname of the directory which contains the processed files.
+
+    Returns
+    -------
+    manifest : dict
+        Dictionary of output file name: {"inputs": [...], "params": {...}}.
+    """
+    path_manifest = os.path.join(path_dir, MANIFEST_NAME)
+    if not os.path.isfile(path_manifest):
+        return {}
+    with open(path_manifest, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(path_dir: str, manifest: dict) -> None:
+    """
+    Writes the manifest of a directory. The file is replaced atomically so
+    that an interrupted batch never leaves a broken manifest behind.
+
+    Parameters
+    ----------
+    path_dir : str
+        Pathname of the directory which contains the processed files.
+    manifest : dict
+        The manifest as returned by load_manifest.
+    """
+    path_manifest = os.path.join(path_dir, MANIFEST_NAME)
+    with open(path_manifest + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path_manifest + ".tmp", path_manifest)
+
+
+def is_up_to_date(
+    manifest: dict,
+    output: str,
+    inputs: list[str],
+    params: dict,
+    method: str = "mtime",
+) -> bool:
+    """
+    Checks if an output file exists and was built from the same input files
+    with the same processing parameters.
+
+    Parameters
+    ----------
+    manifest : dict
+        The manifest as returned by load_manifest.
+    output : str
+        Whole path of the output file.
+    inputs : list[str]
+        Whole paths of the input files.
+    params : dict
+        Processing parameters of the output (must be JSON serializable).
+    method : str
+        How the identity of the input files is determined, see file_identity.
+
+    Returns
+    -------
+    up_to_date : bool
+        False if the output has to be recomputed.
+    """
+    entry = manifest.get(os.path.basename(output))
+    if entry is None or not os.path.isfile(output):
+        return False
+    if entry["params"] != params:
+        return False
+    try:
+        identities = [file_identity(path, method) for path in inputs]
+    except FileNotFoundError:
+        return False
+    return entry["inputs"] == identities
+
+
+def record(
+    manifest: dict,
+    output: str,
+    inputs: list[str],
+    params: dict,
+    method: str = "mtime",
+) -> None:
+    """
+    Records an output file with the identities of its input files and its
+    processing parameters in the manifest.
+
+    Parameters
+    ----------
+    manifest, output, inputs, params, method :
+        See is_up_to_date.
+    """
+    manifest[os.path.basename(output)] = {
+        "inputs": [file_identity(path, method) for path in inputs],
+        "params": params,
+    }
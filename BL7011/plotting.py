@@ -3,15 +3,128 @@
 
     Authors: Dayne Sasaki, Damian Guenzing
 """
+import weakref
 import numpy as np
+import h5py
+from BL7011.pyramid import read_preview
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Display percentiles already estimated for an image, stored as
+# (id(image), percentiles): (weak reference to the image, fingerprint of the
+# subsample, values)
+_percentile_cache = {}
+
+# Figures which are reused between calls of the plot functions, stored as
+# function name: (figure, axes, images)
+_figure_cache = {}
+
+
+def display_percentiles(
+        image: np.ndarray,
+        percentiles: tuple,
+        *,
+        max_samples: int = 2**16
+) -> np.ndarray:
+    """
+    Estimates percentiles of an image for setting the color limits of a plot.
+
+    Instead of partitioning all pixels, the percentiles are calculated from a
+    regular strided subsample with about max_samples pixels, which is
+    accurate to well below the resolution of a colormap. The result is
+    cached per image (as long as the image exists) together with a hash of
+    the subsample, so repeated calls with the same array only hash the
+    subsample, while an image modified in place (e.g., a reused buffer) gets
+    new percentiles.
+
+    Parameters:
+        image: np.ndarray
+            A M x N image
+        percentiles: tuple
+            The percentiles to estimate (0 - 100)
+        max_samples: int
+            Approximate number of pixels used for the estimate
+
+    Returns:
+        np.ndarray of the estimated percentiles
+    """
+    # Take every step-th pixel along both axes
+    step = max(1, int(np.ceil(np.sqrt(image.size / max_samples))))
+    sample = image[::step, ::step]
+    fingerprint = hash(sample.tobytes())
+
+    key = (id(image), tuple(percentiles))
+    cached = _percentile_cache.get(key)
+    if cached is not None and cached[0]() is image \
+            and cached[1] == fingerprint:
+        return cached[2]
+
+    values = np.percentile(sample, percentiles)
+
+    # Drop the entry as soon as the image is garbage collected
+    try:
+        reference = weakref.ref(
+            image, lambda _, key=key: _percentile_cache.pop(key, None))
+        _percentile_cache[key] = (reference, fingerprint, values)
+    except TypeError:
+        pass
+
+    return values
+
+
+def downsample_for_display(
+        image: np.ndarray,
+        max_pixels: int
+) -> tuple[np.ndarray, tuple]:
+    """
+    Reduces an image by averaging blocks of factor x factor pixels, such
+    that neither side is larger than max_pixels. Showing more pixels than the
+    axes have on the screen only costs rendering time.
+
+    Parameters:
+        image: np.ndarray
+            A M x N image
+        max_pixels: int
+            Maximum number of pixels along each side of the displayed image
+
+    Returns:
+        (image, extent): tuple
+            The reduced image and the extent to pass to imshow, so that the
+            axes still show the pixel coordinates of the original image
+    """
+    factor = int(np.ceil(max(image.shape) / max(max_pixels, 1)))
+    if factor <= 1:
+        return image, (-0.5, image.shape[1] - 0.5, -0.5, image.shape[0] - 0.5)
+
+    # Leave out the rows and columns which do not fill a whole block
+    rows = image.shape[0] // factor * factor
+    cols = image.shape[1] // factor * factor
+    extent = (-0.5, cols - 0.5, -0.5, rows - 0.5)
+    reduced = image[:rows, :cols].reshape(
+        rows // factor, factor, cols // factor, factor).mean(axis=(1, 3))
+    return reduced, extent
+
+
+def _detector_extent(extent: tuple, binning: int) -> tuple:
+    # Extent of a binned image in the pixel coordinates of the detector
+    return tuple((edge + 0.5) * binning - 0.5 for edge in extent)
+
+
+def _axes_pixels(ax) -> int:
+    # Size in screen pixels of the larger side of the axes
+    bbox = ax.get_window_extent()
+    return max(64, int(np.ceil(max(bbox.width, bbox.height))))
 
 
 def plot_image(
         image: np.ndarray,
         *,
-        title: str = ''
+        title: str = '',
+        decimate: bool = True,
+        reuse_figure: bool = False,
+        binning: int = 1
 ) -> None:
     """
     Plots a single CCD image. What more could you want?
@@ -24,19 +137,41 @@ def plot_image(
             A M x N CCD image.
         title: str
             Title of the figure
+        decimate: bool
+            Averages the image down to the pixel resolution of the axes
+            before showing it
+        reuse_figure: bool
+            Updates the figure of the previous call (if it is still open)
+            instead of creating a new one
+        binning: int
+            Binning the image was read with, so that the axes show the
+            pixel coordinates of the detector
 
     Returns:
         None. It shows a matplotlib figure.
     """
-    # Generate a figure with three side-by-side subplots
-    # TODO: Generalize this function so that multiple images can
-    #   be plotted at the same time
-    fig, axarr = plt.subplots(nrows=1, ncols=1, layout='constrained',
-                              figsize=(11, 3))
+    # Intensity scaling from a subsample of the image
+    vmin, vmax = display_percentiles(image, (5, 95))
+
+    cached = _figure_cache.get('plot_image') if reuse_figure else None
+    if cached is not None and plt.fignum_exists(cached[0].number):
+        fig, axarr, (im,) = cached
+    else:
+        # Generate a figure with three side-by-side subplots
+        # TODO: Generalize this function so that multiple images can
+        #   be plotted at the same time
+        fig, axarr = plt.subplots(nrows=1, ncols=1, layout='constrained',
+                                  figsize=(11, 3))
+
+        axarr.set_box_aspect(aspect=1)
+        im = None
 
-    axarr.set_box_aspect(aspect=1)
     axarr.set_title(title)
 
+    displayed, extent = downsample_for_display(
+        image, _axes_pixels(axarr) if decimate else max(image.shape))
+    extent = _detector_extent(extent, binning)
+
     # Show the images
     """
     im = axarr.imshow(image,
@@ -45,13 +180,21 @@ def plot_image(
                       norm=LogNorm(vmin=np.percentile(image, 5),
                                       vmax=np.percentile(image, 95)))
     """
-    im = axarr.imshow(image,
-                      cmap='viridis',
-                      origin='lower',
-                      vmin=np.percentile(image, 5),
-                      vmax=np.percentile(image, 95))
+    if im is None:
+        im = axarr.imshow(displayed,
+                          cmap='viridis',
+                          origin='lower',
+                          extent=extent,
+                          vmin=vmin,
+                          vmax=vmax)
+        fig.colorbar(im, ax=axarr)
+        if reuse_figure:
+            _figure_cache['plot_image'] = (fig, axarr, (im,))
+    else:
+        im.set_data(displayed)
+        im.set_extent(extent)
+        im.set_clim(vmin, vmax)
 
-    fig.colorbar(im, ax=axarr)
     plt.draw()
     plt.pause(0.001)
 
@@ -66,19 +209,27 @@ def plot_three_images_dichroism(
         title_2: str = '',
         title_3: str = '',
         save_path: str = None,
+        decimate: bool = True,
+        reuse_figure: bool = False,
+        binning: int = 1
 ) -> None:
     """
     Plots three images side-by-side. The intensity scaling of the left and
-    center images are based on their respective 5th and 95th percentile
-    intensities and are shown using a logarithmic viridis colormap. The right
-    image intensity is scaled based on either the 15th or 85th-percentile
-    intensity magnitude. Whichever one is larger will define how the scaling
-    where the intensity will vary from +- that intensity. The right image
-    is shown in bwr colormap
+    center images are based on the 5th and 95th percentile intensities of
+    the left image and are shown using a logarithmic viridis colormap. The
+    right image intensity is scaled based on either the 15th or
+    85th-percentile intensity magnitude. Whichever one is larger will define
+    how the scaling where the intensity will vary from +- that intensity.
+    The right image is shown in bwr colormap
 
     This function is intended to show two different polarization CCD images
     along with the associated dichroism image by its side.
 
+    The percentiles are estimated from a subsample of each image (see
+    display_percentiles) and the images are averaged down to the pixel
+    resolution of the axes before they are shown. For batches, reuse_figure
+    keeps updating one figure instead of building a new one per call.
+
     Parameters:
         image_1 through image_3: np.ndarray
             The three different M x N images. For plotting polarization and
@@ -92,6 +243,15 @@ def plot_three_images_dichroism(
         save_path: str
             If a save path is given, then the figure will be saved to that
             directory with the associated file name.
+        decimate: bool
+            Averages the images down to the pixel resolution of the axes
+            before showing them
+        reuse_figure: bool
+            Updates the figure of the previous call (if it is still open)
+            instead of creating a new one
+        binning: int
+            Binning the images were read with, so that the axes show the
+            pixel coordinates of the detector
 
     Returns:
         None
@@ -102,14 +262,31 @@ def plot_three_images_dichroism(
     plt.ion()
     plt.show()
 
-    # Generate a figure with three side-by-side subplots
-    fig, axarr = plt.subplots(nrows=1, ncols=3, layout='constrained',
-                              figsize=(11, 3))
+    # Intensity scaling of the polarization images, both use the limits of
+    # image_1
+    vmin_1, vmax_1 = display_percentiles(image_1, (5, 95))
 
-    # Iteratively modify the axes to have aspect ratios of 1
-    axarr[0].set_box_aspect(aspect=1)
-    axarr[1].set_box_aspect(aspect=1)
-    axarr[2].set_box_aspect(aspect=1)
+    # Figure out what the largest magnitude pixel in image_3 is for
+    # setting the color limit in dichroism
+    intensity_max, intensity_min = np.absolute(
+        display_percentiles(image_3, (15, 85)))
+    # Set the color limit of the image
+    image_3_climit = max(intensity_max, intensity_min)
+
+    cached = _figure_cache.get('plot_three_images_dichroism') \
+        if reuse_figure else None
+    if cached is not None and plt.fignum_exists(cached[0].number):
+        fig, axarr, images = cached
+    else:
+        # Generate a figure with three side-by-side subplots
+        fig, axarr = plt.subplots(nrows=1, ncols=3, layout='constrained',
+                                  figsize=(11, 3))
+
+        # Iteratively modify the axes to have aspect ratios of 1
+        axarr[0].set_box_aspect(aspect=1)
+        axarr[1].set_box_aspect(aspect=1)
+        axarr[2].set_box_aspect(aspect=1)
+        images = None
 
     # Generate the titles
     fig.suptitle(title_main)
@@ -117,32 +294,47 @@ def plot_three_images_dichroism(
     axarr[1].set_title(title_2)
     axarr[2].set_title(title_3)
 
-    # Figure out what the largest magnitude pixel in image_3 is for
-    # setting the color limit in dichroism
-    intensity_max = np.absolute(np.percentile(image_3, 15))
-    intensity_min = np.absolute(np.percentile(image_3, 85))
-    # Set the color limit of the image
-    image_3_climit = max(intensity_max, intensity_min)
+    # Reduce the images to the resolution of the axes
+    displayed = [downsample_for_display(
+        image, _axes_pixels(ax) if decimate else max(image.shape))
+        for image, ax in zip((image_1, image_2, image_3), axarr)]
+    displayed = [(data, _detector_extent(extent, binning))
+                 for data, extent in displayed]
+
+    if images is None:
+        # Show the images
+        im1 = axarr[0].imshow(displayed[0][0],
+                              cmap='viridis',
+                              origin='lower',
+                              extent=displayed[0][1],
+                              norm=LogNorm(vmin=vmin_1, vmax=vmax_1))
+        im2 = axarr[1].imshow(displayed[1][0],
+                              cmap='viridis',
+                              origin='lower',
+                              extent=displayed[1][1],
+                              norm=LogNorm(vmin=vmin_1, vmax=vmax_1))
+        im3 = axarr[2].imshow(displayed[2][0], cmap='bwr',
+                              vmin=-image_3_climit,
+                              vmax=image_3_climit,
+                              extent=displayed[2][1],
+                              origin='lower')
+
+        fig.colorbar(im1, ax=axarr[0])
+        fig.colorbar(im2, ax=axarr[1])
+        fig.colorbar(im3, ax=axarr[2])
+
+        if reuse_figure:
+            _figure_cache['plot_three_images_dichroism'] = \
+                (fig, axarr, (im1, im2, im3))
+    else:
+        # Update the images of the previous call
+        climits = ((vmin_1, vmax_1), (vmin_1, vmax_1),
+                   (-image_3_climit, image_3_climit))
+        for im, (data, extent), clim in zip(images, displayed, climits):
+            im.set_data(data)
+            im.set_extent(extent)
+            im.set_clim(*clim)
 
-    # Show the images
-    im1 = axarr[0].imshow(image_1,
-                          cmap='viridis',
-                          origin='lower',
-                          norm=LogNorm(vmin=np.percentile(image_1, 5),
-                                       vmax=np.percentile(image_1, 95)))
-    im2 = axarr[1].imshow(image_2,
-                          cmap='viridis',
-                          origin='lower',
-                          norm=LogNorm(vmin=np.percentile(image_1, 5),
-                                       vmax=np.percentile(image_1, 95)))
-    im3 = axarr[2].imshow(image_3, cmap='bwr',
-                          vmin=-image_3_climit,
-                          vmax=image_3_climit,
-                          origin='lower')
-
-    fig.colorbar(im1, ax=axarr[0])
-    fig.colorbar(im2, ax=axarr[1])
-    fig.colorbar(im3, ax=axarr[2])
     # Trick 2: call plt.draw() and wait a little while
     plt.draw()
     plt.pause(0.001)
@@ -150,3 +342,196 @@ def plot_three_images_dichroism(
     # If save_path has been defined, then save the figure
     if save_path is not None:
         fig.savefig(save_path)
+
+
+def plot_processed_file(
+        path_file: str,
+        *,
+        max_pixels: int = 512,
+        save_path: str = None,
+        reuse_figure: bool = False
+) -> None:
+    """
+    Plots the polarization and dichroism images of a processed data file
+    (processed_XCD_*.h5 or processed_XLD_*.h5) written by
+    batch_processing_dichroism.
+
+    Only the coarsest level of the preview pyramid that fits the display is
+    read (see BL7011.pyramid.read_preview). Files without a pyramid are read
+    with a stride.
+
+    Parameters:
+        path_file: str
+            Path name of the processed data file
+        max_pixels: int
+            Number of pixels of the display along the larger image side
+        save_path: str
+            If a save path is given, then the figure will be saved to that
+            directory with the associated file name.
+        reuse_figure: bool
+            Updates the figure of the previous call (if it is still open)
+            instead of creating a new one
+
+    Returns:
+        None
+    """
+    image_1, factor = read_preview(path_file, 'pol_a/image', max_pixels)
+    image_2, _ = read_preview(path_file, 'pol_b/image', max_pixels)
+    image_3, _ = read_preview(path_file, 'process/image_dichro', max_pixels)
+
+    # Show the detector pixels of previews of (binned) images
+    with h5py.File(path_file, 'r') as h5_file:
+        binning = int(h5_file['process/binning'][()]) \
+            if 'process/binning' in h5_file else 1
+
+    # Name the images by the type of dichroism in the file name
+    if 'XLD' in path_file:
+        titles = ('HLP', 'VLP', 'XLD')
+    else:
+        titles = ('RCP', 'LCP', 'XCD')
+
+    plot_three_images_dichroism(image_1, image_2, image_3,
+                                title_main=path_file,
+                                title_1=titles[0],
+                                title_2=titles[1],
+                                title_3=titles[2],
+                                save_path=save_path,
+                                decimate=False,
+                                reuse_figure=reuse_figure,
+                                binning=binning * factor)
+
+
+def plot_contact_sheet(
+        sources: list,
+        *,
+        sort_by: str | tuple[str] = (),
+        image_path: str = 'process/image_dichro',
+        scaling: str = 'symmetric',
+        tile_pixels: int = 64,
+        n_cols: int = None,
+        labels: bool = True,
+        save_path: str = None
+) -> Figure:
+    """
+    Renders a contact sheet of many images (e.g., the dichroism images of a
+    whole campaign) as thumbnails on a grid in a single figure.
+
+    The thumbnails are read from the preview pyramids of the processed data
+    files (see BL7011.pyramid.read_preview), scaled individually and combined
+    into one mosaic image, so the figure only holds a single image
+    regardless of the number of panels. The figure is drawn with the Agg
+    backend independently of pyplot, so no interactive session is needed.
+
+    Parameters:
+        sources: list
+            Processed data files (path names, see batch_processing_dichroism)
+            and/or in-memory results as dictionaries with the M x N image
+            under 'image' and the metadata as further entries,
+            e.g., {'image': im_XCD, 'beamline_energy': 707.5}
+        sort_by: str or tuple[str]
+            Metadata keys (e.g., 'beamline_energy', 'detector_rotate') to
+            sort the thumbnails by. For files, the metadata is read from the
+            'pol_a' group. The values are shown below each thumbnail.
+        image_path: str
+            Dataset of the image within the processed data files
+        scaling: str
+            How each thumbnail is scaled to the colormap
+            - 'symmetric': +- the larger magnitude of the 15th and 85th
+                           percentile, bwr colormap (for dichroism images)
+            - 'log': logarithmic between the 5th and 95th percentile,
+                     viridis colormap (for polarization images)
+        tile_pixels: int
+            Edge length in pixels of each thumbnail
+        n_cols: int
+            Number of thumbnails per row. By default the grid is square.
+        labels: bool
+            Writes the sort_by values below each thumbnail
+        save_path: str
+            If a save path is given, then the figure will be saved to that
+            directory with the associated file name (e.g., a large PNG).
+
+    Returns:
+        fig: matplotlib.figure.Figure
+            The contact sheet
+    """
+    if isinstance(sort_by, str):
+        sort_by = (sort_by,)
+    if scaling not in ('symmetric', 'log'):
+        raise ValueError('scaling has to be symmetric or log')
+
+    # Gather the metadata to sort by
+    metadata = []
+    for source in sources:
+        if isinstance(source, dict):
+            metadata.append(tuple(float(source.get(key, np.nan))
+                                  for key in sort_by))
+        else:
+            with h5py.File(source, 'r') as h5_file:
+                metadata.append(tuple(
+                    float(h5_file['pol_a'][key][()])
+                    if key in h5_file['pol_a'] else np.nan
+                    for key in sort_by))
+    order = sorted(range(len(sources)), key=lambda idx: metadata[idx])
+
+    n_panels = len(sources)
+    n_cols = n_cols or max(1, int(np.ceil(np.sqrt(n_panels))))
+    n_rows = max(1, int(np.ceil(n_panels / n_cols)))
+
+    # Every row of thumbnails is followed by a strip for the labels. Empty
+    # space in the mosaic is NaN (not drawn)
+    label_pixels = 12 if labels and sort_by else 0
+    row_pixels = tile_pixels + label_pixels
+    mosaic = np.full((n_rows * row_pixels, n_cols * tile_pixels), np.nan)
+
+    for position, idx in enumerate(order):
+        source = sources[idx]
+        if isinstance(source, dict):
+            thumbnail = np.asarray(source['image'], dtype=float)
+        else:
+            thumbnail, _ = read_preview(source, image_path, tile_pixels)
+        thumbnail, _ = downsample_for_display(thumbnail, tile_pixels)
+
+        # Scale every thumbnail to [0, 1] on its own
+        if scaling == 'symmetric':
+            climit = np.max(np.absolute(display_percentiles(thumbnail,
+                                                            (15, 85))))
+            thumbnail = (thumbnail / max(climit, np.finfo(float).tiny)
+                         + 1) / 2
+        else:
+            vmin, vmax = display_percentiles(thumbnail, (5, 95))
+            vmin = max(vmin, np.finfo(float).tiny)
+            vmax = max(vmax, vmin * (1 + 1e-9))
+            thumbnail = np.log(np.clip(thumbnail, vmin, None) / vmin) \
+                / np.log(vmax / vmin)
+
+        row, col = divmod(position, n_cols)
+        mosaic[row * row_pixels:row * row_pixels + thumbnail.shape[0],
+               col * tile_pixels:col * tile_pixels + thumbnail.shape[1]] = \
+            np.clip(thumbnail, 0, 1)
+
+    # Build the figure without pyplot, with one screen pixel per mosaic pixel
+    dpi = 100
+    fig = Figure(figsize=(mosaic.shape[1] / dpi, mosaic.shape[0] / dpi),
+                 dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes((0, 0, 1, 1))
+    ax.set_axis_off()
+    ax.imshow(mosaic,
+              cmap='bwr' if scaling == 'symmetric' else 'viridis',
+              vmin=0, vmax=1,
+              interpolation='nearest',
+              aspect='auto')
+
+    # Write the metadata values below each thumbnail
+    if label_pixels:
+        for position, idx in enumerate(order):
+            row, col = divmod(position, n_cols)
+            ax.text(col * tile_pixels + tile_pixels / 2,
+                    row * row_pixels + tile_pixels + label_pixels / 2,
+                    ', '.join(f'{value:g}' for value in metadata[idx]),
+                    ha='center', va='center', fontsize=6)
+
+    if save_path is not None:
+        fig.savefig(save_path)
+
+    return fig
@@ -0,0 +1,164 @@
+"""
+    This file contains functions to store and read multi-resolution preview
+    pyramids of CCD images. A pyramid holds the mean-binned versions (1/2,
+    1/4, 1/8, ...) of an image or image stack next to the full resolution
+    dataset, so that previews only have to read a small fraction of the data.
+
+    A pyramid of the dataset "<path>" is stored in the group "<path>_pyramid"
+    with one dataset per binning factor, named by the factor ("2", "4", ...).
+
+    Authors: Damian Günzing
+"""
+import h5py
+import numpy as np
+
+PYRAMID_SUFFIX = "_pyramid"
+
+
+def bin_image(image: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Mean-bins the last two axes of an image or image stack by a factor.
+    Rows and columns which do not fill a whole bin are left out.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        A (..., M, N) image or image stack.
+    factor : int
+        Binning factor along both axes.
+
+    Returns
+    -------
+    binned : np.ndarray
+        The (..., M // factor, N // factor) binned image.
+    """
+    if factor == 1:
+        return image
+    rows = image.shape[-2] // factor
+    cols = image.shape[-1] // factor
+    cropped = image[..., : rows * factor, : cols * factor]
+    return cropped.reshape(
+        image.shape[:-2] + (rows, factor, cols, factor)
+    ).mean(axis=(-3, -1))
+
+
+def build_pyramid(image: np.ndarray, min_size: int = 32) -> dict[int, np.ndarray]:
+    """
+    Builds the preview pyramid of an image or image stack. Each level is
+    mean-binned by 2 from the previous one, until the smaller side of the
+    image would drop below min_size pixels.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        A (..., M, N) image or image stack.
+    min_size : int
+        Minimum number of pixels along the smaller side of the coarsest level.
+
+    Returns
+    -------
+    pyramid : dict[int, np.ndarray]
+        Dictionary of binning factor: binned image.
+    """
+    pyramid = {}
+    level = np.asarray(image, dtype=float)
+    factor = 1
+    while min(level.shape[-2:]) // 2 >= min_size:
+        level = bin_image(level, 2)
+        factor *= 2
+        pyramid[factor] = level
+    return pyramid
+
+
+def write_pyramid(
+    h5_group: h5py.Group, name: str, image: np.ndarray, min_size: int = 32
+) -> None:
+    """
+    Writes the preview pyramid of an image or image stack next to its full
+    resolution dataset. Stacks are chunked per image so that a single image
+    of a level can be read on its own.
+
+    Parameters
+    ----------
+    h5_group : h5py.Group
+        The group (or open file) that contains the full resolution dataset.
+    name : str
+        Name of the full resolution dataset within h5_group.
+    image : np.ndarray
+        The full resolution (..., M, N) image or image stack.
+    min_size : int
+        Minimum number of pixels along the smaller side of the coarsest level.
+    """
+    g_pyramid = h5_group.require_group(name + PYRAMID_SUFFIX)
+    for factor, level in build_pyramid(image, min_size).items():
+        chunks = (1,) * (level.ndim - 2) + level.shape[-2:] if level.ndim > 2 else None
+        dataset = g_pyramid.create_dataset(
+            str(factor), data=level.astype(np.float32), chunks=chunks
+        )
+        dataset.attrs["factor"] = factor
+
+
+def pyramid_factors(h5_file: h5py.File, dataset_path: str) -> list[int]:
+    """
+    Returns the binning factors of the pyramid stored for a dataset, sorted
+    from fine to coarse. An empty list is returned if there is no pyramid.
+    """
+    group_path = dataset_path + PYRAMID_SUFFIX
+    if group_path not in h5_file:
+        return []
+    return sorted(int(factor) for factor in h5_file[group_path].keys())
+
+
+def read_preview(
+    path_file: str,
+    dataset_path: str,
+    max_pixels: int = 512,
+    index: int | tuple = None,
+) -> tuple[np.ndarray, int]:
+    """
+    Reads a preview of an image (or of one image of a stack) that is just
+    large enough for a display of max_pixels pixels.
+
+    The coarsest pyramid level whose larger side still has at least
+    max_pixels pixels is read. If the file has no pyramid for the dataset,
+    the full resolution dataset is read with a stride instead, which still
+    avoids holding the full image in memory.
+
+    Parameters
+    ----------
+    path_file : str
+        Whole path of the .h5 file.
+    dataset_path : str
+        Path of the full resolution dataset within the file, e.g.,
+        "process/image_dichro" or "entry/data/data".
+    max_pixels : int
+        Number of pixels of the display along the larger side.
+    index : int or tuple
+        Index of the image within an image stack. None reads everything.
+
+    Returns
+    -------
+    (preview, factor) : tuple
+        The preview image and the binning factor relative to full resolution.
+    """
+    index = () if index is None else index
+    with h5py.File(path_file, "r") as h5_file:
+        full_shape = h5_file[dataset_path].shape[-2:]
+
+        # Coarsest level that is still at least as large as the display
+        factor = 1
+        for level_factor in pyramid_factors(h5_file, dataset_path):
+            if max(full_shape) // level_factor >= max_pixels:
+                factor = level_factor
+
+        if factor > 1:
+            group = h5_file[dataset_path + PYRAMID_SUFFIX]
+            return group[str(factor)][index], factor
+
+        # Without a pyramid, read every step-th pixel of the full image
+        step = max(1, max(full_shape) // max_pixels)
+        dataset = h5_file[dataset_path]
+        index = index if isinstance(index, tuple) else (index,)
+        n_lead = dataset.ndim - 2 - len(index)
+        preview = dataset[index + (slice(None),) * n_lead + (slice(None, None, step),) * 2]
+        return preview, step
@@ -0,0 +1,316 @@
+"""
+    This file contains functions to assemble the detector images of angle
+    scans (sample_rotate_steppertheta, detector_rotate or theta2thetaboth)
+    into a 3D reciprocal space map.
+
+    Every pixel of every frame is converted to its momentum transfer
+    (qx, qy, qz) in the frame of the sample, and the intensities and the
+    number of contributing pixels are accumulated into a regular 3D grid
+    with np.bincount. The files are streamed one image at a time; with
+    several workers, each process grids its share of the files into its own
+    partial grid and the partial grids are summed at the end.
+
+    Geometry: the beam travels along +x, the detector arm (two_theta) and
+    the sample (theta) rotate about y. At theta = 0 the sample surface is
+    the x-y plane, so that a specular reflection (two_theta = 2 theta) has
+    its momentum transfer along qz. The detector rows lie in the scattering
+    plane, the columns along y.
+
+    Authors: Damian Günzing
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import h5py
+import numpy as np
+from BL7011 import instrumentation as ins
+from BL7011.tools import frames_per_block
+
+# hc in eV Angstrom, to convert the photon energy to the wave number in 1/A
+HC_EV_ANGSTROM = 12398.419843
+
+
+def pixel_q(
+    frame_shape: tuple[int, int],
+    two_theta: float,
+    theta: float,
+    energy: float,
+    *,
+    distance: float,
+    pixel_size: float | tuple[float, float],
+    center: tuple[float, float] = None,
+) -> np.ndarray:
+    """
+    Momentum transfer of every pixel of a frame in the frame of the sample.
+
+    Parameters
+    ----------
+    frame_shape : tuple[int, int]
+        Shape (M, N) of the frame.
+    two_theta : float
+        Angle of the detector arm in degrees.
+    theta : float
+        Angle of the sample in degrees.
+    energy : float
+        Photon energy in eV.
+    distance : float
+        Distance between the sample and the detector in m.
+    pixel_size : float or tuple[float, float]
+        Size of the pixels (rows, columns) in m.
+    center : tuple[float, float]
+        Pixel (row, column) hit by the detector arm axis, by default the
+        center of the frame.
+
+    Returns
+    -------
+    q : np.ndarray
+        (3, M, N) momentum transfer (qx, qy, qz) in 1/A.
+    """
+    rows, cols = frame_shape
+    if center is None:
+        center = ((rows - 1) / 2, (cols - 1) / 2)
+    pixel_rows, pixel_cols = np.broadcast_to(pixel_size, (2,))
+    two_theta, theta = np.radians(two_theta), np.radians(theta)
+
+    # Pixel positions in the lab frame: the arm axis plus the offsets in the
+    # scattering plane (rows) and along y (columns)
+    u = (np.arange(rows) - center[0]) * pixel_rows
+    v = (np.arange(cols) - center[1]) * pixel_cols
+    axis = np.array([np.cos(two_theta), 0.0, np.sin(two_theta)])
+    in_plane = np.array([-np.sin(two_theta), 0.0, np.cos(two_theta)])
+    position = (
+        distance * axis[:, None, None]
+        + u[None, :, None] * in_plane[:, None, None]
+        + v[None, None, :] * np.array([0.0, 1.0, 0.0])[:, None, None]
+    )
+
+    # Scattered minus incident wave vector
+    k = 2 * np.pi * energy / HC_EV_ANGSTROM
+    q_lab = k * position / np.linalg.norm(position, axis=0)
+    q_lab[0] -= k
+
+    # Components along the sample surface (x), y and the surface normal (z)
+    surface = np.array([np.cos(theta), 0.0, np.sin(theta)])
+    normal = np.array([-np.sin(theta), 0.0, np.cos(theta)])
+    return np.stack(
+        [np.tensordot(surface, q_lab, axes=1), q_lab[1], np.tensordot(normal, q_lab, axes=1)]
+    )
+
+
+def _read_geometry(h5_file: h5py.File, keys: dict, geometry: dict) -> tuple[list, dict]:
+    # Angles and energy of every image of a Nexus file, and the detector
+    # geometry with the values stored in the file where none are given
+    labview = h5_file["entry1/instrument_1/labview_data"]
+    detector = h5_file["entry1/instrument_1/detector_1"]
+    angles = [labview[keys[name]][()] for name in ("two_theta", "theta", "energy")]
+    geometry = dict(geometry)
+    if geometry["distance"] is None:
+        geometry["distance"] = float(detector["distance"][()])
+    if geometry["pixel_size"] is None:
+        geometry["pixel_size"] = (
+            float(detector["y_pixel_size"][()]),
+            float(detector["x_pixel_size"][()]),
+        )
+    return list(zip(*angles)), geometry
+
+
+def _border_q(frame_shape: tuple[int, int], angles: tuple, geometry: dict) -> np.ndarray:
+    # Momentum transfer of the border pixels and of the center row and
+    # column of a frame, which bound the q range of the frame
+    q = pixel_q(frame_shape, *angles, **geometry)
+    rows, cols = frame_shape
+    return np.concatenate(
+        [q[:, 0], q[:, -1], q[:, :, 0], q[:, :, -1], q[:, rows // 2], q[:, :, cols // 2]], axis=1
+    )
+
+
+def _q_range(path_files: list, keys: dict, geometry: dict) -> np.ndarray:
+    # (3, 2) lower and upper bounds of the q of all pixels of the files
+    bounds = np.array([[np.inf, -np.inf]] * 3)
+    for path_file in path_files:
+        with h5py.File(path_file, "r") as h5_file:
+            frame_shape = h5_file["entry1/instrument_1/detector_1/data"].shape[-2:]
+            all_angles, file_geometry = _read_geometry(h5_file, keys, geometry)
+        for angles in all_angles:
+            q = _border_q(frame_shape, angles, file_geometry)
+            bounds[:, 0] = np.minimum(bounds[:, 0], q.min(axis=1))
+            bounds[:, 1] = np.maximum(bounds[:, 1], q.max(axis=1))
+    return bounds
+
+
+def _grid_files(
+    path_files: list,
+    keys: dict,
+    geometry: dict,
+    edges: list,
+    correction: str,
+    max_memory_mb: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    # Grids the images of a share of the files into a partial grid of the
+    # summed intensities and the pixel counts
+    from BL7011.file_processing import get_norm_factor
+
+    shape = tuple(len(e) - 1 for e in edges)
+    intensity = np.zeros(np.prod(shape))
+    counts = np.zeros(np.prod(shape), dtype=np.int64)
+    for path_file in path_files:
+        with h5py.File(path_file, "r") as h5_file:
+            dataset = h5_file["entry1/instrument_1/detector_1/data"]
+            labview = h5_file["entry1/instrument_1/labview_data"]
+            n_exposures, frame_shape = dataset.shape[1], dataset.shape[-2:]
+            all_angles, file_geometry = _read_geometry(h5_file, keys, geometry)
+            block = frames_per_block(
+                frame_shape, itemsize=8, n_arrays=2, max_memory_mb=max_memory_mb
+            )
+
+            for index, angles in enumerate(all_angles):
+                # Flat voxel index of the pixels within the (regular) grid
+                with ins.stage("reciprocal.q"):
+                    q = pixel_q(frame_shape, *angles, **file_geometry).reshape(3, -1)
+                    bins = np.zeros(q.shape[1], dtype=np.int64)
+                    inside = np.ones(q.shape[1], dtype=bool)
+                    for axis, axis_edges in enumerate(edges):
+                        n_voxels = len(axis_edges) - 1
+                        step = (axis_edges[-1] - axis_edges[0]) / n_voxels
+                        n = np.floor((q[axis] - axis_edges[0]) / step).astype(np.int64)
+                        # The last voxel includes its upper edge (also if
+                        # the division rounds up to it)
+                        n[(n == n_voxels) & (q[axis] <= axis_edges[-1])] = n_voxels - 1
+                        inside &= (n >= 0) & (n < n_voxels)
+                        bins = bins * n_voxels + n
+                    bins = bins[inside]
+
+                # Sum of the exposures of the image, read in blocks
+                image = np.zeros(frame_shape)
+                for start in range(0, n_exposures, block):
+                    with ins.stage("reciprocal.read"):
+                        frames = dataset[index, start : start + block]
+                        ins.add_bytes("reciprocal.read", read=frames.nbytes)
+                    image += frames.sum(axis=0, dtype=float)
+                image /= get_norm_factor(labview, index, correction)
+
+                with ins.stage("reciprocal.bincount"):
+                    intensity += np.bincount(bins, image.ravel()[inside], minlength=len(intensity))
+                    counts += n_exposures * np.bincount(bins, minlength=len(counts))
+    return intensity.reshape(shape), counts.reshape(shape)
+
+
+@ins.timed("reciprocal.grid_reciprocal_space")
+def grid_reciprocal_space(
+    path_files: list,
+    outputfilename: str = "",
+    *,
+    bins: int | tuple[int, int, int] = 100,
+    q_range: np.ndarray = None,
+    correction: str = "",
+    distance: float = None,
+    pixel_size: float | tuple[float, float] = None,
+    center: tuple[float, float] = None,
+    key_two_theta: str = "detector_rotate",
+    key_theta: str = "sample_rotate_steppertheta",
+    key_energy: str = "beamline_energy",
+    workers: int = 1,
+    max_memory_mb: float = 512.0,
+    verbose: bool = False,
+) -> str:
+    """
+    Grids the frames of a scan of Nexus files into a 3D reciprocal space
+    map and saves it to an HDF5 file.
+
+    Every exposure of every image of the files is gridded with the angles
+    and energy of its image. The map holds the mean intensity of the pixels
+    within each voxel.
+
+    Parameters
+    ----------
+    path_files : list
+        Whole paths of the .h5 files, or a data frame with a 'path' column
+        (e.g., file_df from file_processing.get_file_groups).
+    outputfilename : str
+        Whole path of the output file, by default "processed_rsm.h5" in the
+        directory of the first file (which get_file_groups leaves out).
+    bins : int or tuple[int, int, int]
+        Number of voxels along qx, qy and qz.
+    q_range : np.ndarray
+        (3, 2) lower and upper bounds of qx, qy and qz in 1/A. By default
+        the range covered by the detector in all files. Pixels outside of
+        the range are left out.
+    correction : str
+        Intensity correction of the images (see
+        file_processing.read_image_from_h5).
+    distance : float
+        Sample-detector distance in m, by default the one stored in the
+        files ("detector_1/distance").
+    pixel_size : float or tuple[float, float]
+        Pixel size (rows, columns) in m, by default the one stored in the
+        files.
+    center : tuple[float, float]
+        Pixel (row, column) on the detector arm axis, by default the center
+        of the frames.
+    key_two_theta, key_theta, key_energy : str
+        Labview entries of the detector angle, the sample angle (both in
+        degrees) and the photon energy (in eV). For theta-2theta scans
+        key_two_theta can be "theta2thetaboth".
+    workers : int
+        Number of processes gridding the files, each into its own partial
+        grid.
+    max_memory_mb : float
+        Memory budget in MB for the exposures read at once per process.
+    verbose : bool
+        Prints the q range and the output file.
+
+    Returns
+    -------
+    outputfilename : str
+        Whole path of the written file, holding the (qx, qy, qz) map in
+        "data" (NaN in empty voxels), the summed intensities in "intensity",
+        the pixel counts in "counts" and the voxel edges in "qx", "qy" and
+        "qz", all chunked.
+    """
+    if not isinstance(path_files, (list, tuple)):
+        path_files = list(path_files["path"].values)
+    if len(path_files) == 0:
+        raise ValueError("No files to grid")
+    if outputfilename == "":
+        outputfilename = os.path.join(os.path.dirname(path_files[0]), "processed_rsm.h5")
+
+    keys = {"two_theta": key_two_theta, "theta": key_theta, "energy": key_energy}
+    geometry = {"distance": distance, "pixel_size": pixel_size, "center": center}
+    if q_range is None:
+        with ins.stage("reciprocal.q_range"):
+            q_range = _q_range(path_files, keys, geometry)
+    q_range = np.asarray(q_range, dtype=float)
+    bins = np.broadcast_to(bins, (3,))
+    edges = [np.linspace(low, high, n + 1) for (low, high), n in zip(q_range, bins)]
+    if verbose:
+        print(f"gridding {len(path_files)} files into {tuple(bins)} voxels")
+        print(f"q range (qx, qy, qz) {q_range.tolist()} 1/A")
+
+    # Partial grids of the shares of the files, summed at the end
+    options = (keys, geometry, edges, correction, max_memory_mb)
+    if workers > 1 and len(path_files) > 1:
+        shares = np.array_split(np.asarray(path_files, dtype=str), workers)
+        shares = [share.tolist() for share in shares if len(share)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            partial_grids = list(executor.map(_grid_files, shares, *map(repeat, options)))
+    else:
+        partial_grids = [_grid_files(path_files, *options)]
+    intensity = sum(grid[0] for grid in partial_grids)
+    counts = sum(grid[1] for grid in partial_grids)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        data = np.where(counts > 0, intensity / counts, np.nan)
+    chunks = tuple(int(min(n, 64)) for n in bins)
+    with ins.stage("reciprocal.write", written=data.nbytes + intensity.nbytes + counts.nbytes):
+        with h5py.File(outputfilename, "w") as f:
+            f.create_dataset("data", data=data, chunks=chunks)
+            f.create_dataset("intensity", data=intensity, chunks=chunks)
+            f.create_dataset("counts", data=counts, chunks=chunks)
+            for name, axis_edges in zip(("qx", "qy", "qz"), edges):
+                f.create_dataset(name, data=axis_edges)
+            f["data"].attrs["files"] = [str(p) for p in path_files]
+            f["data"].attrs["correction"] = correction
+    if verbose:
+        print(f"reciprocal space map written to {outputfilename}")
+    return outputfilename
@@ -0,0 +1,236 @@
+"""
+    This file contains functions to correct the drift of the sample between
+    the frames of an image stack before they are averaged.
+
+    The shift of every frame against a reference image is estimated from the
+    peak of the (phase) cross-correlation and refined to sub-pixel precision with an upsampled DFT
+    around the correlation peak (Guizar-Sicairos et al., Opt. Lett. 33, 156
+    (2008)). The frames are shifted by the Fourier shift theorem, i.e., the
+    shifts wrap around the edges of the frames.
+
+    The frames are transformed in blocks with batched FFTs (scipy.fft, which
+    caches the plans of the repeated transforms), the FFT of the reference is
+    calculated once. The registered mean is accumulated in Fourier space, so
+    that only a single inverse FFT is needed for the whole stack.
+
+    Authors: Damian Günzing
+"""
+import numpy as np
+from BL7011 import instrumentation as ins
+from BL7011.tools import bin_frames, frames_per_block
+
+
+def _upsampled_dft(cross_power: np.ndarray, peaks: np.ndarray, upsample_factor: int) -> np.ndarray:
+    # Cross-correlations of a block of cross-power spectra (k, M, N) in a
+    # window of +-0.75 pixels around the coarse peaks (k, 2), sampled with
+    # 1 / upsample_factor pixels, as (k, A, A) matrix multiplications
+    size = int(np.ceil(upsample_factor * 1.5))
+    offsets = np.arange(size) / upsample_factor - (size // 2) / upsample_factor
+    kernels = []
+    for axis in (0, 1):
+        n = cross_power.shape[axis + 1]
+        frequencies = np.fft.ifftshift(np.arange(n) - n // 2)
+        positions = peaks[:, axis, None] + offsets
+        kernels.append(np.exp(2j * np.pi / n * positions[:, :, None] * frequencies))
+    rows, cols = kernels
+    window = rows @ cross_power @ cols.transpose(0, 2, 1)
+    return window, offsets
+
+
+def estimate_shifts(
+    frames_fft: np.ndarray,
+    reference_fft: np.ndarray,
+    upsample_factor: int = 10,
+    normalization: str = None,
+) -> np.ndarray:
+    """
+    Estimates the shifts which align frames with a reference image from the
+    peak of their (phase) cross-correlation.
+
+    Parameters
+    ----------
+    frames_fft : np.ndarray
+        2D FFTs of a block of (k, M, N) frames.
+    reference_fft : np.ndarray
+        2D FFT of the (M, N) reference image.
+    upsample_factor : int
+        Precision of the shifts is 1 / upsample_factor pixels. 1 gives
+        whole pixel shifts without refinement.
+    normalization : str
+        "phase" normalizes the cross-power spectrum to unit magnitude (phase
+        correlation), which gives sharp peaks but weights the noise of the
+        high frequencies as much as the signal. None (cross-correlation) is
+        several times more precise for frames with shot noise, both for
+        speckle and for broad features.
+
+    Returns
+    -------
+    shifts : np.ndarray
+        (k, 2) shifts (rows, columns) in pixels. Shifting a frame by its
+        shift (see shift_frames) aligns it with the reference.
+    """
+    from scipy import fft
+
+    cross_power = reference_fft * frames_fft.conj()
+    if normalization == "phase":
+        cross_power /= np.maximum(np.abs(cross_power), np.finfo(float).tiny)
+    elif normalization is not None:
+        raise ValueError(f"Unknown normalization {normalization}, use 'phase' or None")
+    correlation = np.abs(fft.ifft2(cross_power))
+
+    # Whole pixel peaks, wrapped to -M/2 ... M/2
+    shape = np.array(frames_fft.shape[1:])
+    flat_peaks = correlation.reshape(len(correlation), -1).argmax(axis=1)
+    peaks = np.stack(np.unravel_index(flat_peaks, frames_fft.shape[1:]), axis=1)
+    peaks = np.where(peaks > shape // 2, peaks - shape, peaks).astype(float)
+    if upsample_factor <= 1:
+        return peaks
+
+    # Sub-pixel refinement around the peaks
+    window, offsets = _upsampled_dft(cross_power, peaks, upsample_factor)
+    window = np.abs(window).reshape(len(window), -1)
+    fine = np.unravel_index(window.argmax(axis=1), (len(offsets), len(offsets)))
+    return peaks + offsets[np.stack(fine, axis=1)]
+
+
+def _shift_fft(frames_fft: np.ndarray, shifts: np.ndarray) -> np.ndarray:
+    # Applies the (k, 2) shifts to a block of frame FFTs by the separable
+    # phase ramps of the Fourier shift theorem
+    ramps = []
+    for axis in (0, 1):
+        n = frames_fft.shape[axis + 1]
+        frequencies = np.fft.fftfreq(n)
+        ramps.append(np.exp(-2j * np.pi * shifts[:, axis, None] * frequencies))
+    return frames_fft * ramps[0][:, :, None] * ramps[1][:, None, :]
+
+
+def shift_frames(frames: np.ndarray, shifts: np.ndarray) -> np.ndarray:
+    """
+    Shifts frames by sub-pixel amounts (Fourier shift theorem, the frames
+    wrap around the edges).
+
+    Parameters
+    ----------
+    frames : np.ndarray
+        (k, M, N) frames or a single (M, N) frame.
+    shifts : np.ndarray
+        (k, 2) or (2,) shifts (rows, columns) in pixels.
+
+    Returns
+    -------
+    shifted : np.ndarray
+        The shifted frames.
+    """
+    from scipy import fft
+
+    single = frames.ndim == 2
+    frames = frames[None] if single else frames
+    shifts = np.atleast_2d(shifts).astype(float)
+    shifted = fft.ifft2(_shift_fft(fft.fft2(frames), shifts)).real
+    return shifted[0] if single else shifted
+
+
+def register_stack(
+    stack,
+    *,
+    reference: int | np.ndarray = 0,
+    index: int = None,
+    dark: np.ndarray = None,
+    upsample_factor: int = 10,
+    normalization: str = None,
+    max_memory_mb: float = 512.0,
+    binning: int = 1,
+    verbose: bool = False,
+) -> tuple:
+    """
+    Averages an image stack after aligning every frame with a reference by
+    its sub-pixel shift. The stack is read in blocks, so that it can stay in
+    the HDF5 file.
+
+    Parameters
+    ----------
+    stack : np.ndarray or h5py.Dataset
+        A (F, M, N) image stack, or a (v, F, M, N) Nexus stack together with
+        index.
+    reference : int or np.ndarray
+        Index of the reference frame within the stack or a (M, N) reference
+        image (e.g., the first frame of another file).
+    index : int
+        Index of the image within a (v, F, M, N) Nexus stack whose F
+        exposures are registered.
+    dark : np.ndarray
+        (M, N) dark frame subtracted from every frame before the shifts are
+        estimated, as the dark does not drift with the sample.
+    upsample_factor : int
+        Precision of the shifts is 1 / upsample_factor pixels.
+    normalization : str
+        "phase" or None, see estimate_shifts.
+    max_memory_mb : float
+        Memory budget in MB for the FFTs of a block of frames.
+    binning : int
+        Sums blocks of binning x binning pixels of the frames right after
+        they are read (see BL7011.tools.bin_frames). A reference image and
+        the dark have to be given at full resolution.
+    verbose : bool
+        Prints the largest shift of the stack.
+
+    Returns
+    -------
+    image : np.ndarray
+        The (M, N) mean of the aligned frames, (M / binning, N / binning) if
+        binned.
+    shifts : np.ndarray
+        (F, 2) shift trajectory (rows, columns) of the frames in (binned)
+        pixels.
+    """
+    from scipy import fft
+
+    def read(frames):
+        key = frames if index is None else (index, frames)
+        with ins.stage("registration.read"):
+            block = stack[key]
+            ins.add_bytes("registration.read", read=block.nbytes)
+        block = bin_frames(block, binning)
+        if dark is not None:
+            block = block - dark
+        return block
+
+    n_frames = stack.shape[-3]
+    frame_shape = (stack.shape[-2] // binning, stack.shape[-1] // binning)
+    if dark is not None:
+        dark = bin_frames(dark, binning)
+    if isinstance(reference, (int, np.integer)):
+        reference = read(slice(reference, reference + 1))[0]
+    else:
+        reference = bin_frames(reference, binning)
+        if dark is not None:
+            reference = reference - dark
+    with ins.stage("registration.fft"):
+        reference_fft = fft.fft2(reference)
+
+    # The complex FFTs, the cross-power spectra and the shifted FFTs (16
+    # bytes per pixel each) next to the full resolution frames read
+    bytes_read = binning**2 * np.dtype(stack.dtype).itemsize
+    block = frames_per_block(
+        frame_shape, itemsize=1, n_arrays=4 * 16 + bytes_read, max_memory_mb=max_memory_mb
+    )
+    shifts = np.empty((n_frames, 2))
+    mean_fft = np.zeros(frame_shape, dtype=complex)
+    for f0 in range(0, n_frames, block):
+        frames = read(slice(f0, f0 + block))
+        with ins.stage("registration.fft"):
+            frames_fft = fft.fft2(frames)
+        with ins.stage("registration.shifts"):
+            shifts[f0 : f0 + len(frames)] = estimate_shifts(
+                frames_fft, reference_fft, upsample_factor, normalization
+            )
+        with ins.stage("registration.shift"):
+            mean_fft += _shift_fft(frames_fft, shifts[f0 : f0 + len(frames)]).sum(axis=0)
+
+    if verbose:
+        largest = np.abs(shifts).max(axis=0)
+        print(f"registered {n_frames} frames, largest shift {largest} pixels (rows, columns)")
+
+    with ins.stage("registration.fft"):
+        image = fft.ifft2(mean_fft / n_frames).real
+    return image, shifts
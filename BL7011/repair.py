@@ -1,5 +1,8 @@
+from BL7011 import instrumentation as ins
 from BL7011.import_functions import import_broken_h5
-from BL7011.tools import get_positions_from_bluesky_json
+from BL7011.tools import get_positions_from_bluesky_json, where_is_my_frame_missing
+from BL7011.pyramid import write_pyramid
+from BL7011.stack import DetectorStack
 from warnings import warn as w
 import h5py
 import numpy as np
@@ -86,6 +89,7 @@ def uncorrupted_h5_structure() -> list:
     ]
 
 
+@ins.timed("repair.h5repair")
 def h5repair(
     h5filename: str,
     jsonfilename: str = "",
@@ -95,36 +99,60 @@ def h5repair(
     roi: list = [0, 2048, 0, 2048],
     missing_frames: list = [],
     eps: float = 0.3,
+    pyramid: bool = False,
+    dtype: str = None,
+    binning: int = 1,
 ) -> None:
     """
     When in the bluesky exporter None is selected it exports the collected detector data in an .h5 file while the
     recorded metadata from labview is written to a .json file. This function returns the averaged data of the detectors
     and the labview data from the json file and writes a new h5 file in the the style of the uncorrupted
     Nexus files.
+
+    If pyramid is True, mean-binned preview pyramids (1/2, 1/4, ...) of the detector data are stored next to it in
+    "entry1/instrument_1/detector_1/data_pyramid" (see BL7011.pyramid).
+
+    The detector data is written with the given dtype (e.g. "float32"), by default as averaged (float64).
+
+    With binning, blocks of binning x binning pixels are summed while the frames are read (see import_broken_h5) and
+    the binning is stored in "entry1/instrument_1/detector_1/binning".
+
+    Without averaging (average=1), binning and pyramid, with the full roi and with the detector data chunked by frame
+    (e.g., compressed), the compressed chunks of the frames are copied verbatim into the repaired file, without
+    decoding and encoding them, and the missing frames are written as chunks of zeros. The detector data keeps its
+    dtype and compression then.
     """
 
-    # Import the data and average it accordingly
-    h5data = import_broken_h5(h5filename, average, verbose, roi, missing_frames, eps)
+    # Copy the chunks of the frames if nothing has to be computed, otherwise import the data and average it
+    slots = None
+    if average == 1 and binning == 1 and not pyramid:
+        slots = _chunk_slots(h5filename, roi, missing_frames, eps, dtype)
+    if slots is None:
+        h5data = import_broken_h5(h5filename, average, verbose, roi, missing_frames, eps, binning=binning)
+        n_frames = h5data.shape[0]
+    else:
+        n_frames = len(slots)
 
     if verbose:
-        print(h5data.shape)
+        print(h5data.shape if slots is None else f"copying the chunks of {n_frames} frames")
 
     # get all the motor positions and save them into a dict
-    if jsonfilename != "":
-        labview_data = get_positions_from_bluesky_json(jsonfilename)
-    else:
-        try:
-            # try to match the json file to the h5 file
-            jsonfilename = h5filename.replace("_0.h5", "_documents.json")
+    with ins.stage("repair.metadata"):
+        if jsonfilename != "":
             labview_data = get_positions_from_bluesky_json(jsonfilename)
-        except:
-            raise ValueError("No json file found")
+        else:
+            try:
+                # try to match the json file to the h5 file
+                jsonfilename = h5filename.replace("_0.h5", "_documents.json")
+                labview_data = get_positions_from_bluesky_json(jsonfilename)
+            except:
+                raise ValueError("No json file found")
 
     for n in labview_data.keys():
-        if not len(labview_data[n]) == h5data.shape[0]:
+        if not len(labview_data[n]) == n_frames:
             w(
                 f"Length of motor positions {n} does not match the length of the data. "
-                f"Motor positions: {len(labview_data[n])}, Data: {h5data.shape[0]}."
+                f"Motor positions: {len(labview_data[n])}, Data: {n_frames}."
             )
     # match names from the labview data with the file path structure of the uncorrupted h5 files
     labview_data_keys = list(labview_data.keys())
@@ -148,7 +176,7 @@ def h5repair(
     if outputfilename == "":
         outputfilename = h5filename.replace(".h5", "_repaired.h5")
 
-    with h5py.File(outputfilename, "w") as f:
+    with ins.stage("repair.write"), h5py.File(outputfilename, "w") as f:
         for key in matches.keys():
             if matches[key] is not None:
                 path = matches[key]
@@ -181,7 +209,93 @@ def h5repair(
         group = group["detector_1"]
 
         # Save data as displayed into the uncorrupted h5 files as (a, 1, b, c)
-        h5data = np.expand_dims(h5data, axis=1)
-        group.create_dataset("data", data=h5data)
+        if slots is not None:
+            _copy_chunks(h5filename, group, slots)
+        else:
+            h5data = np.expand_dims(h5data, axis=1)
+            if dtype is not None:
+                h5data = h5data.astype(dtype)
+            group.create_dataset("data", data=h5data)
+            ins.add_bytes("repair.write", written=h5data.nbytes)
+        if pyramid:
+            write_pyramid(group, "data", h5data)
+        if binning != 1:
+            group.create_dataset("binning", data=binning)
 
     return None
+
+
+def _chunk_slots(h5filename: str, roi: list, missing_frames: list, eps: float, dtype: str) -> list:
+    # Recorded frame of every frame of the repaired data (None for a missing frame, as inserted by import_broken_h5
+    # with average=1), or None if the chunks of the frames can not be copied verbatim
+    with h5py.File(h5filename, "r") as f:
+        dataset = f["entry/data/data"]
+        n_recorded, frame_shape = dataset.shape[0], dataset.shape[1:]
+        whole_frames = dataset.chunks == (1,) + frame_shape
+        same_dtype = dtype is None or np.dtype(dtype) == dataset.dtype
+    # A roi larger than the frame is adjusted to the whole frame by import_broken_h5
+    full_roi = all(
+        roi[2 * axis + 1] - roi[2 * axis] > size or (roi[2 * axis] == 0 and roi[2 * axis + 1] >= size)
+        for axis, size in enumerate(frame_shape)
+    )
+    if not (whole_frames and same_dtype and full_roi):
+        return None
+
+    if len(missing_frames) == 0:
+        missing_frames = where_is_my_frame_missing(h5filename, plot=False, n_images=1, eps=eps)
+    missing = set(np.asarray(missing_frames, dtype=int).tolist())
+    slots = []
+    for n in range(n_recorded):
+        if n in missing:
+            slots.append(None)
+        slots.append(n)
+    if len(slots) - n_recorded != len(missing_frames):
+        raise ValueError("number of missing frames does not match the replacement")
+    return slots
+
+
+def _copy_chunks(h5filename: str, group: h5py.Group, slots: list) -> None:
+    # Writes the (a, 1, M, N) detector data by copying the compressed chunks of the recorded frames verbatim and
+    # writing chunks of zeros for the missing frames
+    with h5py.File(h5filename, "r") as f:
+        source = f["entry/data/data"]
+        frame_shape = source.shape[1:]
+        # Same dtype, filters and fill value as the recorded data, one chunk per frame
+        dcpl = source.id.get_create_plist()
+        dcpl.set_chunk((1, 1) + frame_shape)
+        space = h5py.h5s.create_simple((len(slots), 1) + frame_shape)
+        dataset = h5py.Dataset(h5py.h5d.create(group.id, b"data", source.id.get_type(), space, dcpl=dcpl))
+
+        zeros = np.zeros((1,) + frame_shape, dtype=source.dtype)
+        for n, frame in enumerate(slots):
+            if frame is None:
+                dataset[n] = zeros
+                continue
+            with ins.stage("repair.copy_chunks"):
+                filter_mask, chunk = source.id.read_direct_chunk((frame, 0, 0))
+                dataset.id.write_direct_chunk((n, 0, 0, 0), chunk, filter_mask)
+                ins.add_bytes("repair.copy_chunks", read=len(chunk), written=len(chunk))
+
+
+def read_repaired_h5(path_file: str, lazy: bool = False) -> np.ndarray | DetectorStack:
+    """
+    Reads the detector data of a file written by h5repair.
+
+    Parameters
+    ----------
+    path_file : str
+        Whole path of the repaired .h5 file.
+    lazy : bool
+        Returns a BL7011.stack.DetectorStack of the averages instead, which is only read when it is sliced down to
+        frames, reduced or converted with np.asarray. Its labview attribute holds the motor positions of the
+        averages.
+
+    Returns
+    -------
+    data : np.ndarray or BL7011.stack.DetectorStack
+        The (a, M, N) averages of the repaired file.
+    """
+    stack = DetectorStack(path_file, "entry1/instrument_1/detector_1/data")
+    if lazy:
+        return stack
+    return stack.compute()
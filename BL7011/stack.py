@@ -0,0 +1,309 @@
+"""
+    This file contains a lazy image stack type for the detector data of the
+    h5 files (Nexus, repaired Nexus and broken bluesky files).
+
+    A DetectorStack refers to the dataset in the file instead of holding the
+    frames. Slicing it only narrows down the frames, rows and columns it
+    refers to, the normalization and dark subtraction are applied while the
+    data is read, and the reductions (sum, mean, std) read the frames in
+    blocks of a memory budget. The frames are only loaded as a whole when
+    asked for (np.asarray(stack) or stack.compute()).
+
+    Authors: Damian Günzing
+"""
+import h5py
+import numpy as np
+from BL7011 import instrumentation as ins
+from BL7011.tools import frames_per_block
+
+NEXUS_DATASET = "entry1/instrument_1/detector_1/data"
+BLUESKY_DATASET = "entry/data/data"
+NEXUS_LABVIEW = "entry1/instrument_1/labview_data"
+
+
+def _as_slice(positions: range) -> slice:
+    # h5py selection of a range of increasing positions
+    if positions.step < 0:
+        raise IndexError("DetectorStack only supports increasing selections")
+    return slice(positions.start, positions.start + len(positions) * positions.step, positions.step)
+
+
+class DetectorStack:
+    """
+    Lazy (F, M, N) stack of detector frames of an h5 file.
+
+    Parameters
+    ----------
+    path_file : str
+        Whole path of the .h5 file.
+    dataset_path : str
+        Path of the detector data within the file. By default the Nexus
+        detector data, or "entry/data/data" if there is none.
+    index : int
+        Index of the image of a (a, b, M, N) Nexus stack whose b exposures
+        are the frames. None uses the a images of a stack with a single
+        exposure per image (e.g., repaired files) or the frames of a
+        (F, M, N) stack.
+    max_memory_mb : float
+        Memory budget in MB for the blocks of frames read by the reductions.
+    """
+
+    def __init__(
+        self,
+        path_file: str,
+        dataset_path: str = None,
+        *,
+        index: int = None,
+        max_memory_mb: float = 512.0,
+    ):
+        with h5py.File(path_file, "r") as f:
+            if dataset_path is None:
+                dataset_path = NEXUS_DATASET if NEXUS_DATASET in f else BLUESKY_DATASET
+            dataset = f[dataset_path]
+            shape, self._raw_dtype = dataset.shape, dataset.dtype
+        if len(shape) == 4 and index is None and shape[1] != 1:
+            raise ValueError(
+                f"{dataset_path} holds {shape[1]} exposures per image, the index of the image is needed"
+            )
+        if len(shape) not in (3, 4):
+            raise ValueError(f"{dataset_path} has the shape {shape}, not a stack of frames")
+
+        self.path_file = path_file
+        self.dataset_path = dataset_path
+        self.index = index
+        self.max_memory_mb = max_memory_mb
+        self._ndim_file = len(shape)
+        n_frames = shape[1] if index is not None else shape[0]
+        self._frames = range(n_frames)
+        self._frame_shape = shape[-2:]
+        self._rows = range(shape[-2])
+        self._cols = range(shape[-1])
+        self._factor = None
+        self._dark = None
+        self._labview = None
+
+    def _copy(self, **changes):
+        stack = object.__new__(DetectorStack)
+        stack.__dict__.update(self.__dict__)
+        stack.__dict__.update(changes)
+        return stack
+
+    def __repr__(self):
+        return (
+            f"DetectorStack({self.path_file!r}, {self.dataset_path!r}, shape={self.shape}, "
+            f"normalized={self._factor is not None}, dark={self._dark is not None})"
+        )
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self._frames), len(self._rows), len(self._cols))
+
+    @property
+    def ndim(self) -> int:
+        return 3
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(float)
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __getitem__(self, key):
+        """
+        Slices (start:stop:step) give a new lazy stack, integers read the
+        selected frames, rows or columns right away (dropping the axis).
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError(f"too many indices for a stack: {len(key)}")
+        key = key + (slice(None),) * (3 - len(key))
+
+        positions, squeeze = [], []
+        for axis, (k, current) in enumerate(zip(key, (self._frames, self._rows, self._cols))):
+            if isinstance(k, slice):
+                positions.append(current[k])
+            elif isinstance(k, (int, np.integer)):
+                positions.append(current[k : k + 1 or None])
+                squeeze.append(axis)
+            else:
+                raise IndexError("DetectorStack only supports integers and slices")
+        stack = self._copy(_frames=positions[0], _rows=positions[1], _cols=positions[2])
+        if not squeeze:
+            return stack
+        return stack.compute().squeeze(axis=tuple(squeeze))
+
+    @property
+    def labview(self) -> dict:
+        """
+        Labview data of the frames (Nexus files), one value per frame, or a
+        single value if the frames are the exposures of one image.
+        """
+        if self._labview is None:
+            with h5py.File(self.path_file, "r") as f:
+                group = f.get(NEXUS_LABVIEW, {})
+                self._labview = {key: group[key][()] for key in group}
+        if self.index is not None:
+            return {key: values[self.index] for key, values in self._labview.items()}
+        return {key: values[_as_slice(self._frames)] for key, values in self._labview.items()}
+
+    def normalize(self, correction: str = "", dark: np.ndarray = None) -> "DetectorStack":
+        """
+        Returns a stack which is dark subtracted and normalized while it is
+        read, replacing a previous normalization of the stack.
+
+        Parameters
+        ----------
+        correction : str
+            Intensity correction as in file_processing.read_image_from_h5
+            ("i0 blade", "i0 rlrl", "cps" or "" for none), using the labview
+            data of the file.
+        dark : np.ndarray
+            Dark frame subtracted before the normalization, either of the
+            full frame size or of the rows and columns of the stack.
+
+        Returns
+        -------
+        stack : DetectorStack
+            The lazily normalized stack.
+        """
+        from BL7011.file_processing import get_norm_factor
+
+        factor = None
+        if correction:
+            with h5py.File(self.path_file, "r") as f:
+                if NEXUS_LABVIEW not in f:
+                    raise ValueError(f"{self.path_file} holds no labview data to normalize by")
+                if self.index is not None:
+                    factor = get_norm_factor(f[NEXUS_LABVIEW], self.index, correction)
+                else:
+                    factor = get_norm_factor(f[NEXUS_LABVIEW], slice(None), correction)
+            factor = np.asarray(factor, dtype=float)
+        if dark is not None and dark.shape != self._frame_shape:
+            if dark.shape != self.shape[1:]:
+                raise ValueError(
+                    f"dark has the shape {dark.shape}, which is neither the frame size "
+                    f"{self._frame_shape} nor the size {self.shape[1:]} of the stack"
+                )
+            # Place the dark of the selection within the full frame
+            full = np.zeros(self._frame_shape)
+            full[_as_slice(self._rows), _as_slice(self._cols)] = dark
+            dark = full
+        return self._copy(_factor=factor, _dark=dark)
+
+    def _read(self, dataset: h5py.Dataset, frames: range) -> np.ndarray:
+        # Reads, dark subtracts and normalizes frames of the selection
+        rows, cols = _as_slice(self._rows), _as_slice(self._cols)
+        if self.index is not None:
+            key = (self.index, _as_slice(frames), rows, cols)
+        elif self._ndim_file == 4:
+            # Images with a single exposure each
+            key = (_as_slice(frames), 0, rows, cols)
+        else:
+            key = (_as_slice(frames), rows, cols)
+        with ins.stage("stack.read"):
+            block = dataset[key]
+            ins.add_bytes("stack.read", read=block.nbytes)
+        block = block.astype(float)
+        if self._dark is not None:
+            block -= self._dark[rows, cols]
+        if self._factor is not None:
+            if self._factor.ndim == 0:
+                block /= self._factor
+            else:
+                block /= self._factor[_as_slice(frames)][:, None, None]
+        return block
+
+    def iter_blocks(self, max_memory_mb: float = None):
+        """
+        Yields the frames of the stack in blocks of a memory budget.
+
+        Parameters
+        ----------
+        max_memory_mb : float
+            Memory budget in MB of a block, by default the one of the stack.
+
+        Yields
+        ------
+        block : np.ndarray
+            (k, M, N) frames.
+        """
+        max_memory_mb = self.max_memory_mb if max_memory_mb is None else max_memory_mb
+        # The float block, the raw data read and a working array
+        block = frames_per_block(self.shape[1:], itemsize=8, n_arrays=3, max_memory_mb=max_memory_mb)
+        with h5py.File(self.path_file, "r") as f:
+            dataset = f[self.dataset_path]
+            for start in range(0, len(self), block):
+                yield self._read(dataset, self._frames[start : start + block])
+
+    def compute(self) -> np.ndarray:
+        """
+        Loads the whole (selected) stack.
+
+        Returns
+        -------
+        frames : np.ndarray
+            The (F, M, N) frames.
+        """
+        with h5py.File(self.path_file, "r") as f:
+            return self._read(f[self.dataset_path], self._frames)
+
+    def __array__(self, dtype=None, copy=None):
+        frames = self.compute()
+        return frames if dtype is None else frames.astype(dtype, copy=False)
+
+    def _reduce(self, axis, moments: bool) -> tuple:
+        # Blocked (count, sum) or (count, mean, M2) over the axes, merging
+        # the moments of the blocks (Chan et al.) if the frames are reduced
+        if axis is None:
+            axis = (0, 1, 2)
+        axis = tuple(a % 3 for a in np.atleast_1d(axis))
+        if 0 not in axis:
+            # Every block reduces its own frames
+            results = [
+                (block.sum(axis=axis), block.std(axis=axis) if moments else None)
+                for block in self.iter_blocks()
+            ]
+            count = int(np.prod([self.shape[a] for a in axis]))
+            sums = np.concatenate([r[0] for r in results])
+            return count, sums, (np.concatenate([r[1] for r in results]) if moments else None)
+
+        count, total, mean, m2 = 0, 0.0, 0.0, 0.0
+        for block in self.iter_blocks():
+            n_block = int(np.prod([block.shape[a] for a in axis]))
+            block_sum = block.sum(axis=axis)
+            total = total + block_sum
+            if moments:
+                block_mean = block_sum / n_block
+                expanded = np.expand_dims(block_mean, axis)
+                block_m2 = ((block - expanded) ** 2).sum(axis=axis)
+                delta = block_mean - mean
+                mean = mean + delta * n_block / (count + n_block)
+                m2 = m2 + block_m2 + delta**2 * count * n_block / (count + n_block)
+            count += n_block
+        return count, total, (np.sqrt(m2 / count) if moments else None)
+
+    def sum(self, axis=None) -> np.ndarray:
+        """
+        Sum over the given axes (None for all), read in blocks.
+        """
+        return self._reduce(axis, moments=False)[1]
+
+    def mean(self, axis=None) -> np.ndarray:
+        """
+        Mean over the given axes (None for all), read in blocks.
+        """
+        count, total, _ = self._reduce(axis, moments=False)
+        return total / count
+
+    def std(self, axis=None) -> np.ndarray:
+        """
+        Standard deviation over the given axes (None for all), read in
+        blocks with running moments.
+        """
+        return self._reduce(axis, moments=True)[2]
@@ -0,0 +1,488 @@
+"""
+    This file contains a generator for synthetic COSMIC Scattering datasets of
+    realistic size, used for benchmarks and tests. It writes
+
+    - Nexus files following repair.uncorrupted_h5_structure() (the output of
+      the bluesky exporter when Nexus is selected), and
+    - broken bluesky "<name>_0.h5"/"<name>_documents.json" pairs (the output
+      when None is selected) with missing frames injected.
+
+    The detector images show a direct beam halo and a pair of magnetic
+    scattering satellites whose intensity ratio flips with the polarization,
+    so that dichroism images of a campaign are not just noise.
+
+    Authors: Damian Günzing
+"""
+import itertools
+import json
+import os
+import uuid
+
+import h5py
+import numpy as np
+from BL7011.repair import uncorrupted_h5_structure
+
+# Typical labview values of the COSMIC Scattering endstation (taken from the
+# nexus16x16.h5 test file), used for every entry which is not given
+LABVIEW_DEFAULTS = {
+    "DIAG112_Diode_diode": -58.0,
+    "DetectorDiodeCurrent_diode": -0.55,
+    "EPUPOL_diode": 0.0,
+    "EPU_Polarization": 0.0,
+    "EPU_Polarization_user_setpoint": 0.0,
+    "LS_LLHTA": 300.0,
+    "LS_LLHTA_user_setpoint": 0.0,
+    "LS_LLHTB": 299.74,
+    "LS_LLHTB_user_setpoint": 0.0,
+    "XS111LeftBladecurrent_diode": 6340.0,
+    "XS111RLRL_diode": -0.26,
+    "XS111RightBladecurrent_diode": 3740.0,
+    "beamline_energy": 715.0,
+    "beamline_energy_user_setpoint": 715.0,
+    "det_translate": -0.7,
+    "det_translate_user_setpoint": -0.1,
+    "detector_rotate": 90.008,
+    "detector_rotate_user_setpoint": 90.008,
+    "diagnostic": 1000.0,
+    "diagnostic_user_setpoint": 1000.0,
+    "fake": 1.0,
+    "fake_user_setpoint": 1.0,
+    "pinhole_x": 100.359,
+    "pinhole_x_user_setpoint": 99.97,
+    "pinhole_y": -4425.63,
+    "pinhole_y_user_setpoint": -4424.866,
+    "sample_lift": 2667.7,
+    "sample_lift_user_setpoint": 2667.7,
+    "sample_rotate_steppertheta": 46.004,
+    "sample_rotate_steppertheta_user_setpoint": 46.004,
+    "sample_top": -24966.471,
+    "sample_top_user_setpoint": -24966.471,
+    "sample_translate": 414.999,
+    "sample_translate_user_setpoint": 414.999,
+    "sample_vertical_rotation": 207.941,
+    "sample_vertical_rotation_user_setpoint": 207.941,
+    "sample_vertical_translate": 21.482,
+    "sample_vertical_translate_user_setpoint": 21.482,
+    "sample_wedge": 25521.278,
+    "sample_wedge_user_setpoint": 25521.278,
+    "slit_bottom": -153.0,
+    "slit_bottom_user_setpoint": -153.0,
+    "slit_left": 15013.5,
+    "slit_left_user_setpoint": 15013.5,
+    "slit_right": 28113.5,
+    "slit_right_user_setpoint": 28113.5,
+    "slit_top": 48124.0,
+    "slit_top_user_setpoint": 48124.0,
+    "theta2thetaboth": 90.008,
+    "theta2thetaboth_user_setpoint": 90.008,
+}
+
+# Values of the scalar entries of a Nexus file
+_NEXUS_SCALARS = {
+    "entry1/end_time": b"2024-06-28T09:56:57.632281",
+    "entry1/instrument_1/detector_1/count_time": 5000.0,
+    "entry1/instrument_1/detector_1/description": "Princeton Instruments MTE3",
+    "entry1/instrument_1/detector_1/detector_readout_time": np.int32(0),
+    "entry1/instrument_1/detector_1/distance": 0.208,
+    "entry1/instrument_1/detector_1/exposures": np.int32(1),
+    "entry1/instrument_1/detector_1/period": np.int32(0),
+    "entry1/instrument_1/detector_1/x_pixel_size": 1.5e-05,
+    "entry1/instrument_1/detector_1/y_pixel_size": 1.5e-05,
+    "entry1/instrument_1/name": b"COSMIC-Scattering",
+    "entry1/instrument_1/source_1/name": b"ALS",
+    "entry1/run_id": "00000000-0000-0000-0000-000000000000",
+    "entry1/sample_1/name": b"synthetic",
+    "entry1/start_time": b"2024-06-28T09:48:03.436834",
+}
+
+
+# Polarizations of the different layouts of a campaign
+POLARIZATION_LAYOUTS = {
+    "circular": (-1, 1),
+    "linear": (0, 2),
+    "both": (-1, 1, 0, 2),
+}
+
+
+def synthetic_image(
+    frame_shape: tuple[int, int],
+    polarization: float = 0,
+    intensity: float = 1000.0,
+    contrast: float = 0.2,
+) -> np.ndarray:
+    """
+    Returns the noise free scattering pattern of a single detector image.
+
+    Parameters
+    ----------
+    frame_shape : tuple[int, int]
+        Shape (M, N) of the image.
+    polarization : float
+        EPU polarization (-1, 1 circular, 0, 2 linear). Circular
+        polarizations change the ratio of a horizontal pair of satellites,
+        linear polarizations the ratio of a vertical pair.
+    intensity : float
+        Peak counts of the satellites.
+    contrast : float
+        Relative intensity change of the satellites between opposite
+        polarizations.
+
+    Returns
+    -------
+    image : np.ndarray
+        The (M, N) image in counts.
+    """
+    rows, cols = frame_shape
+    y = (np.arange(rows) - rows / 2)[:, None] / rows
+    x = (np.arange(cols) - cols / 2)[None, :] / cols
+    r2 = x**2 + y**2
+
+    # Halo of the direct beam and a flat background
+    image = 0.2 * intensity * np.exp(-r2 / 0.01) + 0.02 * intensity
+
+    # Satellites of a stripe domain pattern, one pair per polarization type
+    if polarization in (-1, 1):
+        sign = polarization
+        pair = ((0.0, 0.2), (0.0, -0.2))
+    else:
+        sign = 1 - polarization
+        pair = ((0.2, 0.0), (-0.2, 0.0))
+    for (y0, x0), weight in zip(pair, (1 + contrast * sign, 1 - contrast * sign)):
+        image = image + weight * intensity * np.exp(
+            -((y - y0) ** 2 + (x - x0) ** 2) / 0.0005
+        )
+    return image
+
+
+def _noisy_frames(
+    image: np.ndarray, n_frames: int, rng: np.random.Generator, dtype: str
+) -> np.ndarray:
+    # Poisson noise on top of the pattern, clipped to the detector dtype
+    frames = rng.poisson(image, size=(n_frames,) + image.shape)
+    return np.clip(frames, 0, np.iinfo(dtype).max).astype(dtype)
+
+
+def _labview_values(n_points: int, labview: dict) -> dict:
+    # All labview entries with one value per point; defaults are broadcast
+    values = {}
+    for key, default in LABVIEW_DEFAULTS.items():
+        value = labview.get(key, default)
+        values[key] = np.broadcast_to(np.asarray(value, dtype=float), (n_points,))
+    for key in labview.keys() - LABVIEW_DEFAULTS.keys():
+        values[key] = np.broadcast_to(
+            np.asarray(labview[key], dtype=float), (n_points,)
+        )
+    return values
+
+
+def write_nexus_file(
+    path_file: str,
+    *,
+    n_images: int = 10,
+    n_exposures: int = 1,
+    frame_shape: tuple[int, int] = (2048, 2048),
+    polarization: float = 0,
+    labview: dict = {},
+    dtype: str = "uint16",
+    compression: str = None,
+    compression_opts=None,
+    seed: int = None,
+) -> str:
+    """
+    Writes a synthetic Nexus file with the structure of
+    repair.uncorrupted_h5_structure().
+
+    Parameters
+    ----------
+    path_file : str
+        Whole path of the .h5 file to write.
+    n_images : int
+        Number of images a in the (a, b, M, N) detector data.
+    n_exposures : int
+        Number of exposures b per image.
+    frame_shape : tuple[int, int]
+        Shape (M, N) of a single exposure.
+    polarization : float
+        EPU polarization of all images (-1, 1 circular, 0, 2 linear).
+    labview : dict
+        Labview entries to set, as a single value or one value per image.
+        Entries not given are set to LABVIEW_DEFAULTS.
+    dtype : str
+        Integer dtype of the detector data.
+    compression : str
+        HDF5 compression filter of the detector data (e.g., "gzip", "lzf").
+        Compressed data is chunked per exposure.
+    compression_opts :
+        Options of the compression filter (e.g., the gzip level).
+    seed : int
+        Seed of the Poisson noise.
+
+    Returns
+    -------
+    path_file : str
+        Whole path of the written file.
+    """
+    rng = np.random.default_rng(seed)
+    labview = {
+        "EPU_Polarization": polarization,
+        "EPU_Polarization_user_setpoint": polarization,
+        **labview,
+    }
+    labview_values = _labview_values(n_images, labview)
+    energy = labview_values["beamline_energy"]
+    image = synthetic_image(frame_shape, polarization)
+
+    with h5py.File(path_file, "w") as f:
+        for path in uncorrupted_h5_structure():
+            name = path.split("/")[-1]
+            if path.endswith("detector_1/data"):
+                dataset = f.create_dataset(
+                    path,
+                    shape=(n_images, n_exposures) + tuple(frame_shape),
+                    dtype=dtype,
+                    compression=compression,
+                    compression_opts=compression_opts,
+                    chunks=(1, 1) + tuple(frame_shape) if compression else None,
+                )
+                # Write exposure by exposure to keep the memory bounded
+                for n in range(n_images):
+                    for m in range(n_exposures):
+                        dataset[n, m] = _noisy_frames(image, 1, rng, dtype)[0]
+            elif "labview_data" in path:
+                f.create_dataset(path, data=labview_values[name])
+            elif path.endswith("source_1/energy"):
+                f.create_dataset(path, data=energy * 1.602176634e-19)
+            elif path.endswith("source_1/wavelength"):
+                f.create_dataset(path, data=1.23984198e-6 / energy)
+            elif path.endswith("geometry_1"):
+                f.create_group(path)
+            else:
+                f.create_dataset(path, data=_NEXUS_SCALARS[path])
+    return path_file
+
+
+def write_campaign(
+    path_dir: str,
+    *,
+    positions: dict = {"sample_lift": [2667.7]},
+    layout: str = "circular",
+    prefix: str = "synthetic",
+    **kwargs,
+) -> list[str]:
+    """
+    Writes a directory of synthetic Nexus files, one file per combination of
+    positions and polarization, as used by file_processing.get_file_groups
+    and batch_processing_dichroism.
+
+    Parameters
+    ----------
+    path_dir : str
+        Pathname of the directory to write the files to.
+    positions : dict
+        Labview entries (the key_common of get_file_groups) with the list
+        of their values. All combinations of the values are written.
+    layout : str
+        Polarizations written for each combination of positions
+        - 'circular': -1 and 1
+        - 'linear': 0 and 2
+        - 'both': -1, 1, 0 and 2
+    prefix : str
+        Prefix of the file names, followed by a running number.
+    kwargs :
+        Passed on to write_nexus_file (e.g., n_images, frame_shape,
+        compression).
+
+    Returns
+    -------
+    path_files : list[str]
+        Whole paths of the written files.
+    """
+    if layout not in POLARIZATION_LAYOUTS:
+        raise ValueError(f"layout has to be one of {list(POLARIZATION_LAYOUTS)}")
+    os.makedirs(path_dir, exist_ok=True)
+    seed = kwargs.pop("seed", None)
+
+    path_files = []
+    keys = list(positions)
+    for n, values in enumerate(itertools.product(*positions.values())):
+        for polarization in POLARIZATION_LAYOUTS[layout]:
+            path_file = os.path.join(path_dir, f"{prefix}_{len(path_files):04d}.h5")
+            labview = dict(zip(keys, values))
+            labview.update(
+                {key + "_user_setpoint": value for key, value in labview.items()}
+            )
+            write_nexus_file(
+                path_file,
+                polarization=polarization,
+                labview=labview,
+                seed=None if seed is None else seed + len(path_files),
+                **kwargs,
+            )
+            path_files.append(path_file)
+    return path_files
+
+
+def write_broken_pair(
+    path_base: str,
+    *,
+    n_positions: int = 10,
+    average: int = 10,
+    frame_shape: tuple[int, int] = (2048, 2048),
+    missing_frames: list = [],
+    polarization: float = 0,
+    labview: dict = {},
+    dtype: str = "uint16",
+    compression: str = None,
+    compression_opts=None,
+    frame_period: float = 3.3,
+    seed: int = None,
+) -> tuple[str, str]:
+    """
+    Writes a synthetic broken bluesky export, i.e., the detector data in
+    "<path_base>_0.h5" and the labview data in "<path_base>_documents.json",
+    with frames missing from the detector data.
+
+    The timestamps of the recorded frames have a gap of one frame period at
+    every missing frame, which is what tools.where_is_my_frame_missing looks
+    for.
+
+    Parameters
+    ----------
+    path_base : str
+        Whole path of the export without the "_0.h5"/"_documents.json" ending.
+    n_positions : int
+        Number of motor positions, i.e., of labview events and of averaged
+        images after the repair.
+    average : int
+        Number of frames recorded per position.
+    frame_shape : tuple[int, int]
+        Shape (M, N) of a single frame.
+    missing_frames : list
+        Indices of the frames (counted over all n_positions * average
+        intended frames) which are missing from the detector data.
+        import_broken_h5 can only repair fewer than average missing frames if
+        average is not 1.
+    polarization : float
+        EPU polarization of all frames (-1, 1 circular, 0, 2 linear).
+    labview : dict
+        Labview entries to set, as a single value or one value per position.
+        Entries not given are set to LABVIEW_DEFAULTS.
+    dtype : str
+        Integer dtype of the detector data.
+    compression, compression_opts :
+        HDF5 compression of the detector data, see write_nexus_file.
+    frame_period : float
+        Seconds between two frames.
+    seed : int
+        Seed of the Poisson noise and of the timestamp jitter.
+
+    Returns
+    -------
+    (h5filename, jsonfilename) : tuple[str, str]
+        Whole paths of the written files.
+    """
+    rng = np.random.default_rng(seed)
+    h5filename = path_base + "_0.h5"
+    jsonfilename = path_base + "_documents.json"
+
+    n_intended = n_positions * average
+    recorded = np.setdiff1d(np.arange(n_intended), missing_frames)
+    n_recorded = len(recorded)
+
+    # Timestamps of the recorded frames, with a small jitter
+    time_start = 1719609348.0
+    timestamps = (
+        time_start
+        + recorded * frame_period
+        + rng.normal(0, 0.01 * frame_period, n_recorded)
+    )
+
+    image = synthetic_image(frame_shape, polarization)
+    with h5py.File(h5filename, "w") as f:
+        dataset = f.create_dataset(
+            "entry/data/data",
+            shape=(n_recorded,) + tuple(frame_shape),
+            dtype=dtype,
+            compression=compression,
+            compression_opts=compression_opts,
+            chunks=(1,) + tuple(frame_shape) if compression else None,
+        )
+        # Write the frames in blocks to keep the memory bounded
+        block = max(1, 2**26 // (2 * int(np.prod(frame_shape))))
+        for start in range(0, n_recorded, block):
+            stop = min(start + block, n_recorded)
+            dataset[start:stop] = _noisy_frames(image, stop - start, rng, dtype)
+
+        attributes = f.create_group("entry/instrument/NDAttributes")
+        attributes.create_dataset("NDArrayTimeStamp", data=timestamps - 631152000.0)
+        attributes.create_dataset(
+            "NDArrayEpicsTSSec", data=np.floor(timestamps).astype(np.uint32)
+        )
+        attributes.create_dataset(
+            "NDArrayEpicsTSnSec",
+            data=((timestamps % 1) * 1e9).astype(np.uint32),
+        )
+        attributes.create_dataset(
+            "NDArrayUniqueId", data=(recorded + 1).astype(np.int32)
+        )
+
+    # Bluesky documents with one event per motor position
+    labview = {
+        "EPU_Polarization": polarization,
+        "EPU_Polarization_user_setpoint": polarization,
+        **labview,
+    }
+    labview_values = _labview_values(n_positions, labview)
+    run_uid = str(uuid.UUID(int=int(rng.integers(2**63))))
+    descriptor_uid = str(uuid.UUID(int=int(rng.integers(2**63))))
+    documents = [
+        [
+            "start",
+            {
+                "uid": run_uid,
+                "time": time_start,
+                "plan_name": "synthetic",
+                "num_points": n_positions,
+            },
+        ],
+        [
+            "descriptor",
+            {
+                "run_start": run_uid,
+                "uid": descriptor_uid,
+                "time": time_start,
+                "data_keys": {
+                    key: {"dtype": "number", "shape": []} for key in labview_values
+                },
+            },
+        ],
+    ]
+    for n in range(n_positions):
+        documents.append(
+            [
+                "event_page",
+                {
+                    "time": [time_start + n * average * frame_period],
+                    "seq_num": [n + 1],
+                    "descriptor": descriptor_uid,
+                    "data": {
+                        key: [float(value[n])] for key, value in labview_values.items()
+                    },
+                },
+            ]
+        )
+    documents.append(
+        [
+            "stop",
+            {
+                "run_start": run_uid,
+                "time": time_start + n_intended * frame_period,
+                "exit_status": "success",
+                "num_events": {"primary": n_positions},
+            },
+        ]
+    )
+    with open(jsonfilename, "w") as f:
+        json.dump(documents, f)
+
+    return h5filename, jsonfilename
@@ -0,0 +1,46 @@
+import shutil
+
+import numpy as np
+import pytest
+from BL7011.asc_reader import load_asc_files, read_asc
+
+asc_file = "BL7011/test_data/pcs/example.ASC"
+
+
+def test_read_asc():
+    asc_data = read_asc(asc_file)
+    header = asc_data["header"]
+    assert header["Temperature [K]"] == 298.15
+    assert header["Duration [s]"] == 30
+    assert header["Runs"] == 1
+    assert header["Time"] == "14:03:12"
+    assert header["Monitor Diode"] == 1234567.0
+
+    assert asc_data["lag_time"].shape == (24,)
+    assert asc_data["lag_time"][0] == 1.25e-4
+    assert asc_data["correlation"].shape == (24, 2)
+    assert asc_data["count_time"].shape == (10,)
+    assert asc_data["count_rate"].shape == (10, 2)
+    assert asc_data["blocks"]["StandardDeviation"].shape == (24, 3)
+
+
+def test_load_asc_files(tmp_path):
+    for n in range(6):
+        shutil.copy(asc_file, tmp_path / f"measurement_{n}.ASC")
+    # A measurement which was stopped early has a shorter count rate trace
+    with open(asc_file, encoding="latin-1") as f:
+        lines = f.read().splitlines()
+    start = lines.index('"Count Rate"')
+    with open(tmp_path / "measurement_6.asc", "w", encoding="latin-1") as f:
+        f.write("\n".join(lines[: start + 4]))
+
+    asc_data, metadata_df = load_asc_files(str(tmp_path), workers=2)
+    assert asc_data["correlation"].shape == (7, 24, 2)
+    assert asc_data["count_rate"].shape == (7, 10, 2)
+    assert np.all(np.isnan(asc_data["count_rate"][6, 3:]))
+    assert not np.any(np.isnan(asc_data["count_rate"][:6]))
+    assert len(metadata_df) == 7
+    assert np.all(metadata_df["Temperature [K]"] == 298.15)
+
+    with pytest.raises(ValueError):
+        load_asc_files(str(tmp_path / "*.dat"))
@@ -0,0 +1,75 @@
+from BL7011.cli import repair_main, groups_main, dichroism_main
+import json
+import shutil
+import h5py
+import pytest
+
+
+nexus_file = "BL7011/test_data/uncorrupted_frames/nexus16x16.h5"
+
+
+def json_lines(capsys):
+    # Parse the JSON lines written to stdout
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+@pytest.fixture
+def pair_dir(tmp_path):
+    # Directory with a pair of linear polarization files
+    for name, polarization in [("scan_HLP.h5", 0), ("scan_VLP.h5", 2)]:
+        shutil.copy(nexus_file, tmp_path / name)
+        with h5py.File(tmp_path / name, "r+") as h5_file:
+            h5_file["entry1/instrument_1/labview_data/EPU_Polarization"][:] = polarization
+    return tmp_path
+
+
+def test_groups_main(pair_dir, capsys):
+    assert groups_main([str(pair_dir), "--key-common", "detector_rotate"]) == 0
+    lines = json_lines(capsys)
+
+    # Test case: Progress should be reported per file and the groups listed
+    assert [line["event"] for line in lines] == ["start", "progress", "progress", "group", "done"]
+    assert lines[2]["files_done"] == 2 and lines[2]["bytes_read"] > 0
+    assert lines[2]["eta_s"] == 0
+    assert len(lines[3]["files"]) == 2
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_dichroism_main(pair_dir, capsys, workers):
+    args = [str(pair_dir), "--key-common", "detector_rotate", "-j", workers, "--dtype", "float32"]
+
+    # Test case: The first run should compute the pair, the second skip it
+    assert dichroism_main(args) == 0
+    lines = json_lines(capsys)
+    assert {line["command"] for line in lines} == {"dichroism"}
+    done = lines[-1]
+    assert done["event"] == "done" and done["outputs"] == 1
+    with h5py.File(next(pair_dir.glob("processed_XLD*.h5")), "r") as h5_file:
+        assert h5_file["process/image_dichro"].dtype == "float32"
+
+    assert dichroism_main(args) == 0
+    assert json_lines(capsys)[-1]["outputs"] == 0
+
+    # Test case: A forced dry run should list the output without recomputing
+    assert dichroism_main(args + ["--force", "--dry-run"]) == 0
+    lines = json_lines(capsys)
+    assert lines[-1]["outputs"] == 1 and lines[-1]["dry_run"]
+
+
+def test_repair_main(tmp_path, capsys):
+    h5_file = tmp_path / "scan_0.h5"
+    shutil.copy("BL7011/test_data/missing_frames/ccd_data16x16_2.h5", h5_file)
+    shutil.copy("BL7011/test_data/missing_frames/labview_2.json", tmp_path / "scan_documents.json")
+    args = [str(h5_file), "--average", "1", "--roi", "0", "10", "0", "10"]
+
+    # Test case: The file should be repaired once and then be up to date
+    assert repair_main(args) == 0
+    assert json_lines(capsys)[-1]["files_done"] == 1
+    assert (tmp_path / "scan_0_repaired.h5").is_file()
+    assert repair_main(args) == 0
+    assert json_lines(capsys)[-1]["files_done"] == 0
+
+    # Test case: A missing json file should be reported as an error
+    (tmp_path / "scan_documents.json").unlink()
+    assert repair_main(args + ["--no-cache"]) == 1
+    assert any(line["event"] == "error" for line in json_lines(capsys))
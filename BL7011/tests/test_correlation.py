@@ -0,0 +1,128 @@
+import h5py
+import numpy as np
+import pytest
+from BL7011 import correlation as cr
+from BL7011 import synthetic as sy
+
+
+def _ar1_stack(n_frames, frame_shape, phi=0.9, seed=0):
+    # Intensities with an exponentially decaying autocorrelation
+    rng = np.random.default_rng(seed)
+    x = np.zeros((n_frames,) + frame_shape)
+    x[0] = rng.normal(size=frame_shape)
+    for t in range(1, n_frames):
+        x[t] = phi * x[t - 1] + np.sqrt(1 - phi**2) * rng.normal(size=frame_shape)
+    return 10 + x
+
+
+def _brute_force_g2(stack, lag):
+    past, future = stack[: len(stack) - lag], stack[lag:]
+    return (past * future).mean(0) / (past.mean(0) * future.mean(0))
+
+
+def test_multi_tau_lags():
+    lags = cr.multi_tau_lags(3, num_bufs=4)
+    assert list(lags) == [0, 1, 2, 3, 4, 6, 8, 12]
+
+
+def test_multi_tau_g2_matches_brute_force():
+    stack = _ar1_stack(1000, (4, 6))
+    lags, g2 = cr.multi_tau_g2(stack, num_bufs=8)
+    assert g2.shape == (len(lags), 4, 6)
+    assert lags[-1] >= 500
+
+    # The first level correlates every pair of frames
+    for lag, g2_lag in zip(lags[:8], g2[:8]):
+        assert np.allclose(g2_lag, _brute_force_g2(stack, lag), rtol=1e-5)
+    # Higher levels correlate binned frames
+    for lag, g2_lag in zip(lags[8:14], g2[8:14]):
+        assert np.allclose(g2_lag.mean(), _brute_force_g2(stack, lag).mean(), atol=2e-4)
+
+    # The q-bin g2 averages the intensities over the pixels of a bin
+    labels = np.zeros((4, 6), dtype=int)
+    labels[:2] = 1
+    labels[2:, :3] = 2
+    _, g2_q = cr.multi_tau_g2(stack, labels=labels, num_bufs=8)
+    in_bin = labels.ravel() == 2
+    pixels = stack.reshape(len(stack), -1)[:, in_bin]
+    past, future = pixels[:-3], pixels[3:]
+    expected = (past * future).mean() / (past.mean() * future.mean())
+    assert np.isclose(g2_q[3, 1], expected, rtol=1e-5)
+
+
+def test_multi_tau_g2_streams_from_h5(tmp_path):
+    stack = _ar1_stack(600, (8, 8)).astype(np.float32)
+    path_file = str(tmp_path / "scan_0.h5")
+    with h5py.File(path_file, "w") as f:
+        f.create_dataset("entry/data/data", data=stack)
+
+    lags, g2 = cr.multi_tau_g2(stack, roi=[2, 6, 0, 8])
+    # A tiny memory budget reads the file in many blocks
+    lags_h5, g2_h5 = cr.multi_tau_g2(path_file, roi=[2, 6, 0, 8], max_memory_mb=0.001)
+    assert np.all(lags == lags_h5)
+    assert np.allclose(g2, g2_h5, rtol=1e-6)
+
+
+def test_iter_frame_blocks_nexus(tmp_path):
+    path_file = sy.write_nexus_file(
+        str(tmp_path / "nexus.h5"), n_images=5, n_exposures=3, frame_shape=(4, 4)
+    )
+    with h5py.File(path_file, "r") as f:
+        data = f[cr.NEXUS_DATASET]
+        frames = data[()].reshape(15, 4, 4)
+        blocks = list(cr.iter_frame_blocks(data, start=2, stop=13, block_frames=4))
+    assert [len(block) for block in blocks] == [4, 4, 3]
+    assert np.all(np.concatenate(blocks) == frames[2:13])
+
+
+def test_two_time_correlation(tmp_path):
+    stack = _ar1_stack(300, (8, 8)).astype(np.float32)
+    path_file = str(tmp_path / "scan_0.h5")
+    with h5py.File(path_file, "w") as f:
+        f.create_dataset("entry/data/data", data=stack)
+    labels = np.zeros((8, 8), dtype=int)
+    labels[:4] = 1
+    labels[4:, 2:] = 2
+
+    # A tiny memory budget splits the frames into several panels and tiles
+    outputfilename = cr.two_time_correlation(
+        path_file, labels=labels, tile_frames=32, max_memory_mb=0.05
+    )
+    assert outputfilename == str(tmp_path / "scan_0_two_time.h5")
+    with h5py.File(outputfilename, "r") as f:
+        two_time = f["two_time"][()]
+        assert f["two_time"].chunks == (1, 32, 32)
+        assert list(f["two_time"].attrs["bins"]) == [1, 2]
+    assert two_time.shape == (2, 300, 300)
+
+    pixels = stack.reshape(300, -1)[:, labels.ravel() == 2].astype(float)
+    means = pixels.mean(axis=1)
+    expected = (pixels @ pixels.T / pixels.shape[1]) / np.outer(means, means)
+    assert np.allclose(two_time[1], expected, rtol=1e-5)
+    assert np.all(two_time[1] == two_time[1].T)
+
+
+@pytest.mark.parametrize("max_memory_mb", [0.01, 0.05, 1.0])
+def test_two_time_panel_layout_within_budget(max_memory_mb):
+    panel_frames, tile_frames = cr._panel_layout(1000, 64, 48, 256, max_memory_mb)
+    # The panel, a tile (both while they are read) and the products fit into the budget
+    frame_bytes = 4 * (64 + 48)
+    used = frame_bytes * (panel_frames + tile_frames) + 12 * panel_frames * tile_frames
+    assert 1 <= tile_frames <= min(panel_frames, 256)
+    assert used <= max_memory_mb * 2**20
+    with pytest.raises(ValueError):
+        cr._panel_layout(1000, 2048**2, 2048**2, 256, 1.0)
+
+
+def test_two_time_correlation_shrinks_tiles(tmp_path):
+    stack = _ar1_stack(100, (8, 8)).astype(np.float32)
+    # The budget does not hold a panel of 256 frames, the tiles are shrunk
+    outputfilename = cr.two_time_correlation(
+        stack, str(tmp_path / "two_time.h5"), tile_frames=256, max_memory_mb=0.02
+    )
+    pixels = stack.reshape(100, -1).astype(float)
+    means = pixels.mean(axis=1)
+    expected = (pixels @ pixels.T / pixels.shape[1]) / np.outer(means, means)
+    with h5py.File(outputfilename, "r") as f:
+        assert f["two_time"].chunks[1] < 100
+        assert np.allclose(f["two_time"][0], expected, rtol=1e-5)
@@ -0,0 +1,94 @@
+import h5py
+import numpy as np
+import pytest
+from BL7011 import darks as dk
+from BL7011 import file_processing as fp
+from BL7011 import synthetic as sy
+from BL7011.import_functions import import_broken_h5
+
+
+def _dark_file(path_file, level, count_time=5000.0, n_images=4):
+    # Nexus file of constant frames at a dark level
+    sy.write_nexus_file(path_file, n_images=n_images, n_exposures=2, frame_shape=(8, 8))
+    with h5py.File(path_file, "a") as f:
+        f["entry1/instrument_1/detector_1/data"][...] = level
+        f["entry1/instrument_1/detector_1/count_time"][()] = count_time
+    return path_file
+
+
+def test_read_dark_metadata():
+    metadata = dk.read_dark_metadata("BL7011/test_data/uncorrupted_frames/nexus16x16.h5")
+    assert metadata["count_time"] == 5000.0
+    assert np.isnan(metadata["temperature"])
+    assert metadata["date"] == "2024-06-28"
+    metadata = dk.read_dark_metadata("BL7011/test_data/missing_frames/ccd_data16x16_2.h5")
+    assert np.isnan(metadata["count_time"])
+    assert metadata["date"] == "2024-06-28"
+
+
+def test_build_master_dark(tmp_path):
+    path_files = [
+        _dark_file(str(tmp_path / "dark_a.h5"), 100),
+        _dark_file(str(tmp_path / "dark_b.h5"), 200, n_images=2),
+    ]
+    # A tiny memory budget reads a single image at a time
+    master, n_frames = dk.build_master_dark(path_files, max_memory_mb=0.0001)
+    assert n_frames == 12
+    assert master.shape == (8, 8)
+    assert np.allclose(master, (8 * 100 + 4 * 200) / 12)
+
+
+def test_dark_library_lookup(tmp_path):
+    library = dk.DarkLibrary(str(tmp_path / "darks.h5"))
+    library.add(_dark_file(str(tmp_path / "d1.h5"), 100), temperature=170.0)
+    library.add(_dark_file(str(tmp_path / "d2.h5"), 110), temperature=180.0)
+    library.add(_dark_file(str(tmp_path / "d3.h5"), 120, count_time=1000.0))
+    library.add(
+        _dark_file(str(tmp_path / "d4.h5"), 130), temperature=170.0, date="2024-07-28"
+    )
+    assert len(library.index()) == 4
+
+    assert library.lookup(5000.0, 179.0) == "dark_1"
+    assert library.lookup(5000.0, 171.0, "2024-06-30") == "dark_0"
+    assert library.lookup(5000.0, 171.0, "2024-07-20") == "dark_3"
+    assert library.lookup(1000.0, 171.0) == "dark_2"
+    with pytest.raises(KeyError):
+        library.lookup(5000.0, 200.0)
+
+    # Masters are read once and then shared from the cache
+    dk.clear_cache()
+    master = library.master("dark_0")
+    assert library.master("dark_0") is master
+    assert not master.flags.writeable
+    assert dk._read_master.cache_info().hits == 1
+
+
+def test_dark_subtraction_on_load(tmp_path):
+    library = dk.DarkLibrary(str(tmp_path / "darks.h5"))
+    library.add(_dark_file(str(tmp_path / "dark.h5"), 100))
+    path_file = sy.write_nexus_file(
+        str(tmp_path / "image.h5"), n_images=1, n_exposures=3, frame_shape=(8, 8)
+    )
+    raw = fp.load_h5_image(path_file)
+    assert np.allclose(fp.load_h5_image(path_file, dark=library), raw - 100)
+    assert np.allclose(fp.load_h5_image(path_file, dark=np.full((8, 8), 7.0)), raw - 7)
+
+    # Broken bluesky files hold no count_time, it has to be given
+    h5filename = "BL7011/test_data/missing_frames/ccd_data16x16_2.h5"
+    raw = import_broken_h5(h5filename, average=1, roi=[0, 16, 0, 16])
+    dark_file = sy.write_nexus_file(
+        str(tmp_path / "dark_16.h5"), n_images=1, frame_shape=(16, 16)
+    )
+    with h5py.File(dark_file, "a") as f:
+        f["entry1/instrument_1/detector_1/data"][...] = 50
+    library.add(dark_file, count_time=1000.0)
+    with pytest.raises(ValueError):
+        import_broken_h5(h5filename, average=1, roi=[0, 16, 0, 16], dark=library)
+    averages = import_broken_h5(
+        h5filename, average=1, roi=[0, 16, 4, 12], dark=library, dark_count_time=1000.0
+    )
+    assert np.allclose(averages[0], raw[0, :, 4:12] - 50)
+    averages = import_broken_h5(
+        h5filename, average=1, roi=[0, 16, 4, 12], dark=np.full((16, 8), 50.0)
+    )
+    assert np.allclose(averages[0], raw[0, :, 4:12] - 50)
@@ -0,0 +1,156 @@
+from BL7011.data_processing import (
+    calculate_dichroism_from_file,
+    find_peaks,
+    fit_peaks,
+    reduce_stack,
+    PEAK_DTYPE,
+    FIT_DTYPE,
+)
+import h5py
+import numpy as np
+import pytest
+
+
+def gaussian_stack(n_frames=6, shape=(32, 32), centers=((8, 10), (20, 24))):
+    # Synthetic stack with gaussian peaks that move by one pixel per frame
+    rows, cols = np.mgrid[: shape[0], : shape[1]]
+    stack = np.zeros((n_frames,) + shape)
+    for n in range(n_frames):
+        for r, c in centers:
+            stack[n] += 100 * np.exp(-((rows - r) ** 2 + (cols - c - n) ** 2) / 4)
+    return stack
+
+
+@pytest.mark.parametrize("max_memory_mb", [512, 1e-3])
+def test_find_peaks(max_memory_mb):
+    stack = gaussian_stack()
+    peaks = find_peaks(stack, sigma=1, size=5, max_memory_mb=max_memory_mb)
+
+    # Test case: Function should return a structured array with the peak dtype
+    assert peaks.dtype == PEAK_DTYPE
+
+    # Test case: Two peaks per frame at the expected positions
+    assert len(peaks) == 2 * len(stack)
+    for n in range(len(stack)):
+        frame_peaks = peaks[peaks["frame"] == n]
+        assert set(zip(frame_peaks["row"], frame_peaks["col"])) == {
+            (8, 10 + n),
+            (20, 24 + n),
+        }
+
+    # Test case: A threshold above all intensities should return no peaks
+    assert len(find_peaks(stack, threshold=1e6)) == 0
+
+    # Test case: Function should raise a ValueError for a single frame
+    with pytest.raises(ValueError):
+        find_peaks(stack[0])
+
+
+@pytest.mark.parametrize("profile", ["gaussian", "lorentzian", "pseudo-voigt"])
+def test_fit_peaks(profile):
+    stack = gaussian_stack(n_frames=20, shape=(32, 64)) + 5
+    peaks = find_peaks(stack)
+    fit_table = fit_peaks(stack, peaks, window=9, profile=profile, block_frames=4)
+
+    # Test case: Function should return one row per peak with the fit dtype
+    assert fit_table.dtype == FIT_DTYPE
+    assert len(fit_table) == len(peaks)
+    assert np.array_equal(fit_table["frame"], peaks["frame"])
+
+    # Test case: Centres should be found for every profile
+    assert np.allclose(fit_table["center_row"], peaks["row"], atol=0.05)
+    assert np.allclose(fit_table["center_col"], peaks["col"], atol=0.05)
+    assert np.all(fit_table["err_fwhm_row"] >= 0)
+
+    if profile == "gaussian":
+        # Test case: A gaussian profile should reproduce the exact parameters
+        # exp(-d^2 / 4) corresponds to a FWHM of 4 sqrt(ln 2)
+        assert fit_table["converged"].all()
+        assert np.allclose(fit_table["fwhm_row"], 4 * np.sqrt(np.log(2)), rtol=1e-4)
+        assert np.allclose(fit_table["amplitude"], 100, rtol=1e-4)
+        assert np.allclose(fit_table["background"], 5, atol=1e-3)
+
+
+def test_fit_peaks_warm_start():
+    stack = gaussian_stack(n_frames=20, shape=(32, 64)) + 5
+    peaks = find_peaks(stack)
+    warm = fit_peaks(stack, peaks, block_frames=4)
+    cold = fit_peaks(stack, peaks, block_frames=4, warm_start=False)
+
+    # Test case: Starting every frame from the widths of the previous frame
+    # should need fewer iterations for the same result
+    assert warm["converged"].all() and cold["converged"].all()
+    assert warm["iterations"].sum() < cold["iterations"].sum()
+    # The first frame has no previous frame to start from
+    first = warm["frame"] == 0
+    assert np.array_equal(warm["iterations"][first], cold["iterations"][first])
+    assert np.allclose(warm["fwhm_row"], cold["fwhm_row"], rtol=1e-6)
+
+
+def test_fit_peaks_stalled():
+    # Test case: A flat window leaves no step which lowers the cost, the fit
+    # stalls and should not be reported as converged
+    stack = np.zeros((1, 16, 16))
+    peaks = np.zeros(1, dtype=[("frame", int), ("row", int), ("col", int)])
+    peaks["row"], peaks["col"] = 8, 8
+    assert not fit_peaks(stack, peaks)["converged"].any()
+
+
+def test_fit_peaks_invalid_profile():
+    stack = gaussian_stack()
+    with pytest.raises(ValueError):
+        fit_peaks(stack, find_peaks(stack), profile="triangle")
+
+
+@pytest.mark.parametrize("max_memory_mb", [512, 1e-3])
+def test_reduce_stack(max_memory_mb):
+    rng = np.random.default_rng(0)
+    stack = rng.normal(100, 1, size=(40, 12, 10))
+    # Cosmic-ray hits in single frames
+    hits = stack.copy()
+    hits[3, 2, 4] = 1e5
+    hits[17, 8, 1] = 5e4
+
+    mean = reduce_stack(stack, "mean", max_memory_mb=max_memory_mb)
+    assert np.allclose(mean, stack.mean(axis=0))
+    median = reduce_stack(hits, "median", max_memory_mb=max_memory_mb)
+    assert np.allclose(median, np.median(hits, axis=0))
+
+    # Test case: The clipped mean rejects the hits, the mean does not
+    clipped = reduce_stack(hits, "sigma_clip", max_memory_mb=max_memory_mb)
+    assert np.abs(clipped - stack.mean(axis=0)).max() < 1
+    assert reduce_stack(hits, "mean")[2, 4] > 2000
+
+    # Test case: The exposures of an image of a Nexus stack are reduced
+    assert np.allclose(reduce_stack(hits[None], "median", index=0), median)
+
+    with pytest.raises(ValueError):
+        reduce_stack(stack, "mode")
+
+
+def test_calculate_dichroism_from_file_reducer(tmp_path):
+    from BL7011 import synthetic as sy
+
+    path_files = []
+    for pol in (-1, 1):
+        path_file = sy.write_nexus_file(
+            str(tmp_path / f"pol_{pol}.h5"),
+            n_images=1,
+            n_exposures=9,
+            frame_shape=(16, 16),
+            polarization=pol,
+            seed=pol + 1,
+        )
+        with h5py.File(path_file, "a") as f:
+            f["entry1/instrument_1/detector_1/data"][0, 4, 5, 6] = 60000
+        path_files.append(path_file)
+
+    im_dichro, im_pol_a, im_pol_b = calculate_dichroism_from_file(
+        *path_files, reducer="median", max_memory_mb=1e-3
+    )
+    with h5py.File(path_files[0], "r") as f:
+        expected = np.median(f["entry1/instrument_1/detector_1/data"][0], axis=0)
+    assert np.allclose(im_pol_a, expected)
+    assert np.allclose(im_dichro, im_pol_a - im_pol_b)
+    _, im_mean, _ = calculate_dichroism_from_file(*path_files)
+    assert im_mean[5, 6] > im_pol_a[5, 6] + 1000
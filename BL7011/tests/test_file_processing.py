@@ -0,0 +1,206 @@
+from BL7011.file_processing import (
+    batch_processing_dichroism,
+    extract_roi_series,
+    extract_spectra,
+    get_file_groups,
+    load_h5_image,
+)
+import shutil
+import numpy as np
+import h5py
+import pytest
+
+
+nexus_file = "BL7011/test_data/uncorrupted_frames/nexus16x16.h5"
+
+
+def test_extract_roi_series():
+    rois = [[0, 16, 0, 16], [2, 5, 3, 9], [10, 11, 10, 11]]
+    roi_sums, metadata_df = extract_roi_series([nexus_file, nexus_file], rois)
+
+    with h5py.File(nexus_file, "r") as h5_file:
+        frames = h5_file["entry1/instrument_1/detector_1/data"][:, 0].astype(float)
+        energy = h5_file["entry1/instrument_1/labview_data/beamline_energy"][:]
+
+    # Test case: Function should return a frames x ROIs array
+    assert roi_sums.shape == (2 * len(frames), len(rois))
+
+    # Test case: The sums should match summing the ROIs directly
+    for n, (r0, r1, c0, c1) in enumerate(rois):
+        expected = frames[:, r0:r1, c0:c1].sum(axis=(1, 2))
+        assert np.allclose(roi_sums[: len(frames), n], expected)
+        assert np.allclose(roi_sums[len(frames) :, n], expected)
+
+    # Test case: Each frame should be tagged with its labview data
+    assert len(metadata_df) == len(roi_sums)
+    assert np.allclose(metadata_df["beamline_energy"][: len(frames)], energy)
+
+    # Test case: A small memory budget should give the same result
+    small_sums, _ = extract_roi_series(nexus_file, rois, max_memory_mb=1e-3)
+    assert np.allclose(small_sums, roi_sums[: len(frames)])
+
+    # Test case: Function should raise a ValueError for an invalid ROI
+    with pytest.raises(ValueError):
+        extract_roi_series(nexus_file, [[5, 2, 0, 16]])
+    with pytest.raises(ValueError):
+        extract_roi_series(nexus_file, [[0, 32, 0, 16]])
+
+
+def test_batch_processing_dichroism_incremental(tmp_path):
+    for name, polarization in [("scan_HLP.h5", 0), ("scan_VLP.h5", 2)]:
+        path_file = tmp_path / name
+        shutil.copy(nexus_file, path_file)
+        with h5py.File(path_file, "r+") as h5_file:
+            h5_file["entry1/instrument_1/labview_data/EPU_Polarization"][:] = polarization
+
+    kwargs = dict(key_common="detector_rotate", key_variable="EPU_Polarization")
+    path_dir = str(tmp_path) + "/"
+
+    # Test case: The first run should compute the pair, a dry run should
+    # list it without writing anything
+    assert len(batch_processing_dichroism(path_dir, dry_run=True, **kwargs)) == 1
+    assert not list(tmp_path.glob("processed_*.h5"))
+    assert len(batch_processing_dichroism(path_dir, **kwargs)) == 1
+    assert len(list(tmp_path.glob("processed_XLD*.h5"))) == 1
+
+    # Test case: A rerun should skip the up-to-date output
+    assert batch_processing_dichroism(path_dir, **kwargs) == []
+
+    # Test case: Asking for pyramids should add them to the up-to-date output
+    assert len(batch_processing_dichroism(path_dir, pyramid=True, **kwargs)) == 1
+    assert batch_processing_dichroism(path_dir, pyramid=True, **kwargs) == []
+
+    # Test case: Asking for the figures should save them for the up-to-date output
+    assert len(batch_processing_dichroism(path_dir, pyramid=True, save_figure=True, **kwargs)) == 1
+    assert len(list(tmp_path.glob("processed_XLD*.png"))) == 1
+    assert batch_processing_dichroism(path_dir, pyramid=True, save_figure=True, **kwargs) == []
+
+    # Test case: Changing the parameters, an input or forcing should recompute
+    assert len(batch_processing_dichroism(path_dir, mode="asymmetry", **kwargs)) == 1
+    assert len(batch_processing_dichroism(path_dir, mode="asymmetry", force=True, **kwargs)) == 1
+    with h5py.File(tmp_path / "scan_VLP.h5", "r+") as h5_file:
+        h5_file["entry1/instrument_1/labview_data/fake"][0] = 1
+    assert len(batch_processing_dichroism(path_dir, mode="asymmetry", **kwargs)) == 1
+
+
+def test_binning(tmp_path):
+    image = load_h5_image(nexus_file)
+    dark = np.full(image.shape[1:], 3.0)
+
+    # Test case: Binning on read sums blocks of pixels, the dark is binned alike
+    binned = load_h5_image(nexus_file, binning=4, dark=dark)
+    assert binned.shape == (image.shape[0], image.shape[1] // 4, image.shape[2] // 4)
+    expected = (image - 3).reshape(image.shape[0], image.shape[1] // 4, 4, -1, 4).sum(axis=(2, 4))
+    assert np.allclose(binned, expected)
+
+    # Test case: The binning is carried through to the processed data file
+    for name, polarization in [("scan_RCP.h5", 1), ("scan_LCP.h5", -1)]:
+        path_file = tmp_path / name
+        shutil.copy(nexus_file, path_file)
+        with h5py.File(path_file, "r+") as h5_file:
+            h5_file["entry1/instrument_1/labview_data/EPU_Polarization"][:] = polarization
+    batch_processing_dichroism(
+        str(tmp_path) + "/",
+        key_common="detector_rotate",
+        key_variable="EPU_Polarization",
+        binning=2,
+    )
+    (path_processed,) = tmp_path.glob("processed_XCD*.h5")
+    with h5py.File(path_processed, "r") as h5_file:
+        assert h5_file["process/binning"][()] == 2
+        assert h5_file["process/image_dichro"].shape == (image.shape[1] // 2, image.shape[2] // 2)
+
+
+def test_load_h5_image_into_buffer():
+    image = load_h5_image(nexus_file, "i0 blade")
+    assert image.dtype == float
+
+    # Test case: The image is read into (and normalized in) the given buffer
+    buffer = np.empty_like(image)
+    assert load_h5_image(nexus_file, "i0 blade", out=buffer) is buffer
+    assert np.array_equal(buffer, image)
+    with h5py.File(nexus_file, "r") as h5_file:
+        raw = h5_file["entry1/instrument_1/detector_1/data"][0]
+        blade = h5_file["entry1/instrument_1/labview_data/XS111LeftBladecurrent_diode"][0]
+    assert np.allclose(image, raw / blade)
+
+
+def test_batch_processing_dichroism_prefetch(tmp_path, capsys):
+    from BL7011 import synthetic as sy
+
+    kwargs = dict(key_common="sample_lift", key_variable="EPU_Polarization", reuse_figure=True)
+    results = {}
+    for prefetch in [0, 2]:
+        path_dir = str(tmp_path / f"prefetch_{prefetch}") + "/"
+        sy.write_campaign(
+            path_dir,
+            positions={"sample_lift": [1.0, 2.0, 3.0, 4.0]},
+            layout="both",
+            n_images=3,
+            frame_shape=(16, 16),
+            seed=0,
+        )
+        recomputed = batch_processing_dichroism(path_dir, prefetch=prefetch, verbose=bool(prefetch), **kwargs)
+        assert len(recomputed) == 8
+        results[prefetch] = {}
+        for path_processed in recomputed:
+            with h5py.File(path_processed, "r") as h5_file:
+                results[prefetch][path_processed.split("/")[-1]] = h5_file["process/image_dichro"][()]
+
+    # Test case: Prefetching the groups gives the same images and reports the overlap
+    assert results[0].keys() == results[2].keys()
+    for name, image in results[0].items():
+        assert np.array_equal(image, results[2][name])
+    assert "overlapped with the processing" in capsys.readouterr().out
+
+    # Test case: Up-to-date groups are not loaded again
+    assert batch_processing_dichroism(path_dir, prefetch=2, **kwargs) == []
+
+
+def test_extract_spectra(tmp_path):
+    from BL7011 import synthetic as sy
+
+    energies = [700.0, 701.5, 703.0]
+    path_dir = str(tmp_path) + "/"
+    sy.write_campaign(
+        path_dir,
+        positions={"beamline_energy": energies},
+        layout="both",
+        n_images=2,
+        n_exposures=3,
+        frame_shape=(16, 16),
+        seed=0,
+    )
+    file_df, _, _ = get_file_groups(
+        path_dir, key_common="EPU_Polarization", key_variable="beamline_energy"
+    )
+    roi = [2, 10, 4, 12]
+    spectra = extract_spectra(file_df, roi, correction="i0 blade")
+    assert list(spectra.index) == energies
+    assert list(spectra.columns) == ["RCP", "LCP", "XCD", "HLP", "VLP", "XLD"]
+
+    # Test case: The spectra are the ROI sums of the averaged, corrected images
+    for path, energy, polarization in file_df[["path", "beamline_energy", "EPU_Polarization"]].values:
+        name = {1: "RCP", -1: "LCP", 0: "HLP", 2: "VLP"}[polarization]
+        image = load_h5_image(path, "i0 blade").mean(axis=0)
+        assert np.isclose(spectra.loc[energy, name], image[2:10, 4:12].sum())
+    assert np.allclose(spectra["XCD"], spectra["RCP"] - spectra["LCP"])
+    assert np.allclose(spectra["XLD"], spectra["HLP"] - spectra["VLP"])
+
+    # Test case: Reading the files in several processes gives the same spectra
+    parallel = extract_spectra(list(file_df["path"]), roi, correction="i0 blade", workers=2)
+    assert np.allclose(parallel, spectra)
+
+
+def test_batch_processing_dichroism_verbose(tmp_path, capsys):
+    from BL7011 import synthetic as sy
+
+    path_dir = str(tmp_path) + "/"
+    sy.write_campaign(
+        path_dir, positions={"sample_lift": [1.0]}, layout="both", n_images=3, frame_shape=(16, 16), seed=0
+    )
+    kwargs = dict(key_common="sample_lift", key_variable="EPU_Polarization", reuse_figure=True, verbose=True)
+    # Test case: Verbose runs display the files of every pair, in the batch and in the prefetch path
+    assert len(batch_processing_dichroism(path_dir, prefetch=0, **kwargs)) == 2
+    assert len(batch_processing_dichroism(path_dir, prefetch=1, force=True, **kwargs)) == 2
+    assert "EPU_Polarization" in capsys.readouterr().out
@@ -53,3 +53,46 @@ def test_import_broken_h5(filename, average):
     # Test case: Function should handle region of interest (ROI) and return correct shape
     roi = [0, 10, 0, 10]
     assert import_broken_h5(filename, average=average, roi=roi).shape[1:] == (10, 10)
+
+
+def test_import_broken_h5_reducer(tmp_path):
+    import h5py
+    import numpy as np
+    from BL7011 import synthetic as sy
+
+    h5filename, _ = sy.write_broken_pair(
+        str(tmp_path / "scan"),
+        n_positions=3,
+        average=10,
+        frame_shape=(8, 8),
+        missing_frames=[25],
+        seed=0,
+    )
+    with h5py.File(h5filename, "a") as f:
+        frames = f["entry/data/data"][()].astype(float)
+        f["entry/data/data"][12, 3, 3] = 60000
+        frames[12, 3, 3] = 60000
+    roi = [0, 8, 0, 8]
+
+    # Test case: The median rejects the cosmic-ray hit of the second position
+    median = import_broken_h5(h5filename, roi=roi, reducer="median")
+    assert np.allclose(median[1], np.median(frames[10:20], axis=0))
+    mean = import_broken_h5(h5filename, roi=roi)
+    clipped = import_broken_h5(h5filename, roi=roi, reducer="sigma_clip", sigma=2.5)
+    assert mean[1, 3, 3] > median[1, 3, 3] + 1000
+    assert abs(clipped[1, 3, 3] - median[1, 3, 3]) < 100
+
+    with pytest.raises(ValueError):
+        import_broken_h5(h5filename, roi=roi, reducer="mode")
+
+
+def test_import_broken_h5_binning():
+    import numpy as np
+
+    filename = "BL7011/test_data/missing_frames/ccd_data16x16_2.h5"
+    averages = import_broken_h5(filename, average=1, roi=[0, 16, 0, 16])
+    binned = import_broken_h5(filename, average=1, roi=[0, 16, 2, 14], binning=4)
+
+    # Test case: Sums of 4 x 4 blocks of the roi, also for the replaced frames
+    assert binned.shape == (len(averages), 4, 3)
+    assert np.allclose(binned, averages[:, :, 2:14].reshape(-1, 4, 4, 3, 4).sum(axis=(2, 4)))
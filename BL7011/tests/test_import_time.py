@@ -0,0 +1,58 @@
+import subprocess
+import sys
+import pytest
+
+# The heavy dependencies are imported lazily, so that importing the package
+# and its processing modules is dominated by numpy, h5py and pandas.
+MODULES = [
+    "BL7011",
+    "BL7011.file_processing",
+    "BL7011.import_functions",
+    "BL7011.repair",
+    "BL7011.registration",
+    "BL7011.reciprocal",
+    "BL7011.cli",
+]
+LAZY_MODULES = ["matplotlib", "IPython", "sklearn", "tqdm", "scipy"]
+
+# Upper limits for the cumulative import time (in seconds) reported by
+# python -X importtime (see also the Imports benchmarks). The limits are
+# multiplied by the tolerance, so that only a heavy dependency imported at
+# the top level again fails the test on a loaded machine.
+IMPORT_TIME_LIMITS = {
+    "BL7011.file_processing": 1.5,
+    "BL7011.repair": 1.0,
+}
+TOLERANCE = 3
+
+
+def import_time(module):
+    # Cumulative import time in seconds of a module in a fresh interpreter
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6
+    raise RuntimeError(f"No import time found for {module}")
+
+
+@pytest.mark.parametrize("module, limit", IMPORT_TIME_LIMITS.items())
+def test_import_time(module, limit):
+    # Test case: The best of three imports should be below the limit
+    assert min(import_time(module) for _ in range(3)) < limit * TOLERANCE
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_heavy_dependencies_are_lazy(module):
+    # Test case: Importing the module should not import the heavy dependencies
+    code = f"import sys, {module}; print(' '.join(sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    imported = {name.split(".")[0] for name in result.stdout.split()}
+    assert not imported.intersection(LAZY_MODULES)
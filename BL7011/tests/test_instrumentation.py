@@ -0,0 +1,49 @@
+import json
+
+from BL7011 import instrumentation as ins
+from BL7011 import file_processing as fp
+from BL7011.repair import h5repair
+
+nexus_file = "BL7011/test_data/uncorrupted_frames/nexus16x16.h5"
+
+
+def test_stages_are_not_recorded_by_default():
+    ins.reset()
+    assert not ins.is_enabled()
+    fp.load_h5_image(nexus_file)
+    assert ins.report().stats == {}
+
+
+def test_profile_records_stages(tmp_path):
+    path_json = tmp_path / "report.json"
+    with ins.profile(str(path_json)) as report:
+        image = fp.load_h5_image(nexus_file)
+    assert not ins.is_enabled()
+
+    stages = report.to_dict()["stages"]
+    for name in ("open", "read", "normalize"):
+        assert stages["file_processing." + name]["calls"] == 1
+    # The raw image is read as 16 bit integers and converted to float while reading
+    assert "file_processing.convert" not in stages
+    assert stages["file_processing.read"]["bytes_read"] == image.nbytes // 4
+    assert report.wall_total >= stages["file_processing.read"]["wall_s"]
+    assert "file_processing.read" in report.summary()
+
+    with open(path_json) as f:
+        assert json.load(f)["stages"].keys() == stages.keys()
+
+
+def test_profile_records_repair(tmp_path):
+    with ins.profile() as report:
+        h5repair(
+            "BL7011/test_data/missing_frames/ccd_data16x16_2.h5",
+            jsonfilename="BL7011/test_data/missing_frames/labview_2.json",
+            outputfilename=str(tmp_path / "repaired.h5"),
+            roi=[0, 10, 0, 10],
+            average=1,
+        )
+    stages = report.to_dict()["stages"]
+    assert stages["repair.h5repair"]["calls"] == 1
+    assert stages["import_functions.import_broken_h5"]["calls"] == 1
+    assert stages["import_functions.read"]["bytes_read"] > 0
+    assert stages["repair.write"]["bytes_written"] > 0
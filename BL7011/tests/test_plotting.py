@@ -0,0 +1,87 @@
+from BL7011.plotting import (
+    display_percentiles,
+    downsample_for_display,
+    plot_image,
+    plot_three_images_dichroism,
+    plot_contact_sheet,
+)
+import h5py
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+matplotlib.use("Agg")
+
+
+def test_display_percentiles():
+    rng = np.random.default_rng(0)
+    image = rng.random((1024, 1024))
+
+    # Test case: The estimate should be close to the exact percentiles
+    estimate = display_percentiles(image, (5, 95))
+    assert np.allclose(estimate, np.percentile(image, (5, 95)), atol=0.01)
+
+    # Test case: A second call should return the cached values
+    assert display_percentiles(image, (5, 95)) is estimate
+
+    # Test case: An image modified in place (a reused buffer) should get new
+    # percentiles
+    image *= 2
+    assert np.allclose(display_percentiles(image, (5, 95)), 2 * estimate)
+
+
+@pytest.mark.parametrize("shape, max_pixels, expected", [((2048, 2048), 256, (256, 256)),
+                                                         ((100, 50), 256, (100, 50)),
+                                                         ((100, 50), 30, (25, 12))])
+def test_downsample_for_display(shape, max_pixels, expected):
+    image = np.ones(shape)
+    reduced, extent = downsample_for_display(image, max_pixels)
+
+    # Test case: The reduced image should have the expected shape and keep
+    # the intensity scale
+    assert reduced.shape == expected
+    assert np.allclose(reduced, 1)
+    assert extent[1] <= shape[1] - 0.5 and extent[3] <= shape[0] - 0.5
+
+
+def test_plot_reuse_figure(tmp_path):
+    images = [np.random.default_rng(n).random((256, 256)) + 1 for n in range(3)]
+
+    # Test case: Reusing the figure should not open new figures
+    plt.close("all")
+    for n in range(3):
+        plot_three_images_dichroism(*images, title_main=str(n), reuse_figure=True,
+                                    save_path=str(tmp_path / f"{n}.png"))
+        plot_image(images[0], reuse_figure=True)
+    assert len(plt.get_fignums()) == 2
+    assert (tmp_path / "2.png").is_file()
+    plt.close("all")
+
+
+def test_plot_contact_sheet(tmp_path):
+    rng = np.random.default_rng(0)
+    sources = []
+    for n, energy in enumerate([709.0, 705.0, 707.0]):
+        path_file = str(tmp_path / f"processed_XCD_{n}.h5")
+        with h5py.File(path_file, "w") as h5_file:
+            h5_file.create_dataset("process/image_dichro", data=rng.normal(size=(128, 128)))
+            h5_file.create_dataset("pol_a/beamline_energy", data=energy)
+        sources.append(path_file)
+    sources.append({"image": rng.normal(size=(100, 100)), "beamline_energy": 706.0})
+
+    save_path = tmp_path / "sheet.png"
+    fig = plot_contact_sheet(
+        sources, sort_by="beamline_energy", tile_pixels=32, save_path=str(save_path)
+    )
+
+    # Test case: The sheet should be saved and hold a single mosaic image
+    assert save_path.is_file()
+    assert len(fig.axes[0].images) == 1
+
+    # Test case: The thumbnails should be sorted by the metadata
+    assert [text.get_text() for text in fig.axes[0].texts] == ["705", "706", "707", "709"]
+
+    # Test case: Function should raise a ValueError for an unknown scaling
+    with pytest.raises(ValueError):
+        plot_contact_sheet(sources, scaling="sqrt")
@@ -0,0 +1,43 @@
+from BL7011.pyramid import bin_image, build_pyramid, write_pyramid, read_preview
+import h5py
+import numpy as np
+import pytest
+
+
+def test_build_pyramid():
+    image = np.arange(256 * 200, dtype=float).reshape(256, 200)
+    pyramid = build_pyramid(image, min_size=32)
+
+    # Test case: Levels should be binned by 2 until the smaller side drops below min_size
+    assert list(pyramid.keys()) == [2, 4]
+    assert pyramid[2].shape == (128, 100)
+    assert pyramid[4].shape == (64, 50)
+
+    # Test case: Each level should be the mean of the binned pixels
+    assert np.allclose(pyramid[4], bin_image(image, 4))
+    assert pyramid[2][0, 0] == image[:2, :2].mean()
+
+    # Test case: Stacks should be binned along the last two axes only
+    assert build_pyramid(np.ones((3, 1, 128, 128)))[2].shape == (3, 1, 64, 64)
+
+
+@pytest.mark.parametrize("shape, index", [((512, 512), None), ((5, 512, 512), 3)])
+def test_read_preview(tmp_path, shape, index):
+    image = np.random.default_rng(0).random(shape)
+    path_file = str(tmp_path / "preview.h5")
+    with h5py.File(path_file, "w") as h5_file:
+        h5_file.create_dataset("image", data=image)
+        h5_file.create_dataset("no_pyramid", data=image)
+        write_pyramid(h5_file, "image", image)
+
+    full = image if index is None else image[index]
+
+    # Test case: The coarsest level that still fills the display should be read
+    preview, factor = read_preview(path_file, "image", max_pixels=100, index=index)
+    assert factor == 4
+    assert np.allclose(preview, bin_image(full, 4), atol=1e-6)
+
+    # Test case: Without a pyramid the image should be read with a stride
+    preview, factor = read_preview(path_file, "no_pyramid", max_pixels=100, index=index)
+    assert factor == 5
+    assert np.array_equal(preview, full[::5, ::5])
@@ -0,0 +1,63 @@
+import h5py
+import numpy as np
+from BL7011 import reciprocal as rc
+from BL7011 import synthetic as sy
+
+GEOMETRY = dict(distance=0.2, pixel_size=1e-3)
+
+
+def test_pixel_q():
+    k = 2 * np.pi * 700 / rc.HC_EV_ANGSTROM
+    q = rc.pixel_q((17, 15), 60.0, 30.0, 700, **GEOMETRY)
+    assert q.shape == (3, 17, 15)
+    # The center pixel of a specular reflection is along the surface normal
+    assert np.allclose(q[:, 8, 7], [0, 0, 2 * k * np.sin(np.radians(30))])
+    # |q| only depends on the scattering angle, not on the sample angle
+    assert np.allclose(
+        np.linalg.norm(q, axis=0), np.linalg.norm(rc.pixel_q((17, 15), 60.0, 10.0, 700, **GEOMETRY), axis=0)
+    )
+    # Rows off the arm axis change the scattering angle
+    assert q[2, 0, 7] < q[2, 8, 7] < q[2, 16, 7]
+
+
+def test_grid_reciprocal_space(tmp_path):
+    path_files = []
+    for n, theta in enumerate([[10.0, 12.0], [14.0, 16.0]]):
+        path_file = sy.write_nexus_file(
+            str(tmp_path / f"theta_{n}.h5"),
+            n_images=2,
+            n_exposures=3,
+            frame_shape=(16, 16),
+            labview={
+                "sample_rotate_steppertheta": theta,
+                "detector_rotate": [2 * t for t in theta],
+                "beamline_energy": 700.0,
+            },
+            seed=n,
+        )
+        path_files.append(path_file)
+
+    kwargs = dict(bins=(8, 6, 20), correction="i0 blade", **GEOMETRY)
+    output = rc.grid_reciprocal_space(path_files, str(tmp_path / "rsm_1.h5"), **kwargs)
+    output_parallel = rc.grid_reciprocal_space(
+        path_files, str(tmp_path / "rsm_2.h5"), workers=2, **kwargs
+    )
+
+    total = 0.0
+    for path_file in path_files:
+        with h5py.File(path_file, "r") as f:
+            data = f["entry1/instrument_1/detector_1/data"][()].astype(float)
+            blade = f["entry1/instrument_1/labview_data/XS111LeftBladecurrent_diode"][()]
+            total += (data.sum(axis=(1, 2, 3)) / blade).sum()
+
+    with h5py.File(output, "r") as f, h5py.File(output_parallel, "r") as f_parallel:
+        assert f["data"].shape == (8, 6, 20)
+        assert f["data"].chunks is not None
+        # Every pixel of every exposure falls into the grid spanned by the scan
+        assert f["counts"][()].sum() == 4 * 3 * 16 * 16
+        assert np.isclose(f["intensity"][()].sum(), total)
+        assert np.array_equal(f["counts"][()], f_parallel["counts"][()])
+        assert np.allclose(f["intensity"][()], f_parallel["intensity"][()])
+        # The specular rod runs along qz
+        assert np.isclose(f["qz"][0], rc.pixel_q((16, 16), 20.0, 10.0, 700, **GEOMETRY)[2].min())
+        assert abs(f["qx"][0]) < 0.05 and abs(f["qx"][-1]) < 0.05
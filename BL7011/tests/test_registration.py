@@ -0,0 +1,102 @@
+import h5py
+import numpy as np
+import pytest
+from BL7011 import registration as rg
+from BL7011 import synthetic as sy
+from BL7011.data_processing import calculate_dichroism_from_file
+from BL7011.import_functions import import_broken_h5
+
+
+def _drifting_stack(n_frames, frame_shape=(32, 32), step=0.3, seed=0):
+    # Noisy frames of a pattern drifting on a random walk, and the shifts
+    # which align them with the first frame
+    rng = np.random.default_rng(seed)
+    image = sy.synthetic_image(frame_shape, polarization=-1)
+    shifts = np.cumsum(rng.normal(0, step, (n_frames, 2)), axis=0)
+    shifts -= shifts[0]
+    frames = rg.shift_frames(np.repeat(image[None], n_frames, axis=0), -shifts)
+    return rng.poisson(np.clip(frames, 0, None)).astype(float), shifts, image
+
+
+def test_estimate_shifts():
+    from scipy import fft
+
+    _, _, image = _drifting_stack(1)
+    shifts = np.array([[3, -2], [0.4, 1.3], [-5.3, 2.2]])
+    frames = rg.shift_frames(np.repeat(image[None], 3, axis=0), -shifts)
+    estimated = rg.estimate_shifts(fft.fft2(frames), fft.fft2(image))
+    assert np.allclose(estimated, shifts, atol=1e-6)
+    for normalization in ["phase", None]:
+        estimated = rg.estimate_shifts(
+            fft.fft2(frames), fft.fft2(image), upsample_factor=1, normalization=normalization
+        )
+        assert np.all(estimated == np.round(shifts))
+
+    # Whole pixel shifts are circular shifts
+    assert np.allclose(rg.shift_frames(image, [2, -3]), np.roll(image, (2, -3), axis=(0, 1)))
+
+
+def test_register_stack_from_h5(tmp_path):
+    frames, shifts, image = _drifting_stack(1000)
+    path_file = str(tmp_path / "drift.h5")
+    with h5py.File(path_file, "w") as f:
+        f.create_dataset("data", data=frames[None])
+        # A tiny memory budget transforms a few frames at a time
+        registered, estimated = rg.register_stack(f["data"], index=0, max_memory_mb=0.1)
+
+    assert estimated.shape == (1000, 2)
+    assert np.abs(estimated - shifts).max() < 0.3
+    # The registered mean is sharp, the plain mean is smeared by the drift
+    error = np.abs(registered - image).max()
+    assert error < 0.2 * np.abs(frames.mean(axis=0) - image).max()
+
+
+def test_register_stack_keeps_the_input():
+    frames, _, _ = _drifting_stack(20)
+    original = frames.copy()
+    dark = np.full(frames.shape[1:], 2.0)
+    rg.register_stack(frames, dark=dark)
+    rg.register_stack(frames, reference=frames[3], dark=dark, binning=2)
+    assert np.array_equal(frames, original)
+
+
+def test_register_broken_h5_and_dichroism(tmp_path):
+    h5filename, _ = sy.write_broken_pair(
+        str(tmp_path / "scan"),
+        n_positions=3,
+        average=10,
+        frame_shape=(32, 32),
+        missing_frames=[25],
+        seed=0,
+    )
+    frames, shifts, _ = _drifting_stack(29, step=1.0)
+    with h5py.File(h5filename, "a") as f:
+        f["entry/data/data"][...] = frames
+
+    averages, estimated = import_broken_h5(h5filename, roi=[0, 32, 0, 32], register=True)
+    assert averages.shape == (3, 32, 32)
+    assert estimated.shape == (3, 10, 2)
+    # Shifts relative to the first frame of each position
+    assert np.abs(estimated[1] - (shifts[10:20] - shifts[10])).max() < 0.5
+    assert np.all(np.isnan(estimated[2, -1]))
+    with pytest.raises(ValueError):
+        import_broken_h5(h5filename, roi=[0, 32, 0, 32], register=True, reducer="median")
+
+    path_files = []
+    for pol in (-1, 1):
+        path_file = sy.write_nexus_file(
+            str(tmp_path / f"pol_{pol}.h5"),
+            n_images=1,
+            n_exposures=20,
+            frame_shape=(32, 32),
+            polarization=pol,
+        )
+        with h5py.File(path_file, "a") as f:
+            f["entry1/instrument_1/detector_1/data"][0] = frames[:20]
+        path_files.append(path_file)
+    im_dichro, im_pol_a, im_pol_b, estimated = calculate_dichroism_from_file(
+        *path_files, register=True
+    )
+    assert estimated.shape == (2, 20, 2)
+    assert np.abs(estimated[0] - shifts[:20]).max() < 0.5
+    assert np.allclose(im_dichro, im_pol_a - im_pol_b)
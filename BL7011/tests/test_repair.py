@@ -19,11 +19,12 @@ import pytest
         ),
     ],
 )
-def test_h5repair(filename_h5, filename_json, average, roi):
+def test_h5repair(filename_h5, filename_json, average, roi, tmp_path):
     assert (
         h5repair(
             filename_h5,
             jsonfilename=filename_json,
+            outputfilename=str(tmp_path / "repaired.h5"),
             roi=roi,
             average=average,
             verbose=True,
@@ -32,15 +33,47 @@ def test_h5repair(filename_h5, filename_json, average, roi):
     )
 
 
-def test_h5repair_displays_warning():
+def test_h5repair_displays_warning(tmp_path):
     with pytest.warns(UserWarning):
         assert (
             h5repair(
                 "BL7011/test_data/missing_frames/ccd_data16x16.h5",
                 jsonfilename="BL7011/test_data/missing_frames/labview.json",
+                outputfilename=str(tmp_path / "repaired.h5"),
                 roi=[0, 2048, 0, 2048],
                 average=10,
                 verbose=True,
             )
             is None
         )
+
+
+def test_h5repair_copies_chunks(tmp_path):
+    import h5py
+    import numpy as np
+    from BL7011 import synthetic as sy
+
+    h5filename, jsonfilename = sy.write_broken_pair(
+        str(tmp_path / "scan"),
+        n_positions=12,
+        average=1,
+        frame_shape=(16, 16),
+        missing_frames=[5],
+        compression="gzip",
+        seed=0,
+    )
+    copied, decoded = str(tmp_path / "copied.h5"), str(tmp_path / "decoded.h5")
+    options = dict(average=1, roi=[0, 16, 0, 16], missing_frames=[5])
+    h5repair(h5filename, jsonfilename, copied, **options)
+    # A dtype different from the recorded one needs the frames to be decoded
+    h5repair(h5filename, jsonfilename, decoded, dtype="float32", **options)
+
+    with h5py.File(copied, "r") as f_copied, h5py.File(decoded, "r") as f_decoded:
+        data = f_copied["entry1/instrument_1/detector_1/data"]
+        assert data.shape == (12, 1, 16, 16)
+        assert data.dtype == np.uint16 and data.compression == "gzip"
+        assert np.array_equal(data[()], f_decoded["entry1/instrument_1/detector_1/data"][()])
+        assert not data[5].any()
+        # The chunks of the recorded frames are the compressed chunks of the export
+        with h5py.File(h5filename, "r") as f:
+            assert data.id.read_direct_chunk((6, 0, 0, 0)) == f["entry/data/data"].id.read_direct_chunk((5, 0, 0))
@@ -0,0 +1,82 @@
+import h5py
+import numpy as np
+import pytest
+from BL7011 import file_processing as fp
+from BL7011 import synthetic as sy
+from BL7011.import_functions import import_broken_h5
+from BL7011.repair import h5repair, read_repaired_h5
+from BL7011.stack import DetectorStack
+
+
+def test_detector_stack_slicing_and_reductions(tmp_path):
+    path_file = sy.write_nexus_file(
+        str(tmp_path / "image.h5"), n_images=2, n_exposures=30, frame_shape=(16, 16), seed=0
+    )
+    with h5py.File(path_file, "r") as f:
+        frames = f["entry1/instrument_1/detector_1/data"][1].astype(float)
+
+    # A tiny memory budget reads a few frames per block
+    stack = DetectorStack(path_file, index=1, max_memory_mb=0.01)
+    assert stack.shape == (30, 16, 16)
+    assert np.array_equal(np.asarray(stack), frames)
+
+    part = stack[3:25:2, 4:, ::3][1:]
+    assert isinstance(part, DetectorStack)
+    assert part.shape == frames[3:25:2, 4:, ::3][1:].shape
+    assert np.array_equal(np.asarray(part), frames[3:25:2, 4:, ::3][1:])
+    assert np.array_equal(stack[5], frames[5])
+    assert np.array_equal(part[:, 2], frames[3:25:2, 4:, ::3][1:, 2])
+
+    for axis in [None, 0, (1, 2), 2]:
+        assert np.allclose(part.sum(axis=axis), frames[3:25:2, 4:, ::3][1:].sum(axis=axis))
+        assert np.allclose(stack.mean(axis=axis), frames.mean(axis=axis))
+        assert np.allclose(stack.std(axis=axis), frames.std(axis=axis))
+
+    with pytest.raises(ValueError):
+        DetectorStack(path_file)
+    with pytest.raises(IndexError):
+        stack[::-1].compute()
+
+
+def test_lazy_normalization(tmp_path):
+    path_file = sy.write_nexus_file(
+        str(tmp_path / "image.h5"),
+        n_images=1,
+        n_exposures=4,
+        frame_shape=(8, 8),
+        labview={"XS111LeftBladecurrent_diode": 2000.0},
+    )
+    dark = np.full((8, 8), 3.0)
+    stack = fp.load_h5_image(path_file, "i0 blade", dark=dark, lazy=True)
+    assert isinstance(stack, DetectorStack)
+    assert np.allclose(np.asarray(stack), fp.load_h5_image(path_file, "i0 blade", dark=dark))
+    assert stack.labview["XS111LeftBladecurrent_diode"] == 2000.0
+    # The dark of a selection
+    part = stack[:, 2:6].normalize("i0 blade", dark=dark[2:6])
+    assert np.allclose(part.mean(axis=0), np.asarray(stack)[:, 2:6].mean(axis=0))
+    with pytest.raises(ValueError):
+        fp.load_h5_image(path_file, lazy=True, binning=2)
+
+
+def test_lazy_broken_and_repaired(tmp_path):
+    h5filename, jsonfilename = sy.write_broken_pair(
+        str(tmp_path / "scan"),
+        n_positions=3,
+        average=10,
+        frame_shape=(16, 16),
+        missing_frames=[25],
+        labview={"beamline_energy": [700.0, 701.0, 702.0]},
+        seed=0,
+    )
+    stack = import_broken_h5(h5filename, roi=[2, 14, 0, 16], dark=np.full((16, 16), 5.0), lazy=True)
+    assert stack.shape == (29, 12, 16)
+    with h5py.File(h5filename, "r") as f:
+        frames = f["entry/data/data"][:, 2:14].astype(float) - 5
+    assert np.allclose(stack[:10].mean(axis=0), frames[:10].mean(axis=0))
+
+    outputfilename = str(tmp_path / "scan_repaired.h5")
+    h5repair(h5filename, jsonfilename, outputfilename, roi=[0, 16, 0, 16])
+    repaired = read_repaired_h5(outputfilename, lazy=True)
+    assert repaired.shape == (3, 16, 16)
+    assert np.allclose(np.asarray(repaired), read_repaired_h5(outputfilename))
+    assert np.allclose(repaired[1:].labview["beamline_energy"], [701.0, 702.0])
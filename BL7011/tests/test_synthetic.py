@@ -0,0 +1,69 @@
+import h5py
+import numpy as np
+from BL7011 import file_processing as fp
+from BL7011 import synthetic as sy
+from BL7011.repair import h5repair, uncorrupted_h5_structure
+from BL7011.tools import where_is_my_frame_missing
+
+
+def test_write_nexus_file(tmp_path):
+    path_file = sy.write_nexus_file(
+        str(tmp_path / "nexus.h5"),
+        n_images=3,
+        n_exposures=2,
+        frame_shape=(32, 48),
+        polarization=-1,
+        labview={"beamline_energy": [706.0, 707.0, 708.0]},
+        compression="gzip",
+        seed=0,
+    )
+    with h5py.File(path_file, "r") as f:
+        for path in uncorrupted_h5_structure():
+            assert path in f
+        data = f["entry1/instrument_1/detector_1/data"]
+        assert data.shape == (3, 2, 32, 48)
+        assert data.compression == "gzip"
+        labview = f["entry1/instrument_1/labview_data"]
+        assert np.all(labview["EPU_Polarization"][()] == -1)
+        assert np.all(labview["beamline_energy"][()] == [706.0, 707.0, 708.0])
+    assert fp.load_h5_image(path_file).shape == (2, 32, 48)
+
+
+def test_write_campaign(tmp_path):
+    path_files = sy.write_campaign(
+        str(tmp_path) + "/",
+        positions={"sample_lift": [1.0, 2.0, 3.0]},
+        layout="both",
+        n_images=1,
+        frame_shape=(16, 16),
+    )
+    assert len(path_files) == 12
+    file_df, file_group_df, file_group = fp.get_file_groups(
+        str(tmp_path) + "/", key_common="sample_lift", key_variable="EPU_Polarization"
+    )
+    assert len(file_df) == 12
+    assert sorted(file_df["EPU_Polarization"].unique()) == [-1, 0, 1, 2]
+
+
+def test_write_broken_pair(tmp_path):
+    h5filename, jsonfilename = sy.write_broken_pair(
+        str(tmp_path / "scan"),
+        n_positions=6,
+        average=10,
+        frame_shape=(16, 16),
+        missing_frames=[24],
+        labview={"beamline_energy": np.arange(706.0, 712.0)},
+        seed=0,
+    )
+    assert h5filename.endswith("_0.h5") and jsonfilename.endswith("_documents.json")
+    with h5py.File(h5filename, "r") as f:
+        assert f["entry/data/data"].shape == (59, 16, 16)
+    # The gap in the timestamps is found after the last recorded frame
+    assert list(where_is_my_frame_missing(h5filename, n_images=10)) == [23]
+
+    outputfilename = str(tmp_path / "repaired.h5")
+    h5repair(h5filename, outputfilename=outputfilename, roi=[0, 16, 0, 16])
+    with h5py.File(outputfilename, "r") as f:
+        assert f["entry1/instrument_1/detector_1/data"].shape == (6, 1, 16, 16)
+        energy = f["entry1/instrument_1/labview_data/beamline_energy"][()]
+        assert np.all(energy == np.arange(706.0, 712.0))
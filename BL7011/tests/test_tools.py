@@ -1,4 +1,5 @@
 from BL7011.tools import (
+    bin_frames,
     get_positions_from_bluesky_json,
     where_is_my_frame_missing,
     h5tree,
@@ -69,3 +70,19 @@ def test_h5tree(filename):
 
     # Test case: Test if the returned list contains only strings
     assert all(isinstance(path, str) for path in h5tree(filename, return_paths=True))
+
+
+def test_bin_frames():
+    frames = np.arange(2 * 6 * 9, dtype=np.uint16).reshape(2, 6, 9)
+
+    # Test case: Sums of 2 x 2 blocks, the last column is left out
+    binned = bin_frames(frames, 2)
+    assert binned.shape == (2, 3, 4) and binned.dtype == float
+    assert binned[1, 2, 3] == frames[1, 4:6, 6:8].sum()
+    assert binned.sum() == frames[:, :, :8].sum()
+
+    # Test case: No binning only converts to float
+    assert np.all(bin_frames(frames, 1) == frames)
+
+    with pytest.raises(ValueError):
+        bin_frames(frames, 0)
@@ -0,0 +1,49 @@
+from BL7011.watch import watch_directory, is_h5_complete
+import os
+import shutil
+import h5py
+import pytest
+
+
+nexus_file = "BL7011/test_data/uncorrupted_frames/nexus16x16.h5"
+
+
+def copy_with_polarization(path_dir, name, polarization):
+    # Copy the nexus test file and set its polarization
+    path_file = os.path.join(path_dir, name)
+    shutil.copy(nexus_file, path_file)
+    with h5py.File(path_file, "r+") as h5_file:
+        h5_file["entry1/instrument_1/labview_data/EPU_Polarization"][:] = polarization
+    return path_file
+
+
+@pytest.mark.parametrize("process_existing, n_outputs", [(True, 1), (False, 0)])
+def test_watch_directory(tmp_path, process_existing, n_outputs):
+    copy_with_polarization(tmp_path, "scan_HLP.h5", 0)
+    copy_with_polarization(tmp_path, "scan_VLP.h5", 2)
+
+    latency_df = watch_directory(
+        str(tmp_path),
+        key_common="detector_rotate",
+        key_variable="EPU_Polarization",
+        poll_interval=0.05,
+        settle_time=0,
+        idle_timeout=0.5,
+        process_existing=process_existing,
+    )
+
+    # Test case: Only the pair of linear polarizations should be processed
+    assert len(latency_df) == n_outputs
+    if n_outputs:
+        assert os.path.basename(latency_df["output"][0]).startswith("processed_XLD")
+        assert os.path.isfile(latency_df["output"][0])
+        assert (latency_df["latency"] >= 0).all()
+
+
+def test_is_h5_complete(tmp_path):
+    # Test case: A truncated file should not count as complete
+    path_file = copy_with_polarization(tmp_path, "scan.h5", 0)
+    assert is_h5_complete(path_file)
+    with open(path_file, "r+b") as f:
+        f.truncate(1000)
+    assert not is_h5_complete(path_file)
@@ -1,10 +1,7 @@
 import json
 import numpy as np
 import h5py
-import matplotlib.pyplot as plt
 import math
-from sklearn.cluster import DBSCAN
-from sklearn.preprocessing import StandardScaler
 import warnings as w
 
 # from BL7011.import_functions import import_broken_h5
@@ -125,6 +122,9 @@ def where_is_my_frame_missing(
     # taking the difference between the timestamps
     diff_scan_times = np.diff(scan_times)
 
+    from sklearn.cluster import DBSCAN
+    from sklearn.preprocessing import StandardScaler
+
     X = diff_scan_times.reshape(-1, 1)
     # Standardize the data
     scaler = StandardScaler()
@@ -147,6 +147,8 @@ def where_is_my_frame_missing(
 
     # plot if wanted and highlight the outliers
     if plot:
+        import matplotlib.pyplot as plt
+
         plt.figure()
         plt.scatter(
             range(len(diff_scan_times)), diff_scan_times, c="blue", label="Data points"
@@ -169,6 +171,65 @@ def where_is_my_frame_missing(
     return outliers
 
 
+def frames_per_block(
+    frame_shape: tuple, itemsize: int = 4, n_arrays: int = 1, max_memory_mb: float = 512.0
+) -> int:
+    """
+    Estimates how many frames of a stack can be processed at once without the
+    working arrays exceeding a given memory budget. Used by the blocked
+    functions that work on whole (F, M, N) image stacks.
+
+    Parameters
+    ----------
+    frame_shape : tuple
+        Shape (M, N) of a single frame.
+    itemsize : int
+        Number of bytes per pixel of the working arrays (4 for float32).
+    n_arrays : int
+        Number of frame-sized working arrays held at the same time per frame.
+    max_memory_mb : float
+        Memory budget in MB for all working arrays of one block.
+
+    Returns
+    -------
+    n_frames : int
+        Number of frames per block, at least 1.
+    """
+    bytes_per_frame = int(np.prod(frame_shape)) * itemsize * n_arrays
+    return max(1, int(max_memory_mb * 2**20) // max(bytes_per_frame, 1))
+
+
+def bin_frames(frames: np.ndarray, binning: int = 1) -> np.ndarray:
+    """
+    Sums blocks of binning x binning pixels of the last two axes of a frame
+    or frame stack. Rows and columns which do not fill a whole bin are left
+    out. The sums are accumulated in float64 directly from the (integer)
+    detector data, so that no full resolution float copy is made.
+
+    Parameters
+    ----------
+    frames : np.ndarray
+        A (..., M, N) frame or frame stack.
+    binning : int
+        Binning factor along both axes, 1 only converts to float64.
+
+    Returns
+    -------
+    binned : np.ndarray
+        The (..., M // binning, N // binning) float64 frames.
+    """
+    if binning == 1:
+        return np.asarray(frames, dtype=float)
+    if binning < 1:
+        raise ValueError(f"binning has to be a positive integer, got {binning}")
+    rows = frames.shape[-2] // binning
+    cols = frames.shape[-1] // binning
+    cropped = frames[..., : rows * binning, : cols * binning]
+    return cropped.reshape(frames.shape[:-2] + (rows, binning, cols, binning)).sum(
+        axis=(-3, -1), dtype=float
+    )
+
+
 def h5tree(h5filename: str, return_paths: bool = False) -> None:
     """
     Prints the structure of an HDF5 file and the shape of the stored datasets.
@@ -0,0 +1,282 @@
+"""
+    This file contains a watch mode for processing COSMIC Scattering data
+    while it is being recorded. New h5 files in a directory are picked up as
+    soon as they are completely written and the dichroism of a file group is
+    calculated as soon as both polarizations of the group are present.
+
+    Authors: Dayne Sasaki, Damian Günzing
+"""
+import os
+import time
+import warnings as w
+
+import h5py
+import numpy as np
+import pandas as pd
+from BL7011 import file_processing as fp
+
+
+def is_h5_complete(path_file: str) -> bool:
+    """
+    Checks if an h5 file can be opened and its detector data read, i.e.,
+    if the file has been written completely.
+
+    Parameters
+    ----------
+    path_file : str
+        Whole path of the .h5 file.
+
+    Returns
+    -------
+    complete : bool
+        True if the file could be opened and read.
+    """
+    try:
+        with h5py.File(path_file, "r") as h5_file:
+            h5_file["entry1"]["instrument_1"]["detector_1"]["data"].shape
+        return True
+    except (OSError, KeyError):
+        return False
+
+
+def _new_file_event_waiter(path_dir: str, poll_interval: float):
+    """
+    Returns a function that blocks until a file in path_dir has been closed
+    after writing (or moved into path_dir) or poll_interval seconds have
+    passed. inotify is used when the inotify_simple package is available
+    (Linux), otherwise the function simply sleeps for poll_interval.
+    """
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        return lambda: time.sleep(poll_interval), None
+
+    inotify = INotify()
+    inotify.add_watch(path_dir, flags.CLOSE_WRITE | flags.MOVED_TO)
+    return lambda: inotify.read(timeout=int(poll_interval * 1000)), inotify
+
+
+def watch_directory(
+    path_dir: str,
+    *,
+    key_common: str | tuple[str],
+    key_variable: str,
+    search: str = "",
+    mode: str = "difference",
+    correction: str = "",
+    variable_stack: bool = False,
+    poll_interval: float = 2.0,
+    settle_time: float = 1.0,
+    idle_timeout: float = None,
+    process_existing: bool = False,
+    verbose: bool = False,
+    save_data: bool = True,
+    save_figure: bool = False,
+    plot: bool = False,
+) -> pd.DataFrame:
+    """
+    Watches a directory during a beamtime and processes the dichroism of each
+    file group as soon as it is complete, instead of rerunning
+    batch_processing_dichroism over the whole directory.
+
+    The directory is polled every poll_interval seconds (or woken up earlier
+    by inotify if the inotify_simple package is installed). A new .h5 file is
+    only taken into account once its size and modification time did not
+    change for settle_time seconds and it can be opened with h5py. Its
+    labview data is then added to the metadata index and, if the file
+    completes a pair of opposite polarizations of its file group, the
+    dichroism of that pair (and only that pair) is calculated with
+    file_processing.process_dichroism_group.
+
+    The latency from the file landing (the modification time of the last file
+    of the pair) to the processed output is printed for every pair.
+
+    The function runs until it is interrupted (KeyboardInterrupt) or no new
+    file has appeared for idle_timeout seconds.
+
+    Parameters
+    ----------
+    path_dir : str
+        Pathname of the directory (i.e., folder) which contains the h5 files.
+    key_common : str or tuple[str]
+        HDF5 keys/Labview entries which are common to a group of data files.
+    key_variable : str
+        HDF5 key/Labview entry holding the polarization state.
+    search : str
+        Only file names which contain this string are processed.
+    mode, correction, variable_stack, verbose, save_data, save_figure :
+        See file_processing.batch_processing_dichroism.
+    poll_interval : float
+        Seconds between two scans of the directory.
+    settle_time : float
+        Seconds the size and modification time of a new file have to be
+        unchanged before the file is considered as written.
+    idle_timeout : float
+        Stop watching if no new file appeared for this many seconds. None
+        watches until interrupted.
+    process_existing : bool
+        If True, the files already in the directory are processed as well.
+        Otherwise they are only added to the metadata index, so that groups
+        completed by a new file are still processed.
+    plot : bool
+        Plots the polarization and dichroism images of each processed pair.
+
+    Returns
+    -------
+    latency_df : pd.DataFrame
+        One row per processed pair with the output path, the 'landed' and
+        'processed' times (seconds since the epoch) and the 'latency' in
+        seconds.
+    """
+    if isinstance(key_common, str):
+        key_common = (key_common,)
+    keys = key_common + (key_variable,)
+
+    # Metadata index of all complete files, in the column order that
+    # process_dichroism_group expects
+    file_df = pd.DataFrame(columns=["path", *keys])
+    # Files which have been seen but are not completely written yet as
+    # path: (size, mtime, time the size and mtime were first seen)
+    pending = {}
+    # Files without the labview data of interest
+    ignored = set()
+    # Pairs of opposite polarizations which have already been processed
+    processed = set()
+    latency_list = []
+
+    wait_for_event, inotify = _new_file_event_waiter(path_dir, poll_interval)
+    first_scan = True
+    last_new_file = time.time()
+
+    try:
+        while True:
+            now = time.time()
+            indexed = set(file_df["path"])
+
+            # Look for new h5 files and check if the pending ones are done
+            for entry in os.scandir(path_dir):
+                path_file = entry.path
+                if (
+                    not entry.name.endswith(".h5")
+                    or entry.name.startswith("processed_")
+                    or search not in path_file
+                    or path_file in indexed
+                    or path_file in ignored
+                ):
+                    continue
+
+                stat = entry.stat()
+                if first_scan and not process_existing:
+                    # Files that are already there count as settled
+                    pending[path_file] = (stat.st_size, stat.st_mtime, -np.inf)
+                if pending.get(path_file, (None, None))[:2] != (
+                    stat.st_size,
+                    stat.st_mtime,
+                ):
+                    pending[path_file] = (stat.st_size, stat.st_mtime, now)
+                    last_new_file = now
+                    continue
+                if now - pending[path_file][2] < settle_time:
+                    continue
+                if not is_h5_complete(path_file):
+                    continue
+
+                # The file is complete, add it to the metadata index
+                del pending[path_file]
+                try:
+                    file_metadata = fp.read_file_metadata(path_file, keys)
+                except KeyError:
+                    w.warn(f"{path_file} has no labview data for {keys}, skipped")
+                    ignored.add(path_file)
+                    continue
+                file_df.loc[len(file_df)] = {"path": path_file, **file_metadata}
+                indexed.add(path_file)
+                if verbose:
+                    print("New file: " + path_file)
+
+                if first_scan and not process_existing:
+                    # Mark the pairs that are already complete as processed
+                    processed.update(_complete_pairs(file_df, key_common, key_variable))
+                    continue
+
+                # Process the pairs this file has completed
+                for pair in _complete_pairs(file_df, key_common, key_variable):
+                    if pair in processed:
+                        continue
+                    processed.add(pair)
+                    pair_df = _pair_files(file_df, pair, key_common, key_variable)
+                    landed = max(os.stat(p).st_mtime for p in pair_df["path"])
+
+                    save_paths = fp.process_dichroism_group(
+                        pair_df,
+                        path_dir=path_dir,
+                        key_variable=key_variable,
+                        mode=mode,
+                        correction=correction,
+                        variable_stack=variable_stack,
+                        verbose=verbose,
+                        save_data=save_data,
+                        save_figure=save_figure,
+                        plot=plot,
+                    )
+
+                    done = time.time()
+                    for save_path in save_paths:
+                        print(f"Latency {done - landed:.2f} s for {save_path}")
+                        latency_list.append(
+                            {
+                                "output": save_path,
+                                "landed": landed,
+                                "processed": done,
+                                "latency": done - landed,
+                            }
+                        )
+
+            first_scan = False
+
+            if idle_timeout is not None and time.time() - last_new_file > idle_timeout:
+                break
+
+            wait_for_event()
+    except KeyboardInterrupt:
+        print("Stopped watching " + path_dir)
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+    return pd.DataFrame(
+        latency_list, columns=["output", "landed", "processed", "latency"]
+    )
+
+
+def _complete_pairs(
+    file_df: pd.DataFrame, key_common: tuple[str], key_variable: str
+) -> set:
+    """
+    Returns all (key_common values, dichroism label) combinations in file_df
+    for which each polarization of the pair is present exactly once.
+    """
+    pairs = set()
+    for values, group_df in file_df.groupby(list(key_common)):
+        values = values if isinstance(values, tuple) else (values,)
+        for label, _, pol_a, _, pol_b in fp.DICHROISM_PAIRS:
+            n_a = np.sum(group_df[key_variable] == pol_a)
+            n_b = np.sum(group_df[key_variable] == pol_b)
+            if n_a * n_b == 1:
+                pairs.add((values, label))
+    return pairs
+
+
+def _pair_files(
+    file_df: pd.DataFrame, pair: tuple, key_common: tuple[str], key_variable: str
+) -> pd.DataFrame:
+    """
+    Returns the rows of file_df belonging to a pair from _complete_pairs.
+    """
+    values, label = pair
+    pols = [(pol_a, pol_b) for pair_label, _, pol_a, _, pol_b
+            in fp.DICHROISM_PAIRS if pair_label == label][0]
+    in_pair = file_df[key_variable].isin(pols)
+    for key, value in zip(key_common, values):
+        in_pair &= file_df[key] == value
+    return file_df[in_pair]
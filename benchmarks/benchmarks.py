@@ -0,0 +1,343 @@
+"""
+    Benchmarks of the processing pipeline on synthetic datasets of realistic
+    detector sizes (see BL7011.synthetic), written for airspeed velocity (asv).
+
+    Run them with "asv run" from the root of the repository; "asv publish"
+    and "asv preview" show the results of all benchmarked commits over time.
+    A quick run against the working tree is "asv run --python=same --quick".
+
+    The datasets are written once per benchmark class by setup_cache into the
+    temporary working directory of asv.
+
+    Authors: Damian Günzing
+"""
+import os
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import numpy as np
+from BL7011 import data_processing as dp
+from BL7011 import file_processing as fp
+from BL7011 import synthetic as sy
+from BL7011.import_functions import import_broken_h5
+from BL7011.repair import h5repair
+
+# Detector sizes of the benchmarks, full size is 2048 x 2048
+FRAME_SIZES = [512, 2048]
+
+
+class BrokenExport:
+    """
+    Repairing broken bluesky exports with one missing frame.
+    """
+
+    params = (FRAME_SIZES, [None, "gzip"])
+    param_names = ["frame_size", "compression"]
+    timeout = 600
+    n_positions = 4
+    average = 10
+
+    def setup_cache(self):
+        path_dir = os.path.abspath("broken_export")
+        os.makedirs(path_dir, exist_ok=True)
+        for size in FRAME_SIZES:
+            for compression in [None, "gzip"]:
+                sy.write_broken_pair(
+                    os.path.join(path_dir, f"scan_{size}_{compression}"),
+                    n_positions=self.n_positions,
+                    average=self.average,
+                    frame_shape=(size, size),
+                    missing_frames=[self.average + 3],
+                    compression=compression,
+                    seed=0,
+                )
+        return path_dir
+
+    def _path_base(self, path_dir, frame_size, compression):
+        return os.path.join(path_dir, f"scan_{frame_size}_{compression}")
+
+    def time_import_broken_h5(self, path_dir, frame_size, compression):
+        import_broken_h5(
+            self._path_base(path_dir, frame_size, compression) + "_0.h5",
+            average=self.average,
+            roi=[0, frame_size, 0, frame_size],
+        )
+
+    def peakmem_import_broken_h5(self, path_dir, frame_size, compression):
+        import_broken_h5(
+            self._path_base(path_dir, frame_size, compression) + "_0.h5",
+            average=self.average,
+            roi=[0, frame_size, 0, frame_size],
+        )
+
+    def time_h5repair(self, path_dir, frame_size, compression):
+        path_base = self._path_base(path_dir, frame_size, compression)
+        h5repair(
+            path_base + "_0.h5",
+            jsonfilename=path_base + "_documents.json",
+            outputfilename=path_base + "_repaired.h5",
+            average=self.average,
+            roi=[0, frame_size, 0, frame_size],
+        )
+
+
+class LoaderAllocations:
+    """
+    Memory of the loaders per frame: the peak of the traced NumPy
+    allocations in units of one float64 frame (i.e., the number of frame
+    sized copies alive at once) and the peak RSS, reading 20 frames of
+    2048 x 2048.
+    """
+
+    params = (["import_broken_h5", "load_h5_image", "load_h5_image_out"],)
+    param_names = ["loader"]
+    timeout = 600
+    average = 10
+    frame_size = 2048
+    unit = "frames"
+
+    def setup_cache(self):
+        path_dir = os.path.abspath("loader_allocations")
+        os.makedirs(path_dir, exist_ok=True)
+        h5filename, _ = sy.write_broken_pair(
+            os.path.join(path_dir, "scan"),
+            n_positions=2,
+            average=self.average,
+            frame_shape=(self.frame_size, self.frame_size),
+            missing_frames=[self.average + 3],
+            seed=0,
+        )
+        path_file = sy.write_nexus_file(
+            os.path.join(path_dir, "image.h5"),
+            n_images=1,
+            n_exposures=2 * self.average,
+            frame_shape=(self.frame_size, self.frame_size),
+            seed=0,
+        )
+        return h5filename, path_file
+
+    def setup(self, paths, loader):
+        self.out = np.empty((2 * self.average, self.frame_size, self.frame_size))
+
+    def _load(self, paths, loader):
+        h5filename, path_file = paths
+        if loader == "import_broken_h5":
+            import_broken_h5(
+                h5filename,
+                average=self.average,
+                roi=[0, self.frame_size, 0, self.frame_size],
+                missing_frames=[self.average + 3],
+            )
+        elif loader == "load_h5_image":
+            fp.load_h5_image(path_file)
+        else:
+            fp.load_h5_image(path_file, out=self.out)
+
+    def track_peak_frame_copies(self, paths, loader):
+        import tracemalloc
+
+        tracemalloc.start()
+        try:
+            self._load(paths, loader)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return peak / (self.frame_size**2 * 8)
+
+    def peakmem_load(self, paths, loader):
+        self._load(paths, loader)
+
+
+class Reducers:
+    """
+    Plain and robust averaging of a 2048 x 2048 x 100 frame stack read from
+    an HDF5 file, against the current path ("current": loading the whole
+    stack with load_h5_image and averaging it with np.average).
+    """
+
+    params = (["current", "mean", "median", "sigma_clip"],)
+    param_names = ["reducer"]
+    timeout = 900
+    n_frames = 100
+    frame_size = 2048
+
+    def setup_cache(self):
+        path_file = os.path.abspath("reducers.h5")
+        sy.write_nexus_file(
+            path_file,
+            n_images=1,
+            n_exposures=self.n_frames,
+            frame_shape=(self.frame_size, self.frame_size),
+            seed=0,
+        )
+        return path_file
+
+    def setup(self, path_file, reducer):
+        # The frames of a position averaged in memory by import_broken_h5
+        rng = np.random.default_rng(0)
+        self.frames = rng.poisson(100, (10, self.frame_size, self.frame_size))
+
+    def _reduce_file(self, path_file, reducer):
+        if reducer == "current":
+            return np.average(fp.load_h5_image(path_file), axis=0)
+        return fp.load_h5_reduced_image(path_file, reducer=reducer)
+
+    def time_reduce_file(self, path_file, reducer):
+        self._reduce_file(path_file, reducer)
+
+    def peakmem_reduce_file(self, path_file, reducer):
+        self._reduce_file(path_file, reducer)
+
+    def time_reduce_frames(self, path_file, reducer):
+        if reducer == "current":
+            np.mean(self.frames, axis=0)
+        else:
+            dp.reduce_stack(self.frames, reducer)
+
+
+class Campaign:
+    """
+    Grouping of a directory of Nexus files by their labview data.
+    """
+
+    params = ([1, 4],)
+    param_names = ["workers"]
+    timeout = 600
+    positions = {"sample_lift": np.arange(8.0)}
+    frame_size = 512
+
+    def setup_cache(self):
+        path_dir = os.path.abspath("campaign") + os.sep
+        sy.write_campaign(
+            path_dir,
+            positions=self.positions,
+            layout="circular",
+            n_images=5,
+            frame_shape=(self.frame_size, self.frame_size),
+            seed=0,
+        )
+        return path_dir
+
+    def time_get_file_groups(self, path_dir, workers):
+        fp.get_file_groups(
+            path_dir,
+            key_common="sample_lift",
+            key_variable="EPU_Polarization",
+            workers=workers,
+        )
+
+
+class BatchDichroism:
+    """
+    Dichroism of all file groups of a campaign, including saving and
+    plotting.
+    """
+
+    params = (FRAME_SIZES,)
+    param_names = ["frame_size"]
+    timeout = 900
+    positions = {"sample_lift": np.arange(4.0)}
+
+    def setup_cache(self):
+        for size in FRAME_SIZES:
+            sy.write_campaign(
+                os.path.abspath(f"batch_{size}"),
+                positions=self.positions,
+                layout="circular",
+                n_images=5,
+                frame_shape=(size, size),
+                seed=0,
+            )
+        return os.path.abspath("batch")
+
+    def time_batch_processing_dichroism(self, path_prefix, frame_size):
+        fp.batch_processing_dichroism(
+            f"{path_prefix}_{frame_size}" + os.sep,
+            key_common="sample_lift",
+            key_variable="EPU_Polarization",
+            reuse_figure=True,
+            incremental=False,
+        )
+
+
+class Plotting:
+    """
+    Plotting of single detector images.
+    """
+
+    params = (FRAME_SIZES,)
+    param_names = ["frame_size"]
+
+    def setup(self, frame_size):
+        from BL7011 import plotting as pt
+
+        self.pt = pt
+        rng = np.random.default_rng(0)
+        shape = (frame_size, frame_size)
+        self.image_a = rng.poisson(sy.synthetic_image(shape, -1)).astype(float)
+        self.image_b = rng.poisson(sy.synthetic_image(shape, 1)).astype(float)
+        self.dichroism = self.image_a - self.image_b
+
+    def teardown(self, frame_size):
+        import matplotlib.pyplot as plt
+
+        plt.close("all")
+
+    def time_plot_image(self, frame_size):
+        self.pt.plot_image(self.image_a, reuse_figure=True)
+
+    def time_plot_three_images_dichroism(self, frame_size):
+        self.pt.plot_three_images_dichroism(
+            self.image_a, self.image_b, self.dichroism, reuse_figure=True
+        )
+
+
+class ContactSheet:
+    """
+    Contact sheet of the dichroism images of a large campaign.
+    """
+
+    params = ([100, 1000],)
+    param_names = ["n_files"]
+    timeout = 600
+    frame_size = 512
+
+    def setup_cache(self):
+        import h5py
+
+        path_dir = os.path.abspath("contact_sheet")
+        os.makedirs(path_dir, exist_ok=True)
+        rng = np.random.default_rng(0)
+        shape = (self.frame_size, self.frame_size)
+        image_a = sy.synthetic_image(shape, -1)
+        image_b = sy.synthetic_image(shape, 1)
+        for n in range(max(self.params[0])):
+            image = rng.poisson(image_a) - rng.poisson(image_b).astype(float)
+            # Only the dichroism image of a processed data file is read
+            path_file = os.path.join(path_dir, f"processed_{n:04d}.h5")
+            with h5py.File(path_file, "w") as f:
+                f.create_dataset("process/image_dichro", data=image)
+        return path_dir
+
+    def setup(self, path_dir, n_files):
+        self.sources = [
+            os.path.join(path_dir, f"processed_{n:04d}.h5") for n in range(n_files)
+        ]
+
+    def time_plot_contact_sheet(self, path_dir, n_files):
+        from BL7011 import plotting as pt
+
+        pt.plot_contact_sheet(self.sources)
+
+
+class Imports:
+    """
+    Import time of the processing modules, each in a fresh interpreter, as
+    the heavy dependencies are imported lazily.
+    """
+
+    def timeraw_import_file_processing(self):
+        return "import BL7011.file_processing"
+
+    def timeraw_import_repair(self):
+        return "import BL7011.repair"
@@ -16,7 +16,7 @@ with open(os.path.join('BL7011', '_version.py'), 'r') as version_file:
 
 setuptools.setup(
     name='BL7011',
-    packages=setuptools.find_packages(""),
+    packages=setuptools.find_packages("", exclude=['benchmarks']),
     version=__version__,
     license='MIT',  # Chose a license from here: https://help.github.com/articles/licensing-a-repository
     description='package for analysis of experimental xray absorption spectroscopy data',
@@ -30,6 +30,12 @@ setuptools.setup(
         'matplotlib',
         'tqdm',
         'scikit-learn'],
+    entry_points={
+        'console_scripts': [
+            'bl7011-repair=BL7011.cli:repair_main',
+            'bl7011-groups=BL7011.cli:groups_main',
+            'bl7011-dichroism=BL7011.cli:dichroism_main',
+        ]},
     classifiers=[
         'Development Status :: 4 - Beta',  # Chose either "3 - Alpha", "4 - Beta" or "5 -
                                            # Production/Stable" as the current state